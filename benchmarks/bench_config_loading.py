@@ -0,0 +1,76 @@
+"""
+Usage:
+    python benchmarks/bench_config_loading.py [iterations]
+
+Times loading a rugby config and rendering its Vagrantfile the way every
+build does, first with the loader caches emptied before each build (as if
+every config was new), then with them warm. Prints the results as JSON.
+"""
+# stdlib
+from os.path import dirname, abspath, join
+import tempfile
+import shutil
+import json
+import time
+import sys
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'rugby'))
+
+# internal
+from rugby_loader import RugbyLoader, clear_caches
+
+RUGBY_CONFIG = """
+- name: Database
+  service:
+    group: db
+    type: mongo
+- name: Tests
+  service:
+    group: lang
+    type: node
+  depends_on:
+    - Database
+  install:
+    - npm install
+  script:
+    - npm test
+  parallelism: 4
+  shard_tests: find test -name '*.js'
+"""
+
+def run(iterations, work_dir, config_path, cold):
+    """
+    This function loads and renders config_path iterations times, and
+    returns the mean seconds taken per build
+    """
+    start = time.time()
+    for index in range(iterations):
+        if cold:
+            clear_caches()
+        rugby_loader = RugbyLoader('bench{}'.format(index % 8), config_path)
+        rugby_loader.render_vagrant(work_dir, 'https://example.com/repo/raw/master')
+    return (time.time() - start) / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    work_dir = tempfile.mkdtemp()
+    try:
+        config_path = join(work_dir, '.rugby.yml')
+        with open(config_path, 'w') as config_file:
+            config_file.write(RUGBY_CONFIG)
+
+        cold = run(iterations, work_dir, config_path, True)
+        warm = run(iterations, work_dir, config_path, False)
+    finally:
+        shutil.rmtree(work_dir)
+
+    sys.stdout.write(json.dumps({
+        'benchmark' : 'config_loading',
+        'iterations' : iterations,
+        'cold_ms' : round(cold * 1000, 3),
+        'warm_ms' : round(warm * 1000, 3),
+        'speedup' : round(cold / warm, 1) if warm else None
+    }, indent=2, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""
+Usage:
+    python benchmarks/bench_load.py [--builds 1000] [--levels 4,16,64] [--output results.json]
+    python benchmarks/bench_load.py --compare old.json new.json
+
+Load test of the whole build pipeline. Every block is put on the fake
+provider, which stands in for Vagrant and SSH: bringing blocks up takes
+--up-seconds and every command takes --command-seconds, so what is
+measured is Rugby itself, IE worker processes, the supervisor, the
+scheduler and the database.
+
+For each concurrency level in --levels, a fresh Rugby with that many
+concurrent builds (and room for their VMs) is started in its own process,
+and --builds synthetic builds are pushed through Rugby.start_runner. Each
+level reports
+
+    throughput    = builds finished per second
+    latency       = seconds from start_runner to the build finishing
+    run_latency   = seconds from the build leaving the queue to finishing
+    state_lag     = seconds from a worker entering a state to the
+                    start_runner callback hearing about it
+    callback_lag  = seconds states waited for a callback thread, and
+                    how many were coalesced, retried or timed out
+    db_write      = seconds taken by a small write made every
+                    --probe-interval seconds while builds run, IE how
+                    long writers wait on each other
+    state_backlog = most state updates waiting for the database writer
+    worker_rss_kb = peak resident memory of each worker process
+    missing_test_sections = successful builds whose log has no
+                    RUNNING_TESTS section, which should always be 0
+
+Levels are compared by throughput per concurrent build. The largest
+level which still gets --efficiency of the smallest level's throughput
+per build, and finishes every build, is reported as
+max_sustainable_concurrency.
+
+Results are written as JSON to --output, along with the git revision and
+parameters, so runs on different revisions can be compared with --compare.
+"""
+# stdlib
+from os.path import dirname, abspath, join
+import subprocess
+import argparse
+import tempfile
+import platform
+import hashlib
+import shutil
+import json
+import time
+import sys
+import os
+
+RUGBY_DIR = join(dirname(dirname(abspath(__file__))), 'rugby')
+sys.path.insert(0, RUGBY_DIR)
+
+# internal
+import rugby_metrics
+
+# Metrics --compare shows, and whether bigger is better
+COMPARED = [('throughput', True), ('latency.p50', False), ('latency.p95', False),
+            ('run_latency.p95', False), ('state_lag.p95', False), ('callback_lag.p95', False),
+            ('db_write.p95', False), ('worker_rss_kb.max', False)]
+
+def rugby_config(blocks, commands):
+    """
+    This function returns a .rugby.yml with blocks blocks, each with
+    commands install and script commands
+    """
+    lines = []
+    for index in range(blocks):
+        group, service_type = ('db', 'mongo') if index % 2 else ('lang', 'node')
+        lines.append('- name: block-{}'.format(index))
+        lines.append('  service: {{group: {}, type: {}}}'.format(group, service_type))
+        for field in ['install', 'script']:
+            lines.append('  {}:'.format(field))
+            for command in range(commands):
+                lines.append('    - echo {} {}'.format(field, command))
+    return '\n'.join(lines) + '\n'
+
+def commit(index):
+    """
+    This function returns the commit object of synthetic build index
+    """
+    commit_id = hashlib.sha1('bench-{}'.format(index)).hexdigest()
+    return {
+        'commit_id' : commit_id,
+        'commit_message' : 'Synthetic build {}'.format(index),
+        'commit_url' : 'https://example.com/bench/commit/{}'.format(commit_id),
+        'commit_timestamp' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'author_login' : 'bench',
+        'author_email' : 'bench@example.com',
+        'author_avatar_url' : '',
+        'contributors_email' : 'bench@example.com',
+        'clone_url' : 'https://example.com/bench.git',
+        'raw_url' : 'https://example.com/bench/raw',
+    }
+
+def summarize(values):
+    """
+    This function returns count, mean, p50, p95 and max of a list of
+    numbers, with the percentiles worked out the same way as the
+    metrics rugby records
+    """
+    values = list(values)
+    stats = rugby_metrics.summarize(values)
+    stats['mean'] = sum(values) / float(len(values)) if values else None
+    return stats
+
+def rss_kb(pid):
+    """
+    This function returns the resident memory of a process in KB,
+    or None if it has exited
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def run_level(args, level, work_dir):
+    """
+    This function pushes args.builds builds through a fresh Rugby which
+    runs level builds at once, and returns the level's results. It must
+    run in a process of its own, since config has to be set before the
+    rugby modules are imported
+    """
+    import config
+    config.DEBUG_MODE = False
+    config.FAKE_VAGRANT = True
+    config.FAKE_UP_SECONDS = args.up_seconds
+    config.FAKE_COMMAND_SECONDS = args.command_seconds
+    config.POOL_ENABLED = False
+    config.SOURCE_CACHE_ENABLED = False
+    config.INSTALL_CACHE_ENABLED = False
+    config.RESULT_CACHE_ENABLED = False
+    config.COORDINATOR_ADDRESS = None
+    config.MAX_CONCURRENT_BUILDS = level
+    config.MAX_CONCURRENT_VMS = level * args.blocks
+    config.MAX_QUEUE_SIZE = args.builds
+
+    from rugby import Rugby, BuildInfo
+    from rugby_database import RugbyDatabase
+    from rugby_state import RugbyState, FINISHED_STATES
+    from threading import Thread, Lock, Event
+
+    rugby_root = join(work_dir, 'root')
+    log_dir = join(work_dir, 'logs')
+    os.makedirs(rugby_root)
+    os.makedirs(log_dir)
+    config_path = join(work_dir, '.rugby.yml')
+    with open(config_path, 'w') as config_file:
+        config_file.write(rugby_config(args.blocks, args.commands))
+
+    finished_states = [str(finished_state) for finished_state in FINISHED_STATES]
+    lock = Lock()
+    all_done = Event()
+    submitted = {}
+    received = {}
+    final = {}
+
+    def on_state(commit_id, state):
+        now = time.time()
+        with lock:
+            received.setdefault(commit_id, {}).setdefault(state, now)
+            if state in finished_states and commit_id not in final:
+                final[commit_id] = state
+                if len(final) == args.builds:
+                    all_done.set()
+
+    rugby = Rugby(rugby_root, log_dir)
+    probe_db = RugbyDatabase(rugby_root)
+    db_writes = []
+    backlog = [0]
+    worker_rss = {}
+    parent_rss = [0]
+
+    def sample():
+        while not all_done.is_set():
+            started = time.time()
+            probe_db.record_source_cache('bench-probe', True)
+            db_writes.append(time.time() - started)
+            if rugby.rugby_db._writes != None:
+                backlog[0] = max(backlog[0], rugby.rugby_db._writes.qsize())
+            for worker in Rugby.workers.values():
+                rss = rss_kb(worker.pid)
+                if rss != None:
+                    worker_rss[worker.pid] = max(worker_rss.get(worker.pid, 0), rss)
+            parent_rss[0] = max(parent_rss[0], rss_kb(os.getpid()) or 0)
+            all_done.wait(args.probe_interval)
+
+    sampler = Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+
+    started_at = time.time()
+    for index in range(args.builds):
+        build_info = BuildInfo(commit(index))
+        submitted[build_info.commit_id] = time.time()
+        rugby.start_runner(build_info, config_path, on_state)
+    all_done.wait(args.timeout)
+    elapsed = time.time() - started_at
+    rugby.rugby_db.flush()
+
+    queued = str(RugbyState.QUEUED)
+    latency = []
+    run_latency = []
+    state_lag = []
+    for commit_id, states in received.items():
+        if commit_id not in final:
+            continue
+        finished_at = states[final[commit_id]]
+        latency.append(finished_at - submitted[commit_id])
+        launched = [at for state, at in states.items() if state != queued]
+        run_latency.append(finished_at - min(launched))
+        # Workers record when they entered each state
+        for phase in rugby.get_phases(commit_id):
+            if phase['phase'] in states:
+                state_lag.append(states[phase['phase']] - phase['started_at'])
+
+    callback_stats = rugby.get_callback_stats()
+
+    # Every successful build's log should have a section for its
+    # tests. Logs are compacted in the background once builds finish
+    tests_phase = str(RugbyState.RUNNING_TESTS)
+    missing_sections = 0
+    for commit_id, state in final.items():
+        if state != str(RugbyState.SUCCESS):
+            continue
+        sections = rugby.get_log_sections(commit_id)
+        deadline = time.time() + 10
+        while sections == None and time.time() < deadline:
+            time.sleep(0.1)
+            sections = rugby.get_log_sections(commit_id)
+        if sections == None or tests_phase not in sections['phases']:
+            missing_sections += 1
+
+    outcomes = {}
+    for state in final.values():
+        outcomes[state] = outcomes.get(state, 0) + 1
+
+    return {
+        'level' : level,
+        'builds' : args.builds,
+        'finished' : len(final),
+        'outcomes' : outcomes,
+        'elapsed' : elapsed,
+        'throughput' : len(final) / elapsed if elapsed else None,
+        'latency' : summarize(latency),
+        'run_latency' : summarize(run_latency),
+        'state_lag' : summarize(state_lag),
+        'callback_lag' : callback_stats['lag'],
+        'callbacks' : dict((name, callback_stats[name]) for name in ['coalesced', 'retried', 'timed_out']),
+        'db_write' : summarize(db_writes),
+        'state_backlog' : backlog[0],
+        'missing_test_sections' : missing_sections,
+        'worker_rss_kb' : summarize(worker_rss.values()),
+        'parent_rss_kb' : parent_rss[0]
+    }
+
+def sustainable(levels, efficiency):
+    """
+    This function returns the largest level whose throughput per build is
+    at least efficiency of the smallest level's, and which finished every
+    build with a complete log, or None if there isn't one
+    """
+    complete = [result for result in levels if result['finished'] == result['builds'] and result['throughput']
+                and not result.get('missing_test_sections')]
+    if not complete:
+        return None
+    base = complete[0]['throughput'] / complete[0]['level']
+    best = None
+    for result in complete:
+        result['efficiency'] = (result['throughput'] / result['level']) / base
+        if result['efficiency'] >= efficiency:
+            best = result['level']
+    return best
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=RUGBY_DIR, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def lookup(result, path):
+    for key in path.split('.'):
+        if result == None:
+            return None
+        result = result.get(key)
+    return result
+
+def compare(old_path, new_path):
+    """
+    This function prints how each level's metrics changed between
+    two result files
+    """
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+    old_levels = dict((result['level'], result) for result in old['levels'])
+    sys.stdout.write('{} -> {}\n'.format(old.get('revision'), new.get('revision')))
+    for result in new['levels']:
+        old_result = old_levels.get(result['level'])
+        if old_result == None:
+            continue
+        sys.stdout.write('level {}\n'.format(result['level']))
+        for path, bigger_is_better in COMPARED:
+            before = lookup(old_result, path)
+            after = lookup(result, path)
+            if not before or after == None:
+                continue
+            change = (after - before) / float(before) * 100
+            better = (change > 0) == bigger_is_better
+            sys.stdout.write('  {:<20} {:>12.4f} {:>12.4f} {:>+8.1f}% {}\n'.format(
+                path, before, after, change, 'better' if better or change == 0 else 'worse'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Rugby load test with a fake provider')
+    parser.add_argument('--builds', type=int, default=1000, help='builds pushed through each level')
+    parser.add_argument('--levels', default='4,16,64', help='comma separated concurrent build limits')
+    parser.add_argument('--blocks', type=int, default=2, help='blocks in each build')
+    parser.add_argument('--commands', type=int, default=3, help='install and script commands per block')
+    parser.add_argument('--up-seconds', type=float, default=0.05, help='time to bring up blocks')
+    parser.add_argument('--command-seconds', type=float, default=0.01, help='time each command takes')
+    parser.add_argument('--probe-interval', type=float, default=0.1, help='seconds between samples')
+    parser.add_argument('--efficiency', type=float, default=0.8,
+                        help='throughput per build, relative to the smallest level, still counted as sustainable')
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for each level')
+    parser.add_argument('--output', default='bench_load.json', help='file results are written to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--run-level', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.run_level != None:
+        result = run_level(args, args.run_level, args.work_dir)
+        with open(join(args.work_dir, 'result.json'), 'w') as result_file:
+            json.dump(result, result_file)
+        # Don't wait for the janitor and supervisor threads
+        os._exit(0)
+
+    levels = []
+    for level in [int(level) for level in args.levels.split(',')]:
+        work_dir = tempfile.mkdtemp(prefix='rugby-bench-')
+        try:
+            cmd = [sys.executable, abspath(__file__), '--run-level', str(level), '--work-dir', work_dir]
+            for name in ['builds', 'blocks', 'commands', 'up_seconds', 'command_seconds', 'probe_interval', 'timeout']:
+                cmd += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+            subprocess.check_call(cmd)
+            with open(join(work_dir, 'result.json')) as result_file:
+                result = json.load(result_file)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        sys.stderr.write('level {}: {:.1f} builds/s, p95 latency {:.2f}s\n'.format(
+            level, result['throughput'] or 0, result['latency']['p95'] or 0))
+        levels.append(result)
+
+    results = {
+        'benchmark' : 'load',
+        'revision' : git_revision(),
+        'recorded_at' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python' : platform.python_version(),
+        'parameters' : dict((name, getattr(args, name)) for name in
+                            ['builds', 'blocks', 'commands', 'up_seconds', 'command_seconds', 'efficiency']),
+        'levels' : levels,
+        'max_sustainable_concurrency' : sustainable(levels, args.efficiency)
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    sys.stdout.write(json.dumps({'max_sustainable_concurrency' : results['max_sustainable_concurrency'],
+                                 'output' : args.output}) + '\n')
+
+if __name__ == '__main__':
+    main()
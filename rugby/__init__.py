@@ -1,5 +1,7 @@
 # internal
 from rugby import Rugby, BuildInfo
+from rugby_scheduler import QueueFullError
+from rugby_coordinator import CoordinatorError
 import config 
 
 # stdlib
@@ -1,5 +1,6 @@
 # stdlib
 from os.path import dirname, abspath, join
+import os
 
 VM_STATIC_IPS = {
     'db'   : '192.168.0.15',
@@ -28,3 +29,265 @@ VAGRANT_TEMPLATE_FILE = join(TEMPLATES_DIR, 'Vagrantfile.j2')
 # Logger constants
 LOGGER_NAME = 'rugby-console'
 
+
+"""
+Warm VM pool constants
+"""
+POOL_ENABLED = True
+POOL_DIR = '/opt/VM_Pool'
+# (min, max) number of pool VMs to keep for each group and type. min VMs
+# are kept booted and ready, max caps ready + in use VMs
+POOL_SIZES = {
+    'db'   : {'mongo': (1, 2)},
+    'lang' : {'node': (1, 3)}
+}
+# Seconds between maintenance passes when no VM has been released
+POOL_MAINTAIN_INTERVAL = 30
+POOL_SNAPSHOT_NAME = 'rugby-clean'
+# Idle pool VMs are each on their own private network, named
+# POOL_NETWORK_NAME-<slot>, and are given addresses POOL_IP_PREFIX + <slot>
+POOL_NETWORK_NAME = 'rugby-pool'
+POOL_IP_PREFIX = '192.168.100.'
+POOL_IP_SLOTS = range(10, 255)
+
+"""
+Build scheduling constants
+"""
+MAX_CONCURRENT_BUILDS = 4
+# Each block in a rugby config is one VM
+MAX_CONCURRENT_VMS = 8
+MAX_QUEUE_SIZE = 100
+# Builds on these branches are started ahead of other branches
+PRIORITY_BRANCHES = ['master']
+# Number of recent queue wait times kept for stats
+QUEUE_WAIT_SAMPLES = 100
+
+"""
+Build network constants
+"""
+# Each build leases the subnet NETWORK_PREFIX + '<n>.0/24' for some n in
+# NETWORK_SUBNETS, and block i of its rugby config is given the address
+# NETWORK_PREFIX + '<n>.' + (NETWORK_HOST_OFFSET + i)
+NETWORK_PREFIX = '10.42.'
+NETWORK_SUBNETS = range(0, 256)
+NETWORK_HOST_OFFSET = 10
+
+"""
+Command execution constants
+"""
+# Run each block's commands at the same time as the other blocks,
+# instead of finishing one block before starting the next
+PARALLEL_BLOCKS = True
+# Seconds between keepalives on the SSH connection to each VM
+SSH_KEEPALIVE = 30
+
+"""
+Source cache constants
+"""
+# Push an archive of each commit from a host side mirror to every VM,
+# instead of having every VM clone the repo
+SOURCE_CACHE_ENABLED = True
+SOURCE_CACHE_DIR = '/opt/VM_Source_Cache'
+# Number of commit archives to keep around
+SOURCE_ARCHIVE_KEEP = 50
+
+"""
+Install cache constants
+"""
+# Restore the cache_dirs of blocks whose install hasn't changed,
+# instead of running their install commands
+INSTALL_CACHE_ENABLED = True
+INSTALL_CACHE_DIR = '/opt/VM_Install_Cache'
+# Max bytes of install archives to keep
+INSTALL_CACHE_BUDGET = 20 * 1024 ** 3
+# Repo files every block's install is assumed to depend on, along
+# with the block's own cache_files
+INSTALL_CACHE_FILES = ['package.json', 'npm-shrinkwrap.json', 'bower.json']
+
+"""
+Database constants
+"""
+# Seconds to wait for another process to release the database lock
+DB_BUSY_TIMEOUT = 30
+# Number of prepared statements kept per connection
+DB_CACHED_STATEMENTS = 100
+# Max number of state updates written in one transaction
+DB_WRITE_BATCH = 100
+
+"""
+Build cache constants
+"""
+# Number of finished builds whose info is kept in memory. Queued and
+# running builds always are
+BUILD_CACHE_SIZE = 1000
+# Number of distinct get_builds queries whose results are kept in memory
+BUILD_QUERY_CACHE_SIZE = 100
+
+"""
+Metrics constants
+"""
+# Record wall time, CPU time and VM memory of every command
+COMMAND_METRICS = True
+# Number of most recent finished builds phase and command stats cover
+METRICS_WINDOW = 100
+
+"""
+Log streaming constants
+"""
+# Max number of lines a worker sends to the parent in one chunk
+LOG_CHUNK_LINES = 200
+# Seconds a worker waits for more lines before sending a chunk
+LOG_FLUSH_INTERVAL = 0.2
+# Number of most recent lines of each running build kept in memory
+LOG_MEMORY_LINES = 5000
+# Bytes of log lines to buffer before appending them to the log file
+LOG_WRITE_BYTES = 64 * 1024
+# Lines per independently compressed chunk of a finished build's log
+LOG_ARCHIVE_CHUNK_LINES = 1000
+# zlib level finished logs are compressed with
+LOG_COMPRESS_LEVEL = 6
+# Finished logs are deleted once they are older than LOG_RETENTION_DAYS,
+# and oldest first while they take up more than LOG_RETENTION_BYTES
+LOG_RETENTION_DAYS = 90
+LOG_RETENTION_BYTES = 10 * 1024 ** 3
+
+"""
+Result cache constants
+"""
+# Reuse the result of an earlier build with the same source tree and
+# rugby config instead of building again. Needs SOURCE_CACHE_ENABLED
+RESULT_CACHE_ENABLED = True
+# Names of the RugbyStates which are reused
+RESULT_CACHE_STATES = ['SUCCESS']
+
+"""
+Distributed constants
+"""
+# (host, port) the coordinator listens on for agents. When set, builds
+# run on agents instead of as local processes. Agents and the coordinator
+# unpickle whatever the other end sends, so the port must only be
+# reachable from the CI hosts, never exposed to the internet
+COORDINATOR_ADDRESS = None
+# Shared secret agents connect to the coordinator with. There is no
+# default, neither side starts without one
+COORDINATOR_AUTHKEY = os.environ.get('RUGBY_COORDINATOR_AUTHKEY')
+# Capacity each agent registers with by default
+AGENT_MAX_BUILDS = MAX_CONCURRENT_BUILDS
+AGENT_MAX_VMS = MAX_CONCURRENT_VMS
+
+"""
+Provider constants
+"""
+# What blocks run on, unless they pick a provider in .rugby.yml
+#   vagrant   = VirtualBox VM
+#   container = Docker container, starts in under a second but shares
+#               the host's kernel
+#   fake      = Nothing, every command succeeds
+PROVIDERS = ['vagrant', 'container', 'fake']
+DEFAULT_PROVIDER = 'vagrant'
+# Docker image for each type of service
+CONTAINER_IMAGES = {
+    'node'  : 'node:0.12',
+    'mongo' : 'mongo:3.0'
+}
+# Groups whose images don't keep running on their own
+CONTAINER_KEEP_ALIVE_GROUPS = ['lang']
+
+"""
+Fake backend constants
+"""
+# Put every block on the fake provider, for trying out agents and
+# the coordinator on one box
+FAKE_VAGRANT = False
+FAKE_UP_SECONDS = 1
+FAKE_COMMAND_SECONDS = 0.1
+
+"""
+Config loading constants
+"""
+# Number of parsed and validated rugby configs kept, by content hash
+LOADER_CACHE_SIZE = 256
+
+"""
+Janitor constants
+"""
+# Max number of orphaned builds torn down at once
+REAP_THREADS = 8
+# Seconds between janitor passes
+JANITOR_INTERVAL = 60
+# Seconds a build may run before the janitor kills it, None for no limit.
+# A backstop for workers stuck where BUILD_TIMEOUT can't stop them, IE
+# while VMs are coming up, so it should be longer
+MAX_BUILD_SECONDS = 3 * 60 * 60
+
+"""
+Timeout constants
+"""
+# Default seconds a single command, each block's share of a phase, and
+# a whole build may take, None for no limit. Blocks can override them
+# with command_timeout, phase_timeout and build_timeout in .rugby.yml
+COMMAND_TIMEOUT = 30 * 60
+PHASE_TIMEOUT = 60 * 60
+BUILD_TIMEOUT = 2 * 60 * 60
+# Seconds a cancelled worker gets to tear down its VMs before it is killed
+CANCEL_GRACE_SECONDS = 60
+# Cancel running builds of a branch when a newer commit of it is queued
+CANCEL_SUPERSEDED = True
+
+"""
+Callback constants
+"""
+# Number of threads the callbacks of every build are run on
+CALLBACK_THREADS = 8
+# Max number of those threads running the same callback at once, so a
+# slow one can't hold up the rest
+CALLBACK_THREADS_PER_CALLBACK = 4
+# Seconds a callback may run before it is given up on, None for no limit
+CALLBACK_TIMEOUT = 60
+# Max number of times a callback which raised is run again
+CALLBACK_RETRIES = 3
+# Seconds before the first retry, doubled before each one after
+CALLBACK_BACKOFF = 1
+CALLBACK_MAX_BACKOFF = 60
+# Seconds between checks for due retries and callbacks past their timeout
+CALLBACK_MONITOR_INTERVAL = 0.5
+# Number of recent callbacks queue lag and run time stats cover
+CALLBACK_STATS_WINDOW = 1000
+
+"""
+Worker supervision constants
+"""
+# Seconds between heartbeats a worker sends the parent
+HEARTBEAT_INTERVAL = 2
+# Seconds without hearing from a worker before it is flagged as stalled
+HEARTBEAT_TIMEOUT = 20
+# Seconds a worker may stay stalled before it is killed and its build
+# moves to ERROR, None to only flag it
+STALL_KILL_SECONDS = 120
+# Seconds between samples of the CPU and memory each worker uses
+RESOURCE_SAMPLE_INTERVAL = 10
+
+"""
+VM sizing constants
+"""
+# Give each Vagrant VM as much memory and as many CPUs as its block
+# used in recent builds of the same repo, plus headroom, instead of
+# the box's defaults. Blocks can set 'memory' and 'cpus' themselves
+RIGHTSIZE_ENABLED = True
+# Number of most recent builds of each block sizes are worked out from
+RIGHTSIZE_WINDOW = 20
+# Builds of a block which have to be seen before its VMs are sized
+RIGHTSIZE_MIN_BUILDS = 3
+# Fraction added on top of the most memory and CPUs a block used
+RIGHTSIZE_HEADROOM = 0.25
+# Seconds between samples of a VM's memory while a command runs
+RIGHTSIZE_SAMPLE_SECONDS = 1
+# Commands which ran for less than this many seconds aren't used to
+# work out how many CPUs a block needs, since they are too short to say
+RIGHTSIZE_MIN_COMMAND_SECONDS = 5
+# Limits of the sizes given to VMs. Memory is rounded up to a multiple
+# of VM_MEMORY_STEP_MB
+VM_MIN_MEMORY_MB = 512
+VM_MAX_MEMORY_MB = 8192
+VM_MEMORY_STEP_MB = 256
+VM_MAX_CPUS = 4
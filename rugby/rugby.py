@@ -1,14 +1,30 @@
 # internal
 from rugby_worker import RugbyWorker
-from rugby_state import RugbyState
-from rugby_database import RugbyDatabase
+from rugby_state import RugbyState, FINISHED_STATES
+from rugby_database import RugbyDatabase, process_lock
+from rugby_build_cache import RugbyBuildCache
+from rugby_pool import RugbyPool
+from rugby_scheduler import RugbyScheduler, QueueFullError
+from rugby_metrics import RugbyMetrics
+from rugby_log import RugbyLogStream
+from rugby_protocol import (msg_state, is_current, cancel_msg, STATE, LOG, PROGRESS,
+                            RESOURCES, HEARTBEAT)
+from rugby_log_store import RugbyLogStore
+from rugby_source import RugbySourceCache
+from rugby_results import RugbyResultCache
+from rugby_coordinator import RugbyCoordinator, RemoteProcess
+from rugby_janitor import RugbyJanitor, kill_process
+from rugby_callbacks import RugbyCallbackExecutor
 import config
 
 # stdlib
 from multiprocessing import Process, Pipe
-from threading import Thread
-import time
+from threading import Thread, Timer
+from functools import partial
 import logging
+import select
+import time
+import errno
 import sys
 import signal
 import os
@@ -31,13 +47,16 @@ class BuildInfo:
         self.contributors_email = commit_obj["contributors_email"]
         self.clone_url = commit_obj["clone_url"]
         self.raw_url = commit_obj["raw_url"]
+        # Optional, used to prioritize and supersede queued builds
+        self.branch = commit_obj.get("branch")
 
 class WorkerInfo:
     """
     Struct to hold all the info we need about a RugbyWorker
     """
-    def __init__(self, worker_pid, worker_msg_pipe, worker_callbacks):
-        self.pid = worker_pid
+    def __init__(self, worker_process, worker_msg_pipe, worker_callbacks, worker_log_stream, worker_build_info):
+        self.process = worker_process
+        self.pid = worker_process.pid
         self.msg_pipe = worker_msg_pipe
         # List of callback functions to call when worker state
         # changes
@@ -45,8 +64,33 @@ class WorkerInfo:
         # Format of callback
         #   func_name('<commit_id>, '<RugbyState>')
         self.callbacks = worker_callbacks
+        # RugbyLogStream the worker's output goes to
+        self.log_stream = worker_log_stream
+        # BuildInfo of the build the worker is running
+        self.build_info = worker_build_info
+        # When the worker was started
+        self.started_at = time.time()
+        # RugbyState the build ends in once the worker exits, set
+        # when the build is cancelled
+        self.cancel_state = None
+        # When the worker was last heard from, when it was flagged as
+        # stalled for not being heard from, and how long it had gone
+        # without making progress at its last heartbeat
+        self.heartbeat_at = self.started_at
+        self.stalled_at = None
+        self.idle_seconds = 0
+        # Command each block is running or last ran
+        #   { "<block name>" : {"state" : "<RugbyState>", "command" : "npm test",
+        #                       "started_at" : <epoch>, "exit_status" : None,
+        #                       "duration" : None, "commands" : 3} }
+        self.progress = {}
+        # Latest CPU and memory sample of each block, and of the worker
+        # itself under None
+        #   { "<block name>" : {"at" : <epoch>, "cpu_seconds" : 1.2,
+        #                       "mem_kb" : 204800, "peak_mem_kb" : 512000} }
+        self.resources = {}
         
-        # Will be set as Worker starts to work (haha)
+        # RugbyState, will be set as Worker starts to work (haha)
         self.state = None
 
     def __del__(self):
@@ -62,9 +106,19 @@ class Rugby:
             { "<commit_id>" : {"worker" : <WorkerInfo>} }
         - defunct_workers: Array of commit_id's which should be removed from
                            workers dict.
+        - wakeup_pipe: Pipe (read fd, write fd) which is written to whenever
+                       a worker is added, so worker_supervisor starts
+                       watching it
+        - scheduler: RugbyScheduler which decides when queued builds
+                     get a worker
+        - callback_executor: RugbyCallbackExecutor which runs the
+                             callbacks of every build
     """
     workers = {}
     defunct_workers = []
+    wakeup_pipe = os.pipe()
+    scheduler = None
+    callback_executor = None
 
     def __init__(self, rugby_root=config.BASE_DIR, rugby_log_dir=config.LOG_DIR):
         """
@@ -76,22 +130,245 @@ class Rugby:
         self.rugby_root = rugby_root
         self.rugby_log_dir = rugby_log_dir
         self.rugby_db = RugbyDatabase(rugby_root)
+        self.rugby_metrics = RugbyMetrics(self.rugby_db)
+        self.rugby_log_store = RugbyLogStore(rugby_log_dir)
+
+        # Results of earlier builds, by source tree and rugby config
+        self.rugby_results = None
+        if config.RESULT_CACHE_ENABLED and config.SOURCE_CACHE_ENABLED:
+            self.rugby_results = RugbyResultCache(self.rugby_db, RugbySourceCache(self.rugby_db))
+        # Commit ids of queued builds which mustn't reuse a cached result
+        self._forced = set()
+
+        # Builds run on agents instead, which each have their own pool
+        self.rugby_coordinator = None
+        if config.COORDINATOR_ADDRESS != None:
+            self.rugby_coordinator = RugbyCoordinator(on_change=lambda: Rugby.scheduler.schedule())
+
+        # Warm VM pool shared by every worker
+        self.rugby_pool = None
+        if config.POOL_ENABLED and self.rugby_coordinator == None:
+            self.rugby_pool = RugbyPool()
+
+        # Clean up after builds which were running when rugby last
+        # stopped, before anything new is started
+        self.rugby_janitor = RugbyJanitor(rugby_root, self.rugby_db, Rugby.live_builds,
+                                          self.rugby_log_store, self.rugby_pool)
+        self.rugby_janitor.recover()
+        self.rugby_janitor.start(self._expire_builds)
+
+        # Builds, counts of their states and results are read from here.
+        # Made after recover(), which fails stuck builds behind its back
+        self.rugby_build_cache = RugbyBuildCache(self.rugby_db)
+        if self.rugby_pool != None:
+            self.rugby_pool.start()
+
+        # Pick up builds which were queued before a restart. With a
+        # coordinator, builds are started whenever an agent has room
+        if self.rugby_coordinator == None:
+            Rugby.scheduler = RugbyScheduler(self.rugby_db, self._launch, config_dir=rugby_root)
+        else:
+            Rugby.scheduler = RugbyScheduler(self.rugby_db, self._launch, sys.maxint, sys.maxint,
+                                             fits=self.rugby_coordinator.fits, config_dir=rugby_root)
+            self.rugby_coordinator.start()
+        Rugby.scheduler.restore(BuildInfo, (self.rugby_build_cache.update_build,))
+        Rugby.scheduler.schedule()
+
+    def get_queue_stats(self):
+        """
+        Method returns the build queue's depth, running builds and VMs,
+        and how long builds have been waiting to start. See
+        RugbyScheduler.get_stats for the format
+        """
+        return Rugby.scheduler.get_stats()
+
+    def get_callback_stats(self):
+        """
+        Method returns how far behind build callbacks are, and how many
+        were retried or timed out. See RugbyCallbackExecutor.get_stats
+        for the format
+        """
+        return Rugby.callback_executor.get_stats()
+
+    def get_worker_stats(self):
+        """
+        Method returns what the worker of every running build last
+        reported, and whether it has stopped sending heartbeats
+
+            { "<commit_id>" : { "state" : "RugbyState.RUNNING_TESTS",
+                                "heartbeat_age" : 1.5, "idle_seconds" : 30.2,
+                                "stalled" : False,
+                                "progress" : <WorkerInfo.progress>,
+                                "resources" : <WorkerInfo.resources> } }
+        """
+        now = time.time()
+        stats = {}
+        for commit_id, worker in Rugby.workers.items():
+            stats[commit_id] = {
+                'state': str(worker.state) if worker.state != None else None,
+                'heartbeat_age': now - worker.heartbeat_at,
+                'idle_seconds': worker.idle_seconds,
+                'stalled': worker.stalled_at != None,
+                'progress': dict((block_name, dict(block)) for block_name, block in worker.progress.items()),
+                'resources': dict((source, dict(sample)) for source, sample in worker.resources.items())
+            }
+        return stats
+
+    def get_agent_stats(self):
+        """
+        Method returns the capacity and load of every agent connected to
+        the coordinator, or None if builds are run locally. See
+        RugbyCoordinator.get_stats for the format
+        """
+        if self.rugby_coordinator == None:
+            return None
+        return self.rugby_coordinator.get_stats()
+
+    def get_pool_stats(self):
+        """
+        Method returns the state counts and hit/miss counters of the warm
+        VM pool, or None if the pool is disabled
+        """
+        if self.rugby_pool == None:
+            return None
+        return self.rugby_pool.get_stats()
 
-    def get_builds(self):
-        return self.rugby_db.get_builds()
+    def get_source_cache_stats(self):
+        """
+        Method returns source cache hits and misses for each repo
+            [ {"clone_url" : "<url>", "hits" : 3, "misses" : 1, "last_used" : "<timestamp>"} ]
+        """
+        return self.rugby_db.get_source_cache_stats()
+
+    def get_install_cache(self, commit_id):
+        """
+        Method takes a unique commit_id and returns whether each of its
+        blocks restored its install from cache
+            [ {"block_name" : "<name>", "fingerprint" : "<sha1>", "hit" : 1, ...} ]
+        """
+        return self.rugby_db.get_install_cache(commit_id)
+
+    def get_phases(self, commit_id):
+        """
+        Method takes a unique commit_id and returns how long its build
+        spent in each RugbyState
+            [ {"phase" : "<RugbyState>", "started_at" : <epoch>, "duration" : <seconds>} ]
+        """
+        return self.rugby_metrics.get_phases(commit_id)
+
+    def get_commands(self, commit_id):
+        """
+        Method takes a unique commit_id and returns every command its build
+        ran, with its block, phase, duration, exit status, CPU seconds and
+        the VM's used memory afterwards
+        """
+        return self.rugby_metrics.get_commands(commit_id)
+
+    def get_phase_stats(self, builds=config.METRICS_WINDOW):
+        """
+        Method returns p50/p95 durations of each phase over the most
+        recent finished builds. See RugbyMetrics.phase_stats
+        """
+        return self.rugby_metrics.phase_stats(builds)
+
+    def get_command_stats(self, builds=config.METRICS_WINDOW, block_name=None):
+        """
+        Method returns p50/p95 durations of each command over the most
+        recent finished builds. See RugbyMetrics.command_stats
+        """
+        return self.rugby_metrics.command_stats(builds, block_name)
+
+    def get_builds(self, limit=None, before=None, state=None, author_login=None):
+        """
+        Method returns builds newest first, optionally filtered by state
+        and author_login. Pass the build_id of the last build of a page
+        as before to get the next limit builds.
+        """
+        return self.rugby_build_cache.get_builds(limit, before, state, author_login)
 
     def get_info(self, commit_id):
         """
         Method takes a unique commit_id and returns a dictionary containing 
         all the information related to it.
         """
-        return self.rugby_db.get_info(commit_id) 
+        return self.rugby_build_cache.get_info(commit_id)
 
-    def start_runner(self, build_info, rugby_config, *args):
+    def get_branch_result(self, branch):
+        """
+        Method returns the commit_id and state of the newest build on
+        branch which passed or failed, or None, without touching the
+        database. See RugbyBuildCache.get_branch_result
+        """
+        return self.rugby_build_cache.get_branch_result(branch)
+
+    def get_build_summary(self):
+        """
+        Method returns the number of builds in each state, the pass rate
+        of each author and the newest result of each branch, without
+        touching the database. See RugbyBuildCache.get_summary
+        """
+        return self.rugby_build_cache.get_summary()
+
+    def get_build_cache_stats(self):
+        """
+        Method returns how many builds are cached, and how many reads
+        of get_builds and get_info were answered without the database
+        """
+        return self.rugby_build_cache.get_stats()
+
+    def stream_log(self, commit_id, offset=0):
+        """
+        Method returns a generator which yields every line of a build's
+        log from offset onwards as
+            (<offset>, <timestamp>, <block name or None>, <RugbyState>, <text>)
+        While the build is running it keeps waiting for new lines until
+        the build finishes. To resume following a build, pass the offset
+        after the last line received
+        """
+        worker = Rugby.workers.get(commit_id)
+        if worker != None:
+            return worker.log_stream.stream(offset)
+        return self.rugby_log_store.read(commit_id, offset)
+
+    def read_log(self, commit_id, offset=0, limit=None, phase=None, block_name=None):
+        """
+        Method returns a generator which yields up to limit lines of a
+        build's log from offset onwards, in the same format as stream_log,
+        only including lines of phase and block_name if they are given.
+        Unlike stream_log it never waits for new lines. Logs of finished
+        builds are compressed, and only the parts needed are read
+        """
+        return self.rugby_log_store.read(commit_id, offset, limit, phase, block_name)
+
+    def tail_log(self, commit_id, lines=500):
+        """
+        Method returns a generator which yields the last lines lines
+        of a build's log, in the same format as stream_log
+        """
+        return self.rugby_log_store.tail(commit_id, lines)
+
+    def get_log_sections(self, commit_id):
+        """
+        Method returns the first and last line offset of each phase and
+        block in a finished build's log, to pass to read_log. Phases are
+        str() of the RugbyState each line was logged in
+            {"phases" : {"RugbyState.RUNNING_TESTS" : [first, last], ...},
+             "blocks" : {"<block name>" : [first, last]}}
+        """
+        return self.rugby_log_store.sections(commit_id)
+
+    def get_log_stats(self):
+        """
+        Method returns how many build logs are kept and how
+        much disk they take up
+        """
+        return self.rugby_log_store.get_stats()
+
+    def start_runner(self, build_info, rugby_config, *args, **kwargs):
         """
         Method takes a unique commit_id, clone_url for the repo with the commit id,
         a path (rugby_config) to a rugby config file, and any number of callback functions 
-        and creates a rugby worker which will execute all the instructions 
+        and queues up a rugby worker which will execute all the instructions 
         in the config. The callback functions will be called everytime there 
         is a state change in the worker.
 
@@ -101,36 +378,221 @@ class Rugby:
 
         Where commit_id is the unique id used to spawn the worker, and RugbyState is
         the workers current state, which can be found in rugby_state.py
+
+        The build starts in the QUEUED state, and moves to SUPERSEDED if a
+        newer commit on the same branch is queued before it starts. Raises
+        QueueFullError if the build queue is full.
+
+        If the commit is already queued or running, the callbacks are
+        attached to that build instead of starting another one. If an
+        earlier build had the same source tree and rugby config, its
+        result is reused once the build leaves the queue instead of
+        starting a worker, unless force=True is passed.
+        """
+        force = kwargs.get('force', False)
+        commit_id = build_info.commit_id
+
+        # Set callbacks
+        callbacks = (self.rugby_build_cache.update_build,) + args
+
+        # Coalesce onto the build of this commit which is already queued
+        # or running. It already updates the database itself
+        if Rugby.scheduler.attach(commit_id, args) != None:
+            worker = Rugby.workers.get(commit_id)
+            state = str(RugbyState.QUEUED)
+            if worker != None and worker.state != None:
+                state = str(worker.state)
+            Rugby.run_callbacks(args, commit_id, state)
+            return
+
+        # The result cache is checked when the build is launched, since
+        # finding its source tree can mean fetching the repo
+        if force and self.rugby_results != None:
+            self._forced.add(commit_id)
+        try:
+            superseded = Rugby.scheduler.submit(build_info, rugby_config, callbacks)
+        except QueueFullError:
+            self._forced.discard(commit_id)
+            raise
+        if superseded == None:
+            # Another request for this commit was queued first
+            Rugby.run_callbacks(args, commit_id, str(RugbyState.QUEUED))
+            return
+
+        # Record database entry
+        self.rugby_build_cache.insert_build(build_info)
+        Rugby.run_callbacks(callbacks, build_info.commit_id, str(RugbyState.QUEUED))
+
+        for queued_build in superseded:
+            Rugby.run_callbacks(queued_build.callbacks, queued_build.build_info.commit_id,
+                                str(RugbyState.SUPERSEDED))
+        if config.CANCEL_SUPERSEDED and build_info.branch != None:
+            self._cancel_superseded(build_info)
+
+        Rugby.scheduler.schedule()
+
+    def cancel(self, commit_id, state=RugbyState.CANCELLED, reason=None):
+        """
+        Method stops a build, which ends in state, IE CANCELLED, TIMEOUT
+        or SUPERSEDED. A queued build is just taken off the queue. The
+        worker of a running build stops whatever commands are running and
+        tears down its VMs, and is killed if it hasn't exited within
+        config.CANCEL_GRACE_SECONDS. Returns False if the build isn't
+        queued or running
+        """
+        reason = reason or 'Build was cancelled'
+        queued_build = Rugby.scheduler.cancel(commit_id)
+        if queued_build != None:
+            logger.debug('Cancelled queued build {}'.format(commit_id))
+            Rugby.run_callbacks(queued_build.callbacks, commit_id, str(state))
+            return True
+
+        worker = Rugby.workers.get(commit_id)
+        if worker == None or worker.cancel_state != None or Rugby.is_finished(worker.state):
+            return False
+        logger.debug('Cancelling {}: {}'.format(commit_id, reason))
+        worker.cancel_state = state
+        worker.log_stream.append([(time.time(), None, str(state), reason)])
+
+        msg = cancel_msg(commit_id, state, reason)
+        try:
+            if self.rugby_coordinator != None:
+                # Workers on agents are reached through the coordinator
+                self.rugby_coordinator.send(commit_id, msg)
+            else:
+                worker.msg_pipe.send(msg)
+        except (EOFError, IOError):
+            # Worker has already exited
+            pass
+
+        t = Timer(config.CANCEL_GRACE_SECONDS, Rugby._kill, args=(commit_id, worker))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _cancel_superseded(self, build_info):
+        """
+        Helper function which cancels running builds of the same repo and
+        branch as build_info, since their result no longer matters
+        """
+        for commit_id, worker in Rugby.workers.items():
+            if (commit_id != build_info.commit_id and
+                worker.build_info.branch == build_info.branch and
+                worker.build_info.clone_url == build_info.clone_url):
+                self.cancel(commit_id, RugbyState.SUPERSEDED,
+                            'Build was superseded by {}'.format(build_info.commit_id))
+
+    @staticmethod
+    def _kill(commit_id, worker):
+        """
+        Helper function which kills a cancelled worker which is still
+        running. Its build ends in its cancel state once it has exited,
+        and the janitor tears down whatever it left behind
+        """
+        if worker.process.is_alive():
+            logger.debug('Killing worker {}, it did not stop after being cancelled'.format(commit_id))
+            worker.process.terminate()
+
+    def _check_result(self, build_info, rugby_config, callbacks, force):
+        """
+        Helper function run on its own thread for each launched build
+        when the result cache is enabled. Finishes the build with the
+        cached result of an earlier build with the same source tree and
+        rugby config if there is one, and starts its worker otherwise
+        """
+        commit_id = build_info.commit_id
+        try:
+            key = self.rugby_results.key(build_info, rugby_config)
+            result = None
+            if not force:
+                result = self.rugby_results.lookup(key)
+            if result == None:
+                # Remember the result for the next build of the same source
+                callbacks.append(partial(self.rugby_results.record, key))
+                self._start_worker(build_info, rugby_config, callbacks)
+                return
+            self._reuse_result(build_info, callbacks, result)
+        except Exception:
+            logger.exception('Failed to start build {}'.format(commit_id))
+            Rugby.run_callbacks(callbacks, commit_id, str(RugbyState.ERROR))
+
+        # No worker was started, so give its room back straight away
+        Rugby.scheduler.finished(commit_id)
+        Rugby.scheduler.schedule()
+
+    def _reuse_result(self, build_info, callbacks, result):
+        """
+        Helper function which finishes a build with the cached result
+        of an earlier build, without starting a worker
+        """
+        commit_id = build_info.commit_id
+        logger.debug('Reusing result of {} for {}'.format(result['commit_id'], commit_id))
+
+        # Don't overwrite the log of the build the result came from
+        if result['commit_id'] != commit_id:
+            log_stream = RugbyLogStream(self.rugby_log_store, commit_id)
+            log_stream.append([(time.time(), None, result['state'],
+                                'Reusing result of build {}, which had the same source and config'.format(result['commit_id']))])
+            log_stream.close()
+        Rugby.run_callbacks(callbacks, commit_id, result['state'])
+
+    def _launch(self, build_info, rugby_config, callbacks):
+        """
+        Helper function called by the scheduler once a queued build
+        can start. Creates a rugby worker process for the build, after
+        checking the result cache on another thread if it is enabled
+        """
+        force = build_info.commit_id in self._forced
+        self._forced.discard(build_info.commit_id)
+        if self.rugby_results == None:
+            self._start_worker(build_info, rugby_config, callbacks)
+            return
+        t = Thread(target=self._check_result, args=(build_info, rugby_config, callbacks, force))
+        t.daemon = True
+        t.start()
+
+    def _start_worker(self, build_info, rugby_config, callbacks):
+        """
+        Helper function which creates a rugby worker process for a
+        build which has left the queue
         """
         commit_id = build_info.commit_id
         clone_url = build_info.clone_url
         raw_url = build_info.raw_url
 
-        # Instantiate a worker
-        rw = RugbyWorker(commit_id, clone_url, raw_url, self.rugby_root, rugby_config)
-        
-        # Create pipe for interprocess communication
-        my_end, their_end = Pipe()
+        # Create the log stream Worker output is sent to
+        log_stream = RugbyLogStream(self.rugby_log_store, commit_id)
+        log_stream.append([(time.time(), None, str(RugbyState.STANDBY),
+                            'Starting job with commit id {}...'.format(commit_id))])
 
-        # Create a log file for Worker to send output to
-        worker_log_path = os.path.join(self.rugby_log_dir, commit_id)
-        with open(worker_log_path, 'a') as f:
-            f.write('Starting job with commit id {}... \n\n'.format(commit_id)) 
+        if self.rugby_coordinator != None:
+            # Worker runs on an agent, which relays its messages
+            # to my_end
+            worker_process, my_end = self.rugby_coordinator.launch(build_info, rugby_config)
+        else:
+            # Instantiate a worker
+            rw = RugbyWorker(commit_id, clone_url, raw_url, self.rugby_root, rugby_config, self.rugby_pool)
 
-        # Start worker process
-        worker_process = Process(target=rw, args=(their_end, worker_log_path))
-        worker_process.start()
-        
-        # Record database entry
-        self.rugby_db.insert_build(build_info)
+            # Create pipe for interprocess communication
+            my_end, their_end = Pipe()
 
-        # Set callbacks
-        callbacks = (self.rugby_db.update_build,) + args
+            # Start worker process, never while another thread is
+            # using the database
+            worker_process = Process(target=rw, args=(their_end,))
+            with process_lock():
+                worker_process.start()
+
+            # Only the worker should hold their_end open, so that our end
+            # sees EOF as soon as the worker process exits
+            their_end.close()
 
         # Record worker info
-        worker_info = WorkerInfo(worker_process.pid, my_end, callbacks)
+        worker_info = WorkerInfo(worker_process, my_end, callbacks, log_stream, build_info)
         Rugby.workers[commit_id] = worker_info
 
+        # Let worker_supervisor know there is a new worker to watch
+        os.write(Rugby.wakeup_pipe[1], 'w')
+
     @staticmethod
     def state_change(commit_id, worker_state):
         """
@@ -139,10 +601,112 @@ class Rugby:
         SUCCESS, we add the worker to defunct_workers so they can be reaped
         """
         Rugby.workers[commit_id].state = worker_state
-        if worker_state == str(RugbyState.SUCCESS) or worker_state == str(RugbyState.ERROR):
+        if Rugby.is_finished(worker_state) and commit_id not in Rugby.defunct_workers:
             # Add worker to defunct list
             Rugby.defunct_workers.append(commit_id)
 
+    def _expire_builds(self):
+        """
+        Helper function called by the janitor, which cancels every build
+        which has been running for longer than config.MAX_BUILD_SECONDS
+        """
+        if config.MAX_BUILD_SECONDS == None:
+            return
+        now = time.time()
+        for commit_id, worker in Rugby.workers.items():
+            if now - worker.started_at >= config.MAX_BUILD_SECONDS:
+                self.cancel(commit_id, RugbyState.TIMEOUT,
+                            'Build was killed after running for longer than {}s'.format(config.MAX_BUILD_SECONDS))
+
+    @staticmethod
+    def live_builds():
+        """
+        Method returns the commit_ids of builds with a worker, and of
+        builds the scheduler has started whose worker may not have been
+        added to workers yet, but may already have made its directory
+        """
+        live = set(Rugby.workers)
+        if Rugby.scheduler != None:
+            live |= Rugby.scheduler.running()
+        return live
+
+    @staticmethod
+    def is_finished(worker_state):
+        """
+        Method returns True if worker_state is one a worker never
+        leaves, IE SUCCESS or ERROR
+        """
+        return worker_state in FINISHED_STATES
+
+    @staticmethod
+    def worker_exited(commit_id):
+        """
+        Method is called once a worker's process has exited. If the worker
+        never reported SUCCESS or ERROR it crashed, so it is moved to ERROR
+        and its callbacks are told about it
+        """
+        worker = Rugby.workers[commit_id]
+        worker.process.join()
+        # Every log line the worker sent has been received by now
+        worker.log_stream.close()
+        if not Rugby.is_finished(worker.state):
+            logger.debug('Worker {} exited with code {} before finishing'.format(commit_id, worker.process.exitcode))
+            Rugby.dispatch(commit_id, worker.cancel_state or RugbyState.ERROR)
+        elif commit_id not in Rugby.defunct_workers:
+            Rugby.defunct_workers.append(commit_id)
+
+    @staticmethod
+    def dispatch(commit_id, state):
+        """
+        Method runs a worker's callback functions with its new RugbyState,
+        then performs the state change
+        """
+        Rugby.run_callbacks(Rugby.workers[commit_id].callbacks, commit_id, str(state))
+        # Perform state change. State might not always change
+        # if current worker state is already set to what is present
+        # in the message
+        Rugby.state_change(commit_id, state)
+
+    @staticmethod
+    def run_callbacks(callbacks, commit_id, state):
+        """
+        Method runs each callback function with a build's new state on
+        the threads of Rugby.callback_executor, after the states it was
+        given before
+        """
+        # Callbacks may be attached to a running build at any time
+        Rugby.callback_executor.submit(list(callbacks), commit_id, state)
+
+    @staticmethod
+    def check_heartbeats():
+        """
+        Method flags workers which haven't been heard from for
+        config.HEARTBEAT_TIMEOUT seconds as stalled, without waiting for
+        them to exit. A worker which is still stalled after
+        config.STALL_KILL_SECONDS is killed, and its build moves to ERROR
+        """
+        now = time.time()
+        for commit_id, worker in Rugby.workers.items():
+            if Rugby.is_finished(worker.state):
+                continue
+            silent = now - worker.heartbeat_at
+            if worker.stalled_at == None:
+                if silent >= config.HEARTBEAT_TIMEOUT:
+                    worker.stalled_at = now
+                    msg = 'Worker has not been heard from for {:.0f}s'.format(silent)
+                    logger.warning('{}: {}'.format(commit_id, msg))
+                    worker.log_stream.append([(now, None, str(worker.state), msg)])
+            elif (config.STALL_KILL_SECONDS != None and worker.cancel_state == None and
+                  now - worker.stalled_at >= config.STALL_KILL_SECONDS):
+                msg = 'Killing worker, it has not been heard from for {:.0f}s'.format(silent)
+                logger.warning('{}: {}'.format(commit_id, msg))
+                worker.log_stream.append([(now, None, str(RugbyState.ERROR), msg)])
+                worker.cancel_state = RugbyState.ERROR
+                if isinstance(worker.process, RemoteProcess):
+                    worker.process.kill()
+                else:
+                    kill_process(worker.process.pid)
+
     @staticmethod
     def reap_defunct():
         """
@@ -151,50 +715,115 @@ class Rugby:
         """
         for i in Rugby.defunct_workers:
             # Delete worker from workers
+            Rugby.workers[i].log_stream.close()
             del Rugby.workers[i]
+            # Give its room back to the scheduler
+            if Rugby.scheduler != None:
+                Rugby.scheduler.finished(i)
 
         # Clear defunct list
         Rugby.defunct_workers = []
 
-def worker_poller():
+        # Start whatever fits in the room that was freed up
+        if Rugby.scheduler != None:
+            Rugby.scheduler.schedule()
+
+def worker_supervisor():
     """
-    This function continuously polls every rugby worker in 
-    Rugby.workers to see if they have a message to share 
-    with us. State is changed based on the message. 
+    This function blocks until a rugby worker in Rugby.workers has
+    a message to share with us, or has exited, and handles it straight
+    away. State is changed based on the message. While no worker has
+    anything to say this function sleeps in poll(), and is only woken
+    up early by start_runner through Rugby.wakeup_pipe. While builds are
+    running it also wakes up every HEARTBEAT_INTERVAL to check their
+    heartbeats, and while nothing is running it doesn't wake up at all.
     """
+    wakeup_fd = Rugby.wakeup_pipe[0]
     while True:
-        for worker_id, worker in Rugby.workers.iteritems():
-            # If worker has sent a message
-            if worker.msg_pipe.poll():
-                # Fetch message from pipe
-                recv_msg = str(worker.msg_pipe.recv()) 
-                logger.debug(recv_msg)
-                # Extract info from recv_msg
-                # NOTE: commit_id and worker_id should be equal
-                # to each other
-                commit_id, state = RugbyWorker.extract_id_and_state(recv_msg)
-                # Run worker callback functions with the new state
-                # information
-                for cb in worker.callbacks:
-                    # Run each callback
-                    t = Thread(target=cb, args=(commit_id, state))
-                    t.start()
-                # Perform state change. State might not always change
-                # if current worker state is already set to what is present
-                # in the message
-                Rugby.state_change(commit_id, state)
+        # Watch the wakeup pipe along with every worker's pipe. Pipe ends
+        # become readable both when a message arrives and when the
+        # worker process exits
+        poller = select.poll()
+        poller.register(wakeup_fd, select.POLLIN)
+        fd_to_worker = {}
+        for worker_id, worker in Rugby.workers.items():
+            fd = worker.msg_pipe.fileno()
+            fd_to_worker[fd] = worker_id
+            poller.register(fd, select.POLLIN)
+
+        # Wake up every HEARTBEAT_INTERVAL to look for stalled workers,
+        # but only while there are workers which could stall
+        timeout = None
+        if any(not Rugby.is_finished(worker.state) for worker in Rugby.workers.itervalues()):
+            timeout = config.HEARTBEAT_INTERVAL * 1000
+        try:
+            events = poller.poll(timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd, event in events:
+            if fd == wakeup_fd:
+                os.read(wakeup_fd, 4096)
+            elif fd_to_worker[fd] in Rugby.workers:
+                handle_worker(fd_to_worker[fd])
+        Rugby.check_heartbeats()
 
         # Reap all defunct workers
         Rugby.reap_defunct()
 
-        # Wait a bit before iterating through workers again
-        time.sleep(5)
+def handle_worker(worker_id):
+    """
+    This function reads every message waiting in a worker's pipe
+    and handles them, see rugby_protocol for what they hold. If the
+    pipe has been closed the worker process has exited.
+    """
+    worker = Rugby.workers[worker_id]
+    try:
+        while worker.msg_pipe.poll():
+            msg = worker.msg_pipe.recv()
+            if not is_current(msg):
+                continue
+            # Any message shows the worker is alive
+            worker.heartbeat_at = time.time()
+            if worker.stalled_at != None:
+                logger.warning('{}: Worker is being heard from again'.format(worker_id))
+                worker.stalled_at = None
 
-# Start polling workers 
-t = Thread(target=worker_poller)
+            kind = msg[1]
+            if kind == LOG:
+                worker.log_stream.append(msg[4])
+            elif kind == STATE:
+                state = msg_state(msg)
+                logger.debug('{} {} {}'.format(worker_id, state, msg[5]))
+                Rugby.dispatch(worker_id, state)
+            elif kind == PROGRESS:
+                _, _, _, timestamp, block_name, _, command, exit_status, duration = msg
+                block = worker.progress.setdefault(block_name, {'commands': 0})
+                if duration == None:
+                    block.update(state=str(msg_state(msg)), command=command, started_at=timestamp,
+                                 exit_status=None, duration=None)
+                else:
+                    block.update(exit_status=exit_status, duration=duration, commands=block['commands'] + 1)
+            elif kind == RESOURCES:
+                _, _, _, timestamp, block_name, cpu_seconds, mem_kb = msg
+                sample = worker.resources.setdefault(block_name, {'peak_mem_kb': None})
+                sample.update(at=timestamp, cpu_seconds=cpu_seconds, mem_kb=mem_kb,
+                              peak_mem_kb=max(sample['peak_mem_kb'], mem_kb))
+            elif kind == HEARTBEAT:
+                worker.idle_seconds = msg[4]
+    except (EOFError, IOError):
+        Rugby.worker_exited(worker_id)
+
+# Start supervising workers
+t = Thread(target=worker_supervisor)
 t.daemon = True
 t.start()
 
+# Start the threads callbacks are run on
+Rugby.callback_executor = RugbyCallbackExecutor()
+
 def sigint_handler(sig_num, frame):
     """
     Handler for when Ctrl-C, or SIGINT is sent. This
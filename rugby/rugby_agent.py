@@ -0,0 +1,182 @@
+# internal
+from rugby_worker import RugbyWorker
+from rugby_pool import RugbyPool
+from rugby_database import RugbyDatabase, process_lock
+from rugby_janitor import RugbyJanitor, kill_process
+from rugby_coordinator import CoordinatorError
+import config
+
+# stdlib
+from multiprocessing.connection import Client
+from multiprocessing import Process, Pipe
+from threading import Thread, Lock
+import logging
+import socket
+import errno
+import sys
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+class RugbyAgent:
+    """
+    Usage:
+        agent = RugbyAgent(('ci-coordinator', 7100))
+        agent.serve_forever()
+
+        or from a shell on each CI host
+        python rugby/rugby_agent.py ci-coordinator:7100 [max builds] [max VMs]
+
+    Runs builds handed out by a RugbyCoordinator on this host. The agent
+    registers its capacity, then starts a RugbyWorker process for every
+    build it is given, and relays everything the worker sends back to
+    the coordinator. Builds only use this host's VMs, pool and caches.
+    """
+
+    def __init__(self, coordinator_address, authkey=None,
+                 rugby_root=config.BASE_DIR, max_builds=config.AGENT_MAX_BUILDS,
+                 max_vms=config.AGENT_MAX_VMS, agent_id=None):
+        """
+        coordinator_address = (host, port) of the coordinator
+        authkey    = Shared secret to connect with, config.COORDINATOR_AUTHKEY
+                     by default. Raises CoordinatorError if there is none
+        rugby_root = Directory where rugby generated files should be placed
+        max_builds = Max number of builds to run at once
+        max_vms    = Max number of VMs to run at once
+        agent_id   = Unique name of this agent, host name and pid by default
+        """
+        self.coordinator_address = coordinator_address
+        self.authkey = authkey or config.COORDINATOR_AUTHKEY
+        if not self.authkey:
+            raise CoordinatorError('No coordinator authkey, set RUGBY_COORDINATOR_AUTHKEY')
+        self.rugby_root = rugby_root
+        self.max_builds = max_builds
+        self.max_vms = max_vms
+        self.agent_id = agent_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        # Warm VM pool of this host
+        self.rugby_pool = None
+        if config.POOL_ENABLED and not config.FAKE_VAGRANT:
+            self.rugby_pool = RugbyPool()
+
+        """
+        Private member variables
+            _conn    = Connection to the coordinator
+            _lock    = Lock guarding sends on _conn from relay threads
+            _workers = Worker process of every build running here
+                       { "<commit_id>" : <Process> }
+            _pipes   = Our end of the message pipe of every worker
+                       { "<commit_id>" : <Connection> }
+        """
+        self._conn = None
+        self._lock = Lock()
+        self._workers = {}
+        self._pipes = {}
+
+        # Cleans up after builds this host was running when the agent
+        # last stopped
+        self.rugby_janitor = RugbyJanitor(rugby_root, RugbyDatabase(rugby_root),
+                                          lambda: set(self._workers), rugby_pool=self.rugby_pool)
+
+    def serve_forever(self):
+        """
+        Method connects to the coordinator and runs the builds it hands
+        out until the coordinator goes away
+        """
+        self.rugby_janitor.recover()
+        self.rugby_janitor.start()
+        if self.rugby_pool != None:
+            self.rugby_pool.start()
+
+        self._conn = Client(self.coordinator_address, authkey=self.authkey)
+        self._send(('register', self.agent_id, self.max_builds, self.max_vms))
+        logger.debug('Agent {} registered with {}'.format(self.agent_id, self.coordinator_address))
+
+        while True:
+            try:
+                msg = self._conn.recv()
+            except (EOFError, IOError):
+                logger.debug('Coordinator went away')
+                break
+            if msg[0] == 'launch':
+                self._launch(msg[1], msg[2])
+            elif msg[0] == 'msg' and msg[1] in self._pipes:
+                # Passed on to the worker, IE to cancel it
+                try:
+                    self._pipes[msg[1]].send(msg[2])
+                except (EOFError, IOError):
+                    pass
+            elif msg[0] == 'terminate':
+                worker_process = self._workers.get(msg[1])
+                if worker_process != None:
+                    worker_process.terminate()
+            elif msg[0] == 'kill':
+                worker_process = self._workers.get(msg[1])
+                if worker_process != None:
+                    kill_process(worker_process.pid)
+
+    def _launch(self, build_info, rugby_config_text):
+        """
+        Helper function which starts a worker process for a build
+        """
+        commit_id = build_info['commit_id']
+        rugby_config = os.path.join(self.rugby_root, '{}.rugby.yml'.format(commit_id))
+        with open(rugby_config, 'w') as config_file:
+            config_file.write(rugby_config_text)
+
+        rw = RugbyWorker(commit_id, build_info['clone_url'], build_info['raw_url'],
+                         self.rugby_root, rugby_config, self.rugby_pool)
+        my_end, their_end = Pipe()
+        worker_process = Process(target=rw, args=(their_end,))
+        self._workers[commit_id] = worker_process
+        self._pipes[commit_id] = my_end
+        # Never fork while another thread is using the database
+        with process_lock():
+            worker_process.start()
+        # Only the worker should hold their_end open, so that our end
+        # sees EOF as soon as the worker process exits
+        their_end.close()
+
+        t = Thread(target=self._relay, args=(commit_id, worker_process, my_end, rugby_config))
+        t.daemon = True
+        t.start()
+
+    def _relay(self, commit_id, worker_process, msg_pipe, rugby_config):
+        """
+        Helper function run in its own thread for each build, which sends
+        everything the worker sends on to the coordinator, then tells it
+        the worker has exited
+        """
+        try:
+            while True:
+                self._send(('msg', commit_id, msg_pipe.recv()))
+        except (EOFError, IOError):
+            pass
+
+        worker_process.join()
+        self._workers.pop(commit_id, None)
+        self._pipes.pop(commit_id, None)
+        msg_pipe.close()
+        try:
+            os.remove(rugby_config)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._send(('exited', commit_id, worker_process.exitcode))
+
+    def _send(self, msg):
+        with self._lock:
+            try:
+                self._conn.send(msg)
+            except (EOFError, IOError):
+                pass
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG if config.DEBUG_MODE else logging.INFO)
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: {} <coordinator host>:<port> [max builds] [max VMs]\n'.format(sys.argv[0]))
+        sys.exit(1)
+    host, port = sys.argv[1].rsplit(':', 1)
+    max_builds = int(sys.argv[2]) if len(sys.argv) > 2 else config.AGENT_MAX_BUILDS
+    max_vms = int(sys.argv[3]) if len(sys.argv) > 3 else config.AGENT_MAX_VMS
+    RugbyAgent((host, int(port)), max_builds=max_builds, max_vms=max_vms).serve_forever()
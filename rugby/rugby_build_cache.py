@@ -0,0 +1,278 @@
+# internal
+from rugby_state import RugbyState, FINISHED_STATES, RESULT_STATES
+import config
+
+# stdlib
+from collections import OrderedDict
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# States as they are kept in the builds table
+FINISHED_STATE_NAMES = [str(finished_state) for finished_state in FINISHED_STATES]
+RESULT_STATE_NAMES = [str(result_state) for result_state in RESULT_STATES]
+
+class RugbyBuildCache:
+    """
+    Usage:
+        build_cache = RugbyBuildCache(rugby_db)
+        build_cache.insert_build(build_info)
+        build_cache.update_build(commit_id, str(RugbyState.SUCCESS))
+        build_cache.get_info(commit_id)
+        build_cache.get_branch_result('master')
+
+    Read through cache in front of the builds table of a RugbyDatabase.
+    Builds which are queued or running are always kept, and up to
+    config.BUILD_CACHE_SIZE finished ones, dropping the least recently
+    used. Pages of get_builds are kept for up to config.BUILD_QUERY_CACHE_SIZE
+    queries, and dropped whenever any build is added or changes state.
+
+    Every new build and state change has to go through insert_build and
+    update_build, which pass it on to the database. They also keep
+    counts of builds in each state, the pass rate of each author and
+    the latest result of each branch, so those are answered from memory.
+    Counts are over the builds table, which holds the newest state of
+    each commit, and only SUCCESS, ERROR and TIMEOUT count as results.
+    """
+
+    def __init__(self, rugby_db):
+        """
+        rugby_db = RugbyDatabase the builds are kept in
+        """
+        self.rugby_db = rugby_db
+
+        """
+        Private member variables
+            _lock       = Lock guarding everything below
+            _live       = Builds which aren't finished, by commit_id
+                          { "<commit_id>" : <row of builds table> }
+            _finished   = Finished builds, least recently used first
+            _queries    = Results of get_builds, least recently used first
+                          { (<limit>, <before>, <state>, <author_login>) : [<row>] }
+            _generation = Bumped whenever a build is added or changes
+                          state, so a database read which raced with
+                          that isn't kept
+            _states     = Number of builds in each state
+                          { "<RugbyState>" : 12 }
+            _authors    = Number of results and passes of each author
+                          { "<author_login>" : [<passed>, <results>] }
+            _branches   = Build with the newest result of each branch
+                          { "<branch>" : {"build_id" : 7, "commit_id" : "<commit_id>",
+                                          "branch" : "<branch>", "state" : "<RugbyState>"} }
+            _counts     = Number of reads answered from memory and from
+                          the database
+        """
+        self._lock = Lock()
+        self._live = {}
+        self._finished = OrderedDict()
+        self._queries = OrderedDict()
+        self._generation = 0
+        self._counts = {'hits': 0, 'misses': 0}
+
+        self._states = dict((row['state'], row['count']) for row in rugby_db.get_state_counts())
+        self._authors = dict((row['author_login'], [row['passed'], row['results']])
+                             for row in rugby_db.get_author_results())
+        self._branches = dict((row['branch'], RugbyBuildCache._branch_result(row))
+                              for row in rugby_db.get_branch_results())
+        for row in rugby_db.get_live_builds():
+            self._live[row['commit_id']] = row
+
+    def insert_build(self, build_info):
+        """
+        Method records a new build in the database and the cache. A build
+        of a commit which was built before keeps its row, which is
+        cached as it is until its state is updated
+        """
+        inserted = self.rugby_db.insert_build(build_info)
+        # The existing row of a commit may still have a state update
+        # waiting to be written
+        self.rugby_db.flush()
+        row = self.rugby_db.get_info(build_info.commit_id)
+        with self._lock:
+            self._generation += 1
+            self._queries.clear()
+            if inserted:
+                self._count(row, 1)
+            self._remember(row)
+
+    def update_build(self, commit_id, state):
+        """
+        Method moves a build to state in the database and the cache. It
+        is passed to start_runner as the first callback of every build
+        """
+        with self._lock:
+            row = self._live.get(commit_id) or self._finished.get(commit_id)
+        if row == None:
+            # A finished build which fell out of the cache, being built again
+            self.rugby_db.flush()
+            try:
+                row = self.rugby_db.get_info(commit_id)
+            except IndexError:
+                logger.debug('No build of {} to update'.format(commit_id))
+                return
+
+        recount = None
+        with self._lock:
+            # Queued before the cache changes, so a read which missed
+            # the change can never miss the write
+            self.rugby_db.update_build(commit_id, state)
+            self._generation += 1
+            self._queries.clear()
+            row = self._live.get(commit_id) or self._finished.get(commit_id) or row
+            if row['state'] != state:
+                self._count(row, -1)
+                if row['branch'] != None and self._branches.get(row['branch'], {}).get('build_id') == row['build_id']:
+                    recount = row['branch']
+                    del self._branches[recount]
+                row = dict(row, state=state)
+                if state in FINISHED_STATE_NAMES:
+                    # Matches datetime('now') as written by the database
+                    row['finish_timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+                self._count(row, 1)
+            self._remember(row)
+
+        if recount != None:
+            # The branch's newest result is being built again, so fall
+            # back to the one before it until this build finishes
+            self.rugby_db.flush()
+            results = self.rugby_db.get_branch_results(recount)
+            with self._lock:
+                for result in results:
+                    self._set_branch_result(RugbyBuildCache._branch_result(result))
+
+    def get_info(self, commit_id):
+        """
+        Method returns the row of a build, raising IndexError if there
+        is no build of commit_id
+        """
+        with self._lock:
+            row = self._live.get(commit_id)
+            if row == None and commit_id in self._finished:
+                row = self._finished.pop(commit_id)
+                self._finished[commit_id] = row
+            if row != None:
+                self._counts['hits'] += 1
+                return dict(row)
+            self._counts['misses'] += 1
+            generation = self._generation
+
+        self.rugby_db.flush()
+        row = self.rugby_db.get_info(commit_id)
+        with self._lock:
+            if generation == self._generation:
+                self._remember(row)
+        return dict(row)
+
+    def get_builds(self, limit=None, before=None, state=None, author_login=None):
+        """
+        Method returns builds newest first, see RugbyDatabase.get_builds
+        """
+        key = (limit, before, str(state) if state != None else None, author_login)
+        with self._lock:
+            rows = self._queries.pop(key, None)
+            if rows != None:
+                self._queries[key] = rows
+                self._counts['hits'] += 1
+                return [dict(row) for row in rows]
+            self._counts['misses'] += 1
+            generation = self._generation
+
+        self.rugby_db.flush()
+        rows = self.rugby_db.get_builds(limit, before, state, author_login)
+        with self._lock:
+            if generation == self._generation:
+                self._queries[key] = rows
+                while len(self._queries) > config.BUILD_QUERY_CACHE_SIZE:
+                    self._queries.popitem(last=False)
+        return [dict(row) for row in rows]
+
+    def get_branch_result(self, branch):
+        """
+        Method returns the build with the newest result on branch, or
+        None if none of its builds has finished with one
+            {"build_id" : 7, "commit_id" : "<commit_id>", "branch" : "<branch>",
+             "state" : "<RugbyState>"}
+        """
+        with self._lock:
+            result = self._branches.get(branch)
+            return dict(result) if result != None else None
+
+    def get_summary(self):
+        """
+        Method returns the number of builds in each state, the pass rate
+        of each author, and the newest result of each branch
+            { "states" : {"RugbyState.SUCCESS" : 120, ...},
+              "authors" : {"<author_login>" : {"passed" : 9, "results" : 10, "pass_rate" : 0.9}},
+              "branches" : {"<branch>" : <get_branch_result(branch)>} }
+        """
+        with self._lock:
+            return {
+                'states': dict((state, count) for state, count in self._states.iteritems() if count),
+                'authors': dict((author_login, {'passed': passed, 'results': results,
+                                                'pass_rate': float(passed) / results})
+                                for author_login, (passed, results) in self._authors.iteritems() if results),
+                'branches': dict((branch, dict(result)) for branch, result in self._branches.iteritems())
+            }
+
+    def get_stats(self):
+        """
+        Method returns how many builds and queries are cached, and how
+        many reads were answered from memory and from the database
+        """
+        with self._lock:
+            stats = {'live': len(self._live), 'finished': len(self._finished),
+                     'queries': len(self._queries)}
+            stats.update(self._counts)
+            return stats
+
+    def _remember(self, row):
+        """
+        Helper function which caches a build's row as the most recently
+        used, dropping the least recently used finished builds if there
+        are too many. Called with _lock held
+        """
+        commit_id = row['commit_id']
+        self._live.pop(commit_id, None)
+        self._finished.pop(commit_id, None)
+        if row['state'] in FINISHED_STATE_NAMES:
+            self._finished[commit_id] = row
+            while len(self._finished) > config.BUILD_CACHE_SIZE:
+                self._finished.popitem(last=False)
+        else:
+            self._live[commit_id] = row
+
+    def _count(self, row, delta):
+        """
+        Helper function which adds delta to the counts a build's row is
+        part of, and makes it its branch's newest result if it is newer.
+        Called with _lock held
+        """
+        state = row['state']
+        self._states[state] = self._states.get(state, 0) + delta
+        if state not in RESULT_STATE_NAMES:
+            return
+        author = self._authors.setdefault(row['author_login'], [0, 0])
+        if state == str(RugbyState.SUCCESS):
+            author[0] += delta
+        author[1] += delta
+        if delta > 0 and row['branch'] != None:
+            self._set_branch_result(RugbyBuildCache._branch_result(row))
+
+    def _set_branch_result(self, result):
+        """
+        Helper function which makes result its branch's newest result
+        unless it already has a newer one. Called with _lock held
+        """
+        current = self._branches.get(result['branch'])
+        if current == None or current['build_id'] <= result['build_id']:
+            self._branches[result['branch']] = result
+
+    @staticmethod
+    def _branch_result(row):
+        """
+        This method returns the part of a build's row kept as the
+        result of its branch
+        """
+        return dict((key, row[key]) for key in ['build_id', 'commit_id', 'branch', 'state'])
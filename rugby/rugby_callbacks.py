@@ -0,0 +1,280 @@
+# internal
+from rugby_metrics import summarize
+import config
+
+# stdlib
+from collections import deque
+from threading import Thread, Condition, current_thread
+import logging
+import time
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+class CallbackLane:
+    """
+    Struct to hold the states waiting to be passed to one callback for
+    one build. They are passed on one at a time, in the order they came in
+    """
+    def __init__(self, callback, commit_id):
+        self.callback = callback
+        self.commit_id = commit_id
+        # [state, submitted_at, attempts] of each state, oldest first
+        self.pending = deque()
+        # 'idle', 'ready' to be picked up, 'running' on a thread, or
+        # 'waiting' to be retried at retry_at
+        self.status = 'idle'
+        self.retry_at = None
+
+class RugbyCallbackExecutor:
+    """
+    Usage:
+        executor = RugbyCallbackExecutor()
+        executor.submit([rugby_db.update_build, notify], commit_id, str(RugbyState.QUEUED))
+        executor.get_stats()
+
+    Runs the callbacks of builds on a fixed pool of threads. Each callback
+    is given a build's states in the order they were submitted, one at a
+    time, while other callbacks and other builds carry on. If a callback
+    falls behind, the states it missed are skipped and it is only given the
+    newest one. No callback runs on more than config.CALLBACK_THREADS_PER_CALLBACK
+    threads, so a slow one, IE posting a GitHub status, can't hold up the rest.
+
+    A callback which raises is retried with the same state, or a newer one
+    if it came in meanwhile, up to config.CALLBACK_RETRIES times, waiting
+    config.CALLBACK_BACKOFF seconds before the first retry and twice as
+    long before each one after. A callback which runs for longer than
+    config.CALLBACK_TIMEOUT is left to finish on its own, and its thread is
+    replaced. Its later states are passed on without waiting for it.
+    """
+
+    def __init__(self, threads=config.CALLBACK_THREADS,
+                 threads_per_callback=config.CALLBACK_THREADS_PER_CALLBACK,
+                 timeout=config.CALLBACK_TIMEOUT, retries=config.CALLBACK_RETRIES):
+        """
+        threads              = Number of threads callbacks are run on
+        threads_per_callback = Max number of threads running the same
+                               callback at once
+        timeout              = Seconds a callback may run before it is
+                               given up on, None for no limit
+        retries              = Max number of times a failed callback is
+                               run again
+        """
+        self.threads = threads
+        self.threads_per_callback = threads_per_callback
+        self.timeout = timeout
+        self.retries = retries
+
+        """
+        Private member variables
+            _lock      = Condition guarding everything below, which idle
+                         threads wait on for a lane to be ready
+            _lanes     = CallbackLane of each callback and build with states
+                         pending or running
+                         { (<callback>, "<commit_id>") : <CallbackLane> }
+            _ready     = Lanes with states pending, in the order they became
+                         ready
+            _waiting   = Lanes waiting to retry a failed callback
+            _running   = [lane, started_at, abandoned] of each thread
+                         running a callback
+                         { <Thread> : [<CallbackLane>, <epoch>, False] }
+            _busy      = Number of threads running each callback
+            _counts    = Number of states submitted, delivered, coalesced
+                         into a newer one, retried, failed and timed out
+            _lags      = Seconds recent states waited before their callback
+                         started
+            _durations = Seconds recent callbacks ran for
+        """
+        self._lock = Condition()
+        self._lanes = {}
+        self._ready = deque()
+        self._waiting = []
+        self._running = {}
+        self._busy = {}
+        self._counts = dict((name, 0) for name in
+                            ['submitted', 'delivered', 'coalesced', 'retried', 'failed', 'timed_out'])
+        self._lags = deque(maxlen=config.CALLBACK_STATS_WINDOW)
+        self._durations = deque(maxlen=config.CALLBACK_STATS_WINDOW)
+
+        for _ in range(threads):
+            self._start_thread()
+        monitor = Thread(target=self._monitor)
+        monitor.daemon = True
+        monitor.start()
+
+    def submit(self, callbacks, commit_id, state):
+        """
+        Method queues state to be passed to each callback, as
+        callback(commit_id, state)
+        """
+        now = time.time()
+        with self._lock:
+            for callback in callbacks:
+                key = (callback, commit_id)
+                lane = self._lanes.get(key)
+                if lane == None:
+                    lane = self._lanes[key] = CallbackLane(callback, commit_id)
+                lane.pending.append([state, now, 0])
+                self._counts['submitted'] += 1
+                if lane.status == 'idle':
+                    self._make_ready(lane)
+
+    def get_stats(self):
+        """
+        Method returns how many states are waiting for their callbacks,
+        how many threads are busy, counts of what happened to submitted
+        states, and how long recent states waited and callbacks ran for
+
+            { "pending" : 3, "lanes" : 2, "oldest_pending" : 0.4,
+              "threads" : 8, "running" : 2,
+              "abandoned" : 0, "submitted" : 120, "delivered" : 110,
+              "coalesced" : 6, "retried" : 1, "failed" : 0, "timed_out" : 0,
+              "lag" : {"count" : 110, "p50" : 0.01, "p95" : 0.2, "max" : 1.5},
+              "duration" : {"count" : 110, "p50" : 0.02, ...} }
+        """
+        with self._lock:
+            now = time.time()
+            oldest = [lane.pending[0][1] for lane in self._lanes.itervalues() if lane.pending]
+            abandoned = len([running for running in self._running.itervalues() if running[2]])
+            stats = {
+                'pending': sum(len(lane.pending) for lane in self._lanes.itervalues()),
+                'lanes': len(self._lanes),
+                'oldest_pending': now - min(oldest) if oldest else 0,
+                'threads': self.threads,
+                'running': len(self._running) - abandoned,
+                'abandoned': abandoned,
+                'lag': summarize(list(self._lags)),
+                'duration': summarize(list(self._durations))
+            }
+            stats.update(self._counts)
+            return stats
+
+    def _start_thread(self):
+        """
+        Helper function which adds a thread to the pool
+        """
+        t = Thread(target=self._work)
+        t.daemon = True
+        t.start()
+
+    def _make_ready(self, lane):
+        """
+        Helper function which lets a thread pick up a lane. Called
+        with _lock held
+        """
+        lane.status = 'ready'
+        self._ready.append(lane)
+        self._lock.notify()
+
+    def _release(self, lane):
+        """
+        Helper function which is called with _lock held once a lane's
+        callback has returned, to pass on its next state if there is one
+        """
+        if lane.pending:
+            self._make_ready(lane)
+            return
+        lane.status = 'idle'
+        del self._lanes[(lane.callback, lane.commit_id)]
+
+    def _next_lane(self):
+        """
+        Helper function which takes the first ready lane whose callback
+        isn't already running on threads_per_callback threads off
+        _ready, or returns None. Called with _lock held
+        """
+        for lane in self._ready:
+            if self._busy.get(lane.callback, 0) < self.threads_per_callback:
+                self._ready.remove(lane)
+                return lane
+        return None
+
+    def _work(self):
+        """
+        Helper function run by each thread of the pool, which runs
+        callbacks with the next state of whichever lane is ready
+        """
+        me = current_thread()
+        while True:
+            with self._lock:
+                lane = self._next_lane()
+                while lane == None:
+                    self._lock.wait()
+                    lane = self._next_lane()
+
+                # Skip to the newest state if the callback has fallen
+                # behind. The wait is counted from the oldest one
+                state, submitted_at, attempts = lane.pending.popleft()
+                while lane.pending:
+                    state, _, attempts = lane.pending.popleft()
+                    self._counts['coalesced'] += 1
+
+                started_at = time.time()
+                lane.status = 'running'
+                self._busy[lane.callback] = self._busy.get(lane.callback, 0) + 1
+                self._running[me] = [lane, started_at, False]
+                self._lags.append(started_at - submitted_at)
+
+            failed = False
+            try:
+                lane.callback(lane.commit_id, state)
+            except Exception:
+                failed = True
+                logger.exception('Callback for {} with state {} failed'.format(lane.commit_id, state))
+
+            with self._lock:
+                _, _, abandoned = self._running.pop(me)
+                self._busy[lane.callback] -= 1
+                if self._busy[lane.callback] == 0:
+                    del self._busy[lane.callback]
+                # The callback may have been held back by this one
+                self._lock.notify()
+                if abandoned:
+                    # The lane moved on and another thread took this
+                    # one's place when it timed out
+                    return
+                self._durations.append(time.time() - started_at)
+
+                if not failed:
+                    self._counts['delivered'] += 1
+                elif attempts < self.retries:
+                    self._counts['retried'] += 1
+                    # A newer state is passed on instead if there is one
+                    if not lane.pending:
+                        lane.pending.appendleft([state, submitted_at, attempts + 1])
+                    lane.status = 'waiting'
+                    lane.retry_at = time.time() + min(config.CALLBACK_BACKOFF * 2 ** attempts,
+                                                      config.CALLBACK_MAX_BACKOFF)
+                    self._waiting.append(lane)
+                    continue
+                else:
+                    self._counts['failed'] += 1
+                    logger.warning('Giving up on callback for {} with state {} after {} retries'.format(
+                        lane.commit_id, state, attempts))
+                self._release(lane)
+
+    def _monitor(self):
+        """
+        Helper function run in its own thread, which passes lanes whose
+        retry is due back to the pool, and gives up on callbacks which
+        have run past the timeout
+        """
+        while True:
+            time.sleep(config.CALLBACK_MONITOR_INTERVAL)
+            with self._lock:
+                now = time.time()
+                for lane in [lane for lane in self._waiting if lane.retry_at <= now]:
+                    self._waiting.remove(lane)
+                    self._make_ready(lane)
+
+                if self.timeout == None:
+                    continue
+                for running in self._running.itervalues():
+                    lane, started_at, abandoned = running
+                    if abandoned or now - started_at < self.timeout:
+                        continue
+                    logger.warning('Callback for {} ran for longer than {}s, carrying on without it'.format(
+                        lane.commit_id, self.timeout))
+                    running[2] = True
+                    self._counts['timed_out'] += 1
+                    self._release(lane)
+                    self._start_thread()
@@ -0,0 +1,315 @@
+# internal
+from rugby_scheduler import RugbyScheduler
+import config
+
+# stdlib
+from multiprocessing.connection import Listener
+from multiprocessing import Pipe
+from threading import Thread, Lock
+from functools import partial
+import logging
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# Exception class that is thrown when the coordinator or an agent
+# can't be started
+class CoordinatorError(Exception):
+    pass
+
+class AgentInfo:
+    """
+    Struct to hold what the coordinator knows about a connected agent
+    """
+    def __init__(self, agent_id, conn, max_builds, max_vms):
+        self.agent_id = agent_id
+        # multiprocessing Connection to the agent
+        self.conn = conn
+        self.max_builds = max_builds
+        self.max_vms = max_vms
+        # Number of VMs used by each build running on the agent
+        #   { "<commit_id>" : <cost> }
+        self.running = {}
+        # Lock guarding sends on conn
+        self.send_lock = Lock()
+
+    def free_vms(self, running=None):
+        running = self.running if running == None else running
+        return self.max_vms - sum(running.itervalues())
+
+    def fits(self, cost, running=None):
+        """
+        Same rule as RugbyScheduler, a build bigger than max_vms
+        can still run on its own
+        """
+        running = self.running if running == None else running
+        if len(running) >= self.max_builds:
+            return False
+        return not running or sum(running.itervalues()) + cost <= self.max_vms
+
+class RemoteProcess:
+    """
+    Stands in for the multiprocessing.Process of a worker which is
+    running on an agent
+    """
+    def __init__(self, agent_id, terminate=None, kill=None):
+        self.agent_id = agent_id
+        self.pid = None
+        # Set once the agent reports the worker has exited
+        self.exitcode = None
+        # Functions which ask the agent to terminate the worker, or kill
+        # it even if it is wedged
+        self._terminate = terminate
+        self._kill = kill
+
+    def join(self):
+        # The agent reports the exit before the message pipe is closed
+        pass
+
+    def is_alive(self):
+        return self.exitcode == None
+
+    def terminate(self):
+        if self._terminate != None:
+            self._terminate()
+
+    def kill(self):
+        if self._kill != None:
+            self._kill()
+
+class RugbyCoordinator:
+    """
+    Usage:
+        coordinator = RugbyCoordinator(('0.0.0.0', 7100))
+        coordinator.start()
+        process, msg_pipe = coordinator.launch(build_info, '.rugby.yml')
+
+    Hands builds out to RugbyAgent processes on other hosts. Each agent
+    connects, registers how many builds and VMs it can run, and then runs
+    RugbyWorker jobs locally. A build goes to an agent which has room for
+    it, preferring the agent which last built the same repo since its
+    source and install caches are warm, then the one with the most free VMs.
+
+    launch() returns a RemoteProcess and the receiving end of a local
+    Pipe, which every message the build's worker sends is relayed to.
+    The pipe is closed when the worker exits or its agent disconnects,
+    so the build looks the same to Rugby as a local worker process.
+    on_change is called whenever capacity is added or freed up.
+    """
+
+    def __init__(self, address=config.COORDINATOR_ADDRESS, authkey=None, on_change=None):
+        """
+        address   = (host, port) to listen for agents on
+        authkey   = Shared secret agents must connect with,
+                    config.COORDINATOR_AUTHKEY by default. Raises
+                    CoordinatorError if there is none
+        on_change = Optional function called when capacity changes
+        """
+        self.address = address
+        self.authkey = authkey or config.COORDINATOR_AUTHKEY
+        if not self.authkey:
+            raise CoordinatorError('No coordinator authkey, set RUGBY_COORDINATOR_AUTHKEY')
+        self.on_change = on_change
+
+        """
+        Private member variables
+            _agents   = AgentInfo of every connected agent
+                        { "<agent_id>" : <AgentInfo> }
+            _builds   = Agent and relay pipe of every running build
+                        { "<commit_id>" : (<AgentInfo>, <RemoteProcess>, <Connection>) }
+            _affinity = Agent which last built each repo
+                        { "<clone_url>" : "<agent_id>" }
+            _lock     = Lock guarding all of the above
+            _listener = multiprocessing Listener agents connect to
+        """
+        self._agents = {}
+        self._builds = {}
+        self._affinity = {}
+        self._lock = Lock()
+        self._listener = None
+
+    def start(self):
+        """
+        Method starts listening for agents in the background
+        """
+        self._listener = Listener(self.address, authkey=self.authkey)
+        logger.debug('Coordinator listening on {}'.format(self._listener.address))
+        t = Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    def fits(self, queued_builds):
+        """
+        Method returns True if every QueuedBuild in queued_builds can be
+        started at once, placing each one the way launch() would
+        """
+        with self._lock:
+            running = dict((agent_id, dict(agent.running)) for agent_id, agent in self._agents.iteritems())
+            for index, queued_build in enumerate(queued_builds):
+                agent = self._choose(queued_build.build_info.clone_url, queued_build.cost, running)
+                if agent == None:
+                    return False
+                running[agent.agent_id][index] = queued_build.cost
+            return True
+
+    def launch(self, build_info, rugby_config):
+        """
+        Method starts a build on an agent, and returns a RemoteProcess and
+        the Connection its worker's messages are relayed to
+        """
+        cost = RugbyScheduler.cost(build_info.commit_id, rugby_config)
+        with open(rugby_config) as config_file:
+            rugby_config_text = config_file.read()
+
+        with self._lock:
+            running = dict((agent_id, agent.running) for agent_id, agent in self._agents.iteritems())
+            agent = self._choose(build_info.clone_url, cost, running)
+            if agent == None and self._agents:
+                # Raced with another launch, squeeze it onto the least busy agent
+                agent = max(self._agents.values(), key=lambda agent: agent.free_vms())
+            if agent == None:
+                raise RuntimeError('No agents connected')
+
+            my_end, their_end = Pipe()
+            process = RemoteProcess(agent.agent_id, partial(self._send, agent, ('terminate', build_info.commit_id)),
+                                    partial(self._send, agent, ('kill', build_info.commit_id)))
+            agent.running[build_info.commit_id] = cost
+            self._builds[build_info.commit_id] = (agent, process, their_end)
+            self._affinity[build_info.clone_url] = agent.agent_id
+
+        logger.debug('Starting {} on agent {}'.format(build_info.commit_id, agent.agent_id))
+        self._send(agent, ('launch', build_info.__dict__, rugby_config_text))
+        return process, my_end
+
+    def send(self, commit_id, obj):
+        """
+        Method sends obj to the worker of a build, down the same pipe
+        a local worker would receive it on
+        """
+        with self._lock:
+            build = self._builds.get(commit_id)
+            agent = build[0] if build != None else None
+        if agent != None:
+            self._send(agent, ('msg', commit_id, obj))
+
+    def get_stats(self):
+        """
+        Method returns the capacity and load of every connected agent
+            { "<agent_id>" : {"max_builds" : 4, "max_vms" : 8, "builds" : 1, "vms" : 2} }
+        """
+        with self._lock:
+            return dict((agent_id, {
+                'max_builds' : agent.max_builds,
+                'max_vms' : agent.max_vms,
+                'builds' : len(agent.running),
+                'vms' : sum(agent.running.itervalues())
+            }) for agent_id, agent in self._agents.iteritems())
+
+    def _choose(self, clone_url, cost, running):
+        """
+        Helper function which returns the AgentInfo a build should go to
+        given how many VMs each agent has running, or None if no agent has
+        room. Must be called holding _lock
+        """
+        candidates = [agent for agent_id, agent in sorted(self._agents.iteritems())
+                      if agent.fits(cost, running[agent_id])]
+        if not candidates:
+            return None
+        warm = self._affinity.get(clone_url)
+        for agent in candidates:
+            if agent.agent_id == warm:
+                return agent
+        return max(candidates, key=lambda agent: agent.free_vms(running[agent.agent_id]))
+
+    def _accept(self):
+        """
+        Helper function run in its own thread, which accepts agents
+        """
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                logger.exception('Failed to accept agent')
+                continue
+            t = Thread(target=self._serve_agent, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve_agent(self, conn):
+        """
+        Helper function run in its own thread for each agent. Registers
+        it, then relays messages from its workers until it disconnects
+        """
+        try:
+            msg_type, agent_id, max_builds, max_vms = conn.recv()
+        except Exception:
+            conn.close()
+            return
+        if msg_type != 'register':
+            conn.close()
+            return
+
+        agent = AgentInfo(agent_id, conn, max_builds, max_vms)
+        with self._lock:
+            self._agents[agent_id] = agent
+        logger.debug('Agent {} registered, {} builds {} VMs'.format(agent_id, max_builds, max_vms))
+        self._changed()
+
+        try:
+            while True:
+                msg = conn.recv()
+                if msg[0] == 'msg':
+                    self._relay(msg[1], msg[2])
+                elif msg[0] == 'exited':
+                    self._exited(msg[1], msg[2])
+        except (EOFError, IOError):
+            logger.debug('Agent {} disconnected'.format(agent_id))
+
+        # Every build still running on the agent is lost. The agent may
+        # have reconnected already, so only this connection's entry
+        # and builds go
+        with self._lock:
+            if self._agents.get(agent_id) is agent:
+                del self._agents[agent_id]
+            lost = [commit_id for commit_id, build in self._builds.iteritems() if build[0] is agent]
+        for commit_id in lost:
+            self._exited(commit_id, None)
+        conn.close()
+        self._changed()
+
+    def _relay(self, commit_id, obj):
+        """
+        Helper function which passes a message from a worker on to Rugby
+        """
+        build = self._builds.get(commit_id)
+        if build != None:
+            build[2].send(obj)
+
+    def _exited(self, commit_id, exitcode):
+        """
+        Helper function which frees up a build's room on its agent, and
+        closes its relay pipe so Rugby sees the worker has exited
+        """
+        with self._lock:
+            build = self._builds.pop(commit_id, None)
+            if build == None:
+                return
+            agent, process, their_end = build
+            agent.running.pop(commit_id, None)
+        process.exitcode = exitcode
+        their_end.close()
+        self._changed()
+
+    def _send(self, agent, msg):
+        """
+        Helper function which sends msg to an agent
+        """
+        try:
+            with agent.send_lock:
+                agent.conn.send(msg)
+        except (EOFError, IOError):
+            # Agent is going away, its reader thread fails its builds
+            pass
+
+    def _changed(self):
+        if self.on_change != None:
+            self.on_change()
@@ -1,12 +1,33 @@
-from rugby_state import RugbyState
+from rugby_state import RugbyState, FINISHED_STATES, RESULT_STATES
 import config
 
+from threading import Thread, Lock
+from Queue import Queue, Empty
 import sqlite3
 import logging
+import json
 import os
 
 logger = logging.getLogger(config.LOGGER_NAME)
 
+# pid and Lock of the process the lock returned by process_lock belongs to
+process_lock_owner = (None, None)
+
+def process_lock():
+    """
+    This function returns the lock held around every use of sqlite by
+    this process. SQLite keeps per process bookkeeping of the locks its
+    connections hold, which a forked child inherits as it was. Forking
+    while another thread is in the middle of a transaction leaves the
+    child's connections waiting on a lock nobody holds, so workers must
+    be forked while holding this lock
+    """
+    global process_lock_owner
+    pid, lock = process_lock_owner
+    if pid != os.getpid():
+        process_lock_owner = (os.getpid(), Lock())
+    return process_lock_owner[1]
+
 class RugbyDatabase:
     def __init__(self, rugby_root):
         """
@@ -20,6 +41,23 @@ class RugbyDatabase:
         state
         """
         self.db_path = os.path.join(rugby_root, 'rugby.db')
+
+        """
+        Private member variables
+            _db_connection = Connection shared by every thread of the
+                             process which opened it
+            _connection_pid = pid of the process _db_connection belongs to
+            _lock          = process_lock(), serializing use of
+                             _db_connection along with every other
+                             connection of the process
+            _writes        = Queue of (commit_id, state) updates waiting
+                             for the writer thread
+        """
+        self._db_connection = None
+        self._connection_pid = None
+        self._lock = None
+        self._writes = None
+
         self._execute("""CREATE TABLE IF NOT EXISTS builds(commit_id TEXT PRIMARY KEY,
                                                            commit_message TEXT,
                                                            commit_url TEXT,
@@ -29,54 +67,393 @@ class RugbyDatabase:
                                                            author_login TEXT,
                                                            author_email TEXT,
                                                            author_avatar_url TEXT,
-                                                           contributors_email TEXT)""")
-
-    def _execute(self, query):
-        def dict_factory(cursor, row):
-            d = {}
-            for idx, col in enumerate(cursor.description):
-                d[col[0]] = row[idx]
-            return d
-
-        connection = sqlite3.connect(self.db_path)
-        connection.row_factory = dict_factory
-        cursor = connection.cursor()
-        # Escape single quotes
-        try:
-            cursor.execute(query)
-            result = cursor.fetchall()
-            connection.commit()
-        except Exception:
-            logger.debug('Could not execute query')
-            logger.debug('COULD NOT EXECUTE QUERY:  %s' % query)
-            raise
-        connection.close()
+                                                           contributors_email TEXT,
+                                                           branch TEXT)""")
+        # Databases made before branches were recorded
+        if 'branch' not in [column['name'] for column in self._execute("PRAGMA table_info(builds)")]:
+            self._execute("ALTER TABLE builds ADD COLUMN branch TEXT")
+        self._execute("CREATE INDEX IF NOT EXISTS builds_state ON builds(state)")
+        self._execute("CREATE INDEX IF NOT EXISTS builds_finish_timestamp ON builds(finish_timestamp)")
+        self._execute("CREATE INDEX IF NOT EXISTS builds_author_login ON builds(author_login)")
+        self._execute("CREATE INDEX IF NOT EXISTS builds_branch ON builds(branch)")
+        # Builds waiting for RugbyScheduler to start them
+        self._execute("""CREATE TABLE IF NOT EXISTS queue(commit_id TEXT PRIMARY KEY,
+                                                          build_info TEXT,
+                                                          rugby_config TEXT,
+                                                          lane INTEGER,
+                                                          cost INTEGER,
+                                                          enqueued_at REAL,
+                                                          rugby_config_text TEXT)""")
+        # Databases made before queued builds kept a copy of their config
+        if 'rugby_config_text' not in [column['name'] for column in self._execute("PRAGMA table_info(queue)")]:
+            self._execute("ALTER TABLE queue ADD COLUMN rugby_config_text TEXT")
+        # Private subnets leased to builds by RugbyNetwork
+        self._execute("""CREATE TABLE IF NOT EXISTS leases(subnet INTEGER PRIMARY KEY,
+                                                           commit_id TEXT UNIQUE,
+                                                           leased_at TEXT)""")
+        # Hits and misses of RugbySourceCache for each repo
+        self._execute("""CREATE TABLE IF NOT EXISTS source_cache(clone_url TEXT PRIMARY KEY,
+                                                                 hits INTEGER,
+                                                                 misses INTEGER,
+                                                                 last_used TEXT)""")
+        # Whether each block of each build restored its install from cache
+        self._execute("""CREATE TABLE IF NOT EXISTS install_cache(commit_id TEXT,
+                                                                  block_name TEXT,
+                                                                  fingerprint TEXT,
+                                                                  hit INTEGER)""")
+        # How long each build spent in each RugbyState
+        self._execute("""CREATE TABLE IF NOT EXISTS build_phases(commit_id TEXT,
+                                                                 phase TEXT,
+                                                                 started_at REAL,
+                                                                 duration REAL)""")
+        self._execute("CREATE INDEX IF NOT EXISTS build_phases_commit_id ON build_phases(commit_id)")
+        # How long each command took on each block of each build
+        self._execute("""CREATE TABLE IF NOT EXISTS build_commands(commit_id TEXT,
+                                                                   block_name TEXT,
+                                                                   phase TEXT,
+                                                                   command TEXT,
+                                                                   started_at REAL,
+                                                                   duration REAL,
+                                                                   exit_status INTEGER,
+                                                                   cpu_seconds REAL,
+                                                                   mem_used_kb INTEGER)""")
+        self._execute("CREATE INDEX IF NOT EXISTS build_commands_commit_id ON build_commands(commit_id)")
+        # Last known duration of each test of each sharded block, used to balance shards
+        self._execute("""CREATE TABLE IF NOT EXISTS test_timings(clone_url TEXT,
+                                                                 block_name TEXT,
+                                                                 test TEXT,
+                                                                 duration REAL,
+                                                                 recorded_at REAL,
+                                                                 PRIMARY KEY(clone_url, block_name, test))""")
+        # Final state of builds by source tree and rugby config, for RugbyResultCache
+        self._execute("""CREATE TABLE IF NOT EXISTS build_results(cache_key TEXT PRIMARY KEY,
+                                                                  commit_id TEXT,
+                                                                  state TEXT,
+                                                                  recorded_at REAL)""")
+        # Peak memory and CPUs each block of each build used, to size its VMs from
+        self._execute("""CREATE TABLE IF NOT EXISTS block_usage(clone_url TEXT,
+                                                                block_name TEXT,
+                                                                commit_id TEXT,
+                                                                peak_mem_kb INTEGER,
+                                                                peak_cpus REAL,
+                                                                recorded_at REAL,
+                                                                PRIMARY KEY(clone_url, block_name, commit_id))""")
+
+    def _connection(self):
+        """
+        Helper function which returns this process's connection to the
+        database, opening it first if needed. Workers inherit this object
+        when they are forked, and an sqlite connection must never be used
+        from two processes, so each process opens its own
+        """
+        if self._connection_pid != os.getpid():
+            self._lock = process_lock()
+            with self._lock:
+                # Statements are prepared once per connection and reused
+                # from sqlite3's statement cache
+                connection = sqlite3.connect(self.db_path, timeout=config.DB_BUSY_TIMEOUT,
+                                             check_same_thread=False,
+                                             cached_statements=config.DB_CACHED_STATEMENTS)
+                connection.row_factory = sqlite3.Row
+                # WAL lets readers carry on while a worker is writing
+                connection.execute('PRAGMA journal_mode=WAL')
+            self._db_connection = connection
+            self._connection_pid = os.getpid()
+            self._writes = None
+        return self._db_connection
+
+    def _execute(self, query, params=()):
+        connection = self._connection()
+        with self._lock:
+            try:
+                cursor = connection.execute(query, params)
+                result = [dict(row) for row in cursor.fetchall()]
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                logger.debug('Could not execute query')
+                logger.debug('COULD NOT EXECUTE QUERY:  %s %s' % (query, params))
+                raise
         return result
-    
+
+    def _writer(self, writes):
+        """
+        Loop run by the writer thread. Waits for a state update, then
+        writes it along with every other update queued up behind it in
+        a single transaction
+        """
+        while True:
+            batch = [writes.get()]
+            while len(batch) < config.DB_WRITE_BATCH:
+                try:
+                    batch.append(writes.get_nowait())
+                except Empty:
+                    break
+            finished_states = [str(finished_state) for finished_state in FINISHED_STATES]
+            connection = self._connection()
+            with self._lock:
+                try:
+                    # Builds are stamped with when they finished
+                    connection.executemany("""UPDATE builds SET state = ?,
+                                                 finish_timestamp = CASE WHEN ? THEN datetime('now')
+                                                                         ELSE finish_timestamp END
+                                              WHERE commit_id = ?""",
+                                           [(state, state in finished_states, commit_id)
+                                            for commit_id, state in batch])
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    logger.exception('Could not write {} state updates'.format(len(batch)))
+            for _ in batch:
+                writes.task_done()
+
     def insert_build(self, build_info):
-        commit_message = build_info.commit_message.replace('\'', '\'\'')
         values = (build_info.commit_id,
                   build_info.commit_message,
                   build_info.commit_url,
-                  str(RugbyState.INITIALIZING),
+                  str(RugbyState.QUEUED),
                   build_info.commit_timestamp,
                   build_info.finish_timestamp,
                   build_info.author_login,
                   build_info.author_email,
                   build_info.author_avatar_url,
-                  build_info.contributors_email)
+                  build_info.contributors_email,
+                  build_info.branch)
         try:
-            self._execute("""INSERT INTO builds VALUES('%s', '%s', '%s', '%s', '%s', 
-                                                       '%s', '%s', '%s', '%s', '%s')""" % values)
+            self._execute("INSERT INTO builds VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", values)
         except sqlite3.IntegrityError:
             logger.debug('Could not record build, commit_id already exists')
+            return False
+        return True
 
     def update_build(self, commit_id, state):
-        self._execute("UPDATE builds SET state = '%s' WHERE commit_id = '%s'" % (state, commit_id))
+        """
+        State updates are queued and written in order by a single writer
+        thread, so a burst of them doesn't fight over the database lock
+        """
+        self._connection()
+        if self._writes == None:
+            self._writes = Queue()
+            writer = Thread(target=self._writer, args=(self._writes,))
+            writer.daemon = True
+            writer.start()
+        self._writes.put((commit_id, state))
+
+    def flush(self):
+        """
+        Method blocks until every queued state update has been written
+        """
+        if self._writes != None and self._connection_pid == os.getpid():
+            self._writes.join()
 
-    def get_builds(self):
-        return self._execute("SELECT * FROM builds")
+    def get_builds(self, limit=None, before=None, state=None, author_login=None):
+        """
+        Method returns builds, newest first. Each build has a build_id,
+        pass the last build_id of a page as before to get the next page.
+        Builds can be filtered by state and author_login.
+        """
+        query = "SELECT rowid AS build_id, * FROM builds"
+        conditions = []
+        params = []
+        if before != None:
+            conditions.append("rowid < ?")
+            params.append(before)
+        if state != None:
+            conditions.append("state = ?")
+            params.append(str(state))
+        if author_login != None:
+            conditions.append("author_login = ?")
+            params.append(author_login)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY rowid DESC"
+        if limit != None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self._execute(query, params)
     
     def get_info(self, commit_id):
-        return self._execute("SELECT * FROM builds WHERE commit_id = '%s'" % (commit_id))[0]
- 
+        return self._execute("SELECT rowid AS build_id, * FROM builds WHERE commit_id = ?", (commit_id,))[0]
+
+    def get_live_builds(self):
+        """
+        Method returns every build which isn't finished, including
+        queued ones
+        """
+        finished_states = [str(finished_state) for finished_state in FINISHED_STATES]
+        return self._execute("SELECT rowid AS build_id, * FROM builds WHERE state NOT IN ({})".format(
+                                 ', '.join('?' * len(finished_states))), finished_states)
+
+    def get_state_counts(self):
+        return self._execute("SELECT state, COUNT(*) AS count FROM builds GROUP BY state")
+
+    def get_author_results(self):
+        """
+        Method returns how many builds of each author finished with a
+        result, and how many of those passed
+        """
+        result_states = [str(result_state) for result_state in RESULT_STATES]
+        return self._execute("""SELECT author_login, SUM(state = ?) AS passed, COUNT(*) AS results FROM builds
+                                WHERE state IN ({}) GROUP BY author_login""".format(
+                                    ', '.join('?' * len(result_states))),
+                             [str(RugbyState.SUCCESS)] + result_states)
+
+    def get_branch_results(self, branch=None):
+        """
+        Method returns the newest build with a result of each branch,
+        or of only one branch
+        """
+        result_states = [str(result_state) for result_state in RESULT_STATES]
+        query = "SELECT MAX(rowid) FROM builds WHERE state IN ({})".format(', '.join('?' * len(result_states)))
+        params = list(result_states)
+        if branch == None:
+            query += " AND branch IS NOT NULL"
+        else:
+            query += " AND branch = ?"
+            params.append(branch)
+        return self._execute("""SELECT rowid AS build_id, commit_id, branch, state FROM builds
+                                WHERE rowid IN ({} GROUP BY branch)""".format(query), params)
+
+    def get_unfinished_builds(self):
+        """
+        Method returns the commit_id and state of every build which is
+        neither finished nor waiting in the queue
+        """
+        finished_states = [str(finished_state) for finished_state in FINISHED_STATES]
+        return self._execute("""SELECT commit_id, state FROM builds
+                                WHERE state NOT IN ({}) AND commit_id NOT IN (SELECT commit_id FROM queue)""".format(
+                                    ', '.join('?' * len(finished_states))), finished_states)
+
+    def enqueue_build(self, queued_build):
+        values = (queued_build.build_info.commit_id,
+                  json.dumps(queued_build.build_info.__dict__),
+                  queued_build.rugby_config,
+                  queued_build.lane,
+                  queued_build.cost,
+                  queued_build.enqueued_at,
+                  queued_build.rugby_config_text)
+        self._execute("INSERT OR REPLACE INTO queue VALUES(?, ?, ?, ?, ?, ?, ?)", values)
+
+    def dequeue_build(self, commit_id):
+        self._execute("DELETE FROM queue WHERE commit_id = ?", (commit_id,))
+
+    def get_queue(self):
+        return self._execute("SELECT * FROM queue ORDER BY lane, enqueued_at")
+
+    def insert_lease(self, subnet, commit_id):
+        self._execute("INSERT INTO leases VALUES(?, ?, datetime('now'))", (subnet, commit_id))
+
+    def delete_lease(self, commit_id):
+        self._execute("DELETE FROM leases WHERE commit_id = ?", (commit_id,))
+
+    def get_lease(self, commit_id):
+        leases = self._execute("SELECT * FROM leases WHERE commit_id = ?", (commit_id,))
+        if not leases:
+            return None
+        return leases[0]
+
+    def get_leases(self):
+        return self._execute("SELECT * FROM leases")
+
+    def record_source_cache(self, clone_url, hit):
+        self._execute("INSERT OR IGNORE INTO source_cache VALUES(?, 0, 0, NULL)", (clone_url,))
+        self._execute("""UPDATE source_cache SET hits = hits + ?, misses = misses + ?,
+                                               last_used = datetime('now')
+                         WHERE clone_url = ?""", (int(hit), int(not hit), clone_url))
+
+    def get_source_cache_stats(self):
+        return self._execute("SELECT * FROM source_cache")
+
+    def record_install_cache(self, commit_id, block_name, fingerprint, hit):
+        self._execute("INSERT INTO install_cache VALUES(?, ?, ?, ?)",
+                      (commit_id, block_name, fingerprint, int(hit)))
+
+    def get_install_cache(self, commit_id):
+        return self._execute("SELECT * FROM install_cache WHERE commit_id = ?", (commit_id,))
+
+    def insert_phase(self, commit_id, phase, started_at, duration):
+        self._execute("INSERT INTO build_phases VALUES(?, ?, ?, ?)", (commit_id, phase, started_at, duration))
+
+    def insert_command(self, commit_id, block_name, phase, command, started_at, duration,
+                       exit_status, cpu_seconds, mem_used_kb):
+        self._execute("INSERT INTO build_commands VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (commit_id, block_name, phase, command, started_at, duration,
+                       exit_status, cpu_seconds, mem_used_kb))
+
+    def get_phases(self, commit_id):
+        return self._execute("SELECT * FROM build_phases WHERE commit_id = ? ORDER BY started_at", (commit_id,))
+
+    def get_commands(self, commit_id):
+        return self._execute("SELECT * FROM build_commands WHERE commit_id = ? ORDER BY started_at", (commit_id,))
+
+    def get_recent_phases(self, builds):
+        return self._execute("""SELECT * FROM build_phases WHERE commit_id IN
+                                    (SELECT commit_id FROM builds WHERE finish_timestamp IS NOT NULL
+                                     ORDER BY rowid DESC LIMIT ?)""", (builds,))
+
+    def get_recent_commands(self, builds, block_name=None):
+        query = """SELECT * FROM build_commands WHERE commit_id IN
+                       (SELECT commit_id FROM builds WHERE finish_timestamp IS NOT NULL
+                        ORDER BY rowid DESC LIMIT ?)"""
+        params = [builds]
+        if block_name != None:
+            query += " AND block_name = ?"
+            params.append(block_name)
+        return self._execute(query, params)
+
+    def record_test_timings(self, clone_url, block_name, timings, recorded_at):
+        connection = self._connection()
+        with self._lock:
+            try:
+                connection.executemany("INSERT OR REPLACE INTO test_timings VALUES(?, ?, ?, ?, ?)",
+                                       [(clone_url, block_name, test, duration, recorded_at)
+                                        for test, duration in timings.iteritems()])
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+
+    def get_test_timings(self, clone_url, block_name):
+        rows = self._execute("SELECT test, duration FROM test_timings WHERE clone_url = ? AND block_name = ?",
+                             (clone_url, block_name))
+        return dict((row['test'], row['duration']) for row in rows)
+
+    def insert_result(self, cache_key, commit_id, state, recorded_at):
+        self._execute("INSERT OR REPLACE INTO build_results VALUES(?, ?, ?, ?)",
+                      (cache_key, commit_id, state, recorded_at))
+
+    def get_result(self, cache_key):
+        results = self._execute("SELECT * FROM build_results WHERE cache_key = ?", (cache_key,))
+        if not results:
+            return None
+        return results[0]
+
+    def record_block_usage(self, clone_url, block_name, commit_id, peak_mem_kb, peak_cpus, recorded_at):
+        """
+        Method records the peak usage of a block in one build, keeping
+        only the config.RIGHTSIZE_WINDOW most recent builds of the block
+        """
+        connection = self._connection()
+        with self._lock:
+            try:
+                connection.execute("INSERT OR REPLACE INTO block_usage VALUES(?, ?, ?, ?, ?, ?)",
+                                   (clone_url, block_name, commit_id, peak_mem_kb, peak_cpus, recorded_at))
+                connection.execute("""DELETE FROM block_usage WHERE clone_url = ? AND block_name = ? AND rowid NOT IN
+                                          (SELECT rowid FROM block_usage WHERE clone_url = ? AND block_name = ?
+                                           ORDER BY recorded_at DESC LIMIT ?)""",
+                                   (clone_url, block_name, clone_url, block_name, config.RIGHTSIZE_WINDOW))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+
+    def get_block_usage(self, clone_url):
+        """
+        Method returns how many recent builds of each block of a repo
+        recorded their usage, and the most memory and CPUs any of them used
+            { "<block name>" : {"builds" : 12, "peak_mem_kb" : 812000, "peak_cpus" : 1.6} }
+        """
+        rows = self._execute("""SELECT block_name, COUNT(*) AS builds, MAX(peak_mem_kb) AS peak_mem_kb,
+                                       MAX(peak_cpus) AS peak_cpus
+                                FROM block_usage WHERE clone_url = ? GROUP BY block_name""", (clone_url,))
+        return dict((row.pop('block_name'), row) for row in rows)
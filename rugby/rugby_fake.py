@@ -0,0 +1,34 @@
+# internal
+import config
+
+# stdlib
+import logging
+import time
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+class FakeConnections:
+    """
+    Usage:
+        connections = FakeConnections(resolve)
+
+    Stands in for RugbyConnections for blocks of the fake provider. Every
+    command takes config.FAKE_COMMAND_SECONDS and succeeds without being
+    run anywhere.
+    """
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+
+    def run(self, block_name, remote_cmd, output, channels=None, input_fd=None, pty=True):
+        if input_fd != None:
+            while input_fd.read(65536):
+                pass
+        time.sleep(config.FAKE_COMMAND_SECONDS)
+        return 0
+
+    def get_timings(self):
+        return {}
+
+    def close(self):
+        pass
@@ -0,0 +1,113 @@
+# internal
+import config
+
+# stdlib
+from contextlib import contextmanager
+import hashlib
+import logging
+import errno
+import json
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+class RugbyInstallCache:
+    """
+    Usage:
+        install_cache = RugbyInstallCache()
+        fingerprint = RugbyInstallCache.fingerprint(vm, files_digest)
+        if install_cache.has(fingerprint):
+            restore from install_cache.path(fingerprint)
+        else:
+            with install_cache.store(fingerprint) as output:
+                write a .tar.gz of the block's cache_dirs to output
+
+    Keeps the directories a block's install commands filled in, as a
+    .tar.gz per fingerprint, so builds whose install would do exactly the
+    same thing can restore them instead. Archives are evicted least
+    recently used first once they take up more than config.INSTALL_CACHE_BUDGET
+    bytes. The cache lives on disk and is shared by every worker process.
+    """
+
+    def __init__(self, cache_dir=config.INSTALL_CACHE_DIR, budget=config.INSTALL_CACHE_BUDGET):
+        """
+        cache_dir = Directory where archives should be placed
+        budget    = Max number of bytes of archives to keep
+        """
+        self.cache_dir = cache_dir
+        self.budget = budget
+
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def fingerprint(vm, files_digest):
+        """
+        This method takes a block from a rugby config and a digest of the
+        repo files its install depends on, and returns the block's cache key
+        """
+        key = [vm['service']['group'],
+               vm['service']['type'],
+               vm.get('install', []),
+               vm['cache_dirs'],
+               files_digest]
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def path(self, fingerprint):
+        return os.path.join(self.cache_dir, '{}.tar.gz'.format(fingerprint))
+
+    def has(self, fingerprint):
+        """
+        Method returns True if there is an archive for fingerprint, and
+        marks it as recently used
+        """
+        try:
+            os.utime(self.path(fingerprint), None)
+        except OSError:
+            return False
+        return True
+
+    @contextmanager
+    def store(self, fingerprint):
+        """
+        Method yields a file to write fingerprint's archive to. The archive
+        is only added to the cache if the block exits without an exception
+        """
+        partial_path = '{}.{}.partial'.format(self.path(fingerprint), os.getpid())
+        try:
+            with open(partial_path, 'wb') as output:
+                yield output
+            os.rename(partial_path, self.path(fingerprint))
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        self._evict()
+
+    def _evict(self):
+        """
+        Helper function which deletes least recently used archives
+        until the cache fits in its budget
+        """
+        archives = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.tar.gz'):
+                continue
+            archive_path = os.path.join(self.cache_dir, name)
+            try:
+                archives.append((os.path.getmtime(archive_path), archive_path))
+            except OSError:
+                # Evicted by another worker
+                pass
+        archives.sort(reverse=True)
+        used = 0
+        for _, archive_path in archives:
+            try:
+                used += os.path.getsize(archive_path)
+                if used > self.budget:
+                    os.remove(archive_path)
+            except OSError:
+                # Evicted by another worker
+                pass
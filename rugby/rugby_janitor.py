@@ -0,0 +1,235 @@
+# internal
+from rugby_state import RugbyState
+from rugby_network import RugbyNetwork
+from rugby_provider import reap_build
+from rugby_log import format_line
+import config
+
+# stdlib
+from threading import Thread, Lock
+import logging
+import shutil
+import signal
+import errno
+import time
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# File in a build's root_dir holding the pid and start time of its worker
+WORKER_PID_FILE = 'worker.pid'
+
+def process_start_time(pid):
+    """
+    This function returns when a process started in clock ticks since
+    boot, which together with its pid identifies it even if the pid is
+    reused, or None if it isn't running or /proc isn't there
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return None
+    # Command name is in brackets and can hold spaces
+    return stat.rsplit(')', 1)[1].split()[19]
+
+def kill_process(pid):
+    """
+    This function kills a process with SIGKILL, which unlike terminate()
+    also works if it is stopped or has wedged itself, and does nothing
+    if it has already exited
+    """
+    try:
+        os.kill(int(pid), signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+class RugbyJanitor:
+    """
+    Usage:
+        janitor = RugbyJanitor(rugby_root, rugby_db, lambda: set(Rugby.workers))
+        janitor.recover()
+        janitor.start(expire)
+
+    Cleans up after builds whose worker died without doing it itself, IE
+    because the rugby process was killed. Every directory under rugby_root
+    belongs to a build, so one whose build isn't live has its worker killed
+    if it outlived rugby, its machines destroyed by each provider, and is
+    removed. Network leases and pool VMs held by builds which aren't live
+    are handed back.
+
+    A worker which outlived rugby can't be attached to again since its
+    message pipe is gone, so its build is always torn down.
+
+    recover() is run once at startup, before any build is started. It also
+    moves builds the database still has as running to ERROR. start() runs
+    a pass every config.JANITOR_INTERVAL seconds, calling expire first so
+    builds over their max lifetime can be killed. They are cleaned up by
+    a later pass, once their worker has exited.
+    """
+
+    def __init__(self, rugby_root, rugby_db, get_live, rugby_log_store=None, rugby_pool=None):
+        """
+        rugby_root      = Directory builds are run in
+        rugby_db        = RugbyDatabase of rugby_root
+        get_live        = Function which returns the set of commit_ids
+                          of builds which are running, from before
+                          their worker is started
+        rugby_log_store = Optional RugbyLogStore to record why stuck
+                          builds were failed in their logs
+        rugby_pool      = Optional RugbyPool whose VMs should be reclaimed
+        """
+        self.rugby_root = rugby_root
+        self.rugby_db = rugby_db
+        self.get_live = get_live
+        self.rugby_log_store = rugby_log_store
+        self.rugby_pool = rugby_pool
+        self.network = RugbyNetwork(rugby_db)
+
+        """
+        Private member variables
+            _lock   = Lock so only one pass runs at a time
+            _thread = Thread running periodic passes
+        """
+        self._lock = Lock()
+        self._thread = None
+
+    def recover(self):
+        """
+        Method fails builds left running by the last rugby process,
+        then reaps everything they left behind. Returns the commit_ids
+        of the builds which were failed
+        """
+        failed = self.fail_stuck_builds()
+        self.reap(restarted=True)
+        return failed
+
+    def start(self, expire=None):
+        """
+        Method starts running a pass every config.JANITOR_INTERVAL
+        seconds in the background
+        """
+        if self._thread != None:
+            return
+        self._thread = Thread(target=self._run, args=(expire,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def fail_stuck_builds(self):
+        """
+        Method moves every build which is neither finished, queued nor
+        live to ERROR, with the reason at the end of its log
+        """
+        live = self.get_live()
+        failed = []
+        for build in self.rugby_db.get_unfinished_builds():
+            commit_id = build['commit_id']
+            if commit_id in live:
+                continue
+            reason = 'Build was interrupted in {} when rugby stopped, and was failed on restart'.format(build['state'])
+            logger.warning('{}: {}'.format(commit_id, reason))
+            self.rugby_db.update_build(commit_id, str(RugbyState.ERROR))
+            self._log_reason(commit_id, reason)
+            failed.append(commit_id)
+        self.rugby_db.flush()
+        return failed
+
+    def reap(self, restarted=False):
+        """
+        Method destroys the machines and removes the directories of builds
+        which aren't live, and hands back their network leases and pool
+        VMs, config.REAP_THREADS builds at a time. Returns the commit_ids
+        of the builds whose directories were removed
+        """
+        with self._lock:
+            # Look on disk before asking what is live, so a build started
+            # in between is never mistaken for an orphan. get_live has to
+            # count a build as live from before its worker can make its
+            # directory
+            build_dirs = [name for name in sorted(os.listdir(self.rugby_root))
+                          if os.path.isdir(os.path.join(self.rugby_root, name))]
+            leases = [lease['commit_id'] for lease in self.rugby_db.get_leases()]
+            live = self.get_live()
+
+            orphans = [commit_id for commit_id in build_dirs if commit_id not in live]
+            pending = list(orphans)
+            pending_lock = Lock()
+
+            def reap_next():
+                while True:
+                    with pending_lock:
+                        if not pending:
+                            return
+                        commit_id = pending.pop(0)
+                    self._reap_dir(commit_id)
+
+            threads = [Thread(target=reap_next) for _ in range(min(config.REAP_THREADS, len(orphans)))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for commit_id in leases:
+                if commit_id not in live:
+                    logger.debug('Releasing network lease of {}'.format(commit_id))
+                    self.network.release(commit_id)
+
+            if self.rugby_pool != None:
+                self.rugby_pool.reclaim(live, restarted)
+            return orphans
+
+    def _reap_dir(self, commit_id):
+        """
+        Helper function which tears down and removes an orphaned build directory
+        """
+        root_dir = os.path.join(self.rugby_root, commit_id)
+        logger.debug('Reaping orphaned build directory {}'.format(root_dir))
+        RugbyJanitor._kill_worker(root_dir)
+        reap_build(root_dir)
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+    def _log_reason(self, commit_id, reason):
+        """
+        Helper function which appends reason to a build's log, and
+        compacts it since the build is finished. The build is failed
+        whether or not its log can be rewritten
+        """
+        if self.rugby_log_store == None or self.rugby_log_store.is_compacted(commit_id):
+            return
+        try:
+            with open(self.rugby_log_store.path(commit_id), 'a') as log_file:
+                log_file.write(format_line((time.time(), None, str(RugbyState.ERROR), reason)))
+            self.rugby_log_store.compact(commit_id)
+        except Exception:
+            logger.exception('Failed to record why {} was failed'.format(commit_id))
+
+    @staticmethod
+    def _kill_worker(root_dir):
+        """
+        This method kills the worker of root_dir if it is still running,
+        so it doesn't carry on using machines which are being destroyed
+        """
+        try:
+            with open(os.path.join(root_dir, WORKER_PID_FILE)) as pid_file:
+                pid, start_time = pid_file.read().split()
+        except (IOError, ValueError):
+            return
+        if process_start_time(pid) != start_time:
+            return
+        logger.debug('Killing orphaned worker {}'.format(pid))
+        kill_process(pid)
+
+    def _run(self, expire):
+        """
+        Helper function run in its own thread, which runs a pass
+        every config.JANITOR_INTERVAL seconds
+        """
+        while True:
+            time.sleep(config.JANITOR_INTERVAL)
+            try:
+                if expire != None:
+                    expire()
+                self.reap()
+            except Exception:
+                logger.exception('Janitor pass failed')
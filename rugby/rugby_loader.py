@@ -1,4 +1,5 @@
 # internal
+from rugby_state import BLOCK_STAGES
 import config
 
 # external 
@@ -7,6 +8,11 @@ import pyrx
 import jinja2
 
 # stdlib
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import math
+import copy
 import os
 
 # import contants from configuration as global variables
@@ -14,8 +20,61 @@ valid_groups = config.GROUPS
 valid_types  = config.TYPES
 valid_group_to_types = config.GROUP_TO_TYPES
 
+# Sets of the above, so validation doesn't scan lists
+valid_group_set = set(valid_groups)
+valid_type_set = set(valid_types)
+valid_pair_set = set((vm_group, vm_type) for vm_group, vm_types in valid_group_to_types.iteritems()
+                     for vm_type in vm_types)
+
 # Where vagrantfile template is located
 vagrant_template_file = config.VAGRANT_TEMPLATE_FILE
+
+# libyaml's loader is many times faster than the pure python one
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Templates are compiled once per process, and the compiled code is
+# kept on disk so new processes don't have to compile them either
+jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(vagrant_template_file)),
+                               bytecode_cache=jinja2.FileSystemBytecodeCache())
+
+# Validated blocks of each config by content hash, before addresses
+# and commit id are added, or None if the config failed validation
+config_cache = OrderedDict()
+cache_lock = Lock()
+
+def clear_caches():
+    """
+    This function empties the config cache
+    """
+    with cache_lock:
+        config_cache.clear()
+
+def cache_get(cache, key):
+    with cache_lock:
+        if key not in cache:
+            return False, None
+        # Mark as recently used
+        value = cache.pop(key)
+        cache[key] = value
+        return True, value
+
+def cache_put(cache, key, value, size):
+    with cache_lock:
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+def render_vagrantfile(dest_dir, vms, repo_location=""):
+    """
+    This function writes the Vagrantfile of vms into dest_dir, using
+    the template compiled by jinja_env. Each block needs a name,
+    service, ip and the commit_id naming the network it is put on
+    """
+    j2_template = jinja_env.get_template(os.path.basename(vagrant_template_file))
+    with open(os.path.join(dest_dir, 'Vagrantfile'), 'w') as output_vagrantfile:
+        output_vagrantfile.write(j2_template.render(vms=vms, site_yml_path=config.SITE_YML,
+                                                    repo_location=repo_location))
         
 # Exception class that is thrown when Validation fails
 class ValidationError(Exception):
@@ -35,6 +94,8 @@ arr_of_str_schema = {
     'contents': {'type': '//str'}
 }
 
+positive_int_schema = {'type': '//int', 'range': {'min': 1}}
+
 conf_vm_schema = {
     'type': '//rec',
     'required' : {
@@ -44,7 +105,19 @@ conf_vm_schema = {
     'optional': {
         'config': '//str',
         'install': arr_of_str_schema,
-        'script': arr_of_str_schema
+        'script': arr_of_str_schema,
+        'depends_on': arr_of_str_schema,
+        'barriers': arr_of_str_schema,
+        'cache_dirs': arr_of_str_schema,
+        'cache_files': arr_of_str_schema,
+        'parallelism': positive_int_schema,
+        'shard_tests': '//str',
+        'provider': '//str',
+        'command_timeout': positive_int_schema,
+        'phase_timeout': positive_int_schema,
+        'build_timeout': positive_int_schema,
+        'memory': positive_int_schema,
+        'cpus': positive_int_schema
     }
 }
 
@@ -80,8 +153,14 @@ class RugbyLoader:
         Kwargs:
             static_ips (list) optionally pass a list static_ips 
             to use for the provision vms
+            network_lease (NetworkLease) optionally pass the subnet
+            leased to this build, each block gets its own address
+            from it instead of a static ip
         """
         self.rugby_conf = rugby_conf
+        self.config_hash = None
+        # Usage of each block in recent builds, see use_usage
+        self.usage = {}
 
         if 'static_ips' in kwargs:
             static_ips_list = kwargs['static_ips']
@@ -89,38 +168,89 @@ class RugbyLoader:
         else:
             self.static_ips = config.VM_STATIC_IPS  
         
-        # Pull VM definitions from rugby_conf
-        vms = self._parse()
-
-        self.rugby_obj = vms
-        
-        # Validate VM definitions object 
-        if not self._valid_config():
+        # Pull VM definitions from rugby_conf, a config which has been
+        # seen before is only copied instead of parsed and validated
+        with open(self.rugby_conf, 'rb') as config_file:
+            content = config_file.read()
+        self.config_hash = hashlib.sha1(content).hexdigest()
+        hit, vms = cache_get(config_cache, self.config_hash)
+        if not hit:
+            vms = self._load(content)
+            cache_put(config_cache, self.config_hash, vms, config.LOADER_CACHE_SIZE)
+        if vms == None:
             raise ValidationError(rugby_conf + " failed validation")
+        vms = copy.deepcopy(vms)
+        self.rugby_obj = vms
 
         # Inject static ip and commit idfor each VM definition
         for vm in vms:
-            # Static ip injection
+            # Static ip injection, shards of a block take
+            # the addresses after the group's
             vm_group = vm['service']['group']
-            vm['ip'] = self.static_ips[vm_group]
+            vm['ip'] = RugbyLoader.offset_ip(self.static_ips[vm_group], vm.get('shard_index', 0))
             # Commit id injection
             vm['commit_id'] = commit_id
+
+        if 'network_lease' in kwargs:
+            self.use_network(kwargs['network_lease'])
+
+    def use_network(self, network_lease):
+        """
+        network_lease = NetworkLease whose addresses should be
+                        given to each block, in order
+        """
+        for index, vm in enumerate(self.rugby_obj):
+            vm['ip'] = network_lease.address(index)
+            vm['netmask'] = network_lease.netmask
     
+    def use_usage(self, usage):
+        """
+        usage = How much memory and how many CPUs each block used in
+                recent builds of the repo, as returned by
+                RugbyDatabase.get_block_usage, which VMs rendered
+                from now on are sized from
+        """
+        self.usage = usage
+
     def get_config(self):
         return self.rugby_obj
 
-    def render_vagrant(self, dest_dir, repo_location=""):
+    @staticmethod
+    def vm_size(vm, usage):
+        """
+        This method returns the memory in MB and number of CPUs to give a
+        block's VM, as { "memory" : 1024, "cpus" : 2 }. The block's own
+        'memory' and 'cpus' are used if it has them, otherwise the most its
+        block used in recent builds plus config.RIGHTSIZE_HEADROOM, once
+        there have been config.RIGHTSIZE_MIN_BUILDS of them. Either is
+        left out if the box's default should be used
+        """
+        size = {}
+        block_usage = usage.get(vm.get('shard_of', vm['name']))
+        if block_usage != None and block_usage['builds'] >= config.RIGHTSIZE_MIN_BUILDS:
+            headroom = 1 + config.RIGHTSIZE_HEADROOM
+            if block_usage['peak_mem_kb'] != None:
+                step = config.VM_MEMORY_STEP_MB
+                memory = int(math.ceil(block_usage['peak_mem_kb'] * headroom / 1024.0 / step)) * step
+                size['memory'] = min(max(memory, config.VM_MIN_MEMORY_MB), config.VM_MAX_MEMORY_MB)
+            if block_usage['peak_cpus'] != None:
+                cpus = int(math.ceil(block_usage['peak_cpus'] * headroom))
+                size['cpus'] = min(max(cpus, 1), config.VM_MAX_CPUS)
+        for name in ['memory', 'cpus']:
+            if name in vm:
+                size[name] = vm[name]
+        return size
+
+    def render_vagrant(self, dest_dir, repo_location="", vms=None):
         """
         dest_dir = path to directory where rendered
                    Vagrantfile should go
+        vms      = blocks to render, all of them by default
         """
-        # Where vagrantfile will be generated
-        generated_vagrantfile = os.path.join(dest_dir, 'Vagrantfile')
-        with open(vagrant_template_file) as template_file:
-            j2_template = jinja2.Template(template_file.read())
-            # Write resulting Vagrantfile to dest_dir
-            with open(generated_vagrantfile, 'w') as output_vagrantfile:
-                output_vagrantfile.write(j2_template.render(vms=self.rugby_obj, site_yml_path=config.SITE_YML, repo_location=repo_location))
+        if vms == None:
+            vms = self.rugby_obj
+        vms = [dict(vm, **RugbyLoader.vm_size(vm, self.usage)) for vm in vms]
+        render_vagrantfile(dest_dir, vms, repo_location)
     
     def _validate_groups_and_types(self):
         """
@@ -132,10 +262,9 @@ class RugbyLoader:
             vm_group = vm_service['group']
             vm_type = vm_service['type']
             
-            valid_group = vm_group in valid_groups
-            valid_type = vm_type in valid_types 
-            valid_pair = (vm_group in valid_group_to_types and 
-                        vm_type in valid_group_to_types[vm_group])
+            valid_group = vm_group in valid_group_set
+            valid_type = vm_type in valid_type_set
+            valid_pair = (vm_group, vm_type) in valid_pair_set
             
             if not valid_group or not valid_type or not valid_pair:
                 return False
@@ -146,16 +275,138 @@ class RugbyLoader:
         Helper function which validates self.rugby_obj based on the
         schema defined
         """
-        return schema.check(self.rugby_obj) and self._validate_groups_and_types()
-        
-    def _parse(self):
+        return (schema.check(self.rugby_obj) and self._validate_groups_and_types() and
+                self._validate_dependencies() and self._validate_barriers() and
+                self._validate_providers())
+
+    def _validate_providers(self):
+        """
+        Helper function which checks that every block's 'provider' is
+        one of config.PROVIDERS, and that its service has an image if
+        it runs in a container
+        """
+        for vm in self.rugby_obj:
+            provider = vm.get('provider', config.DEFAULT_PROVIDER)
+            if provider not in config.PROVIDERS:
+                return False
+            if provider == 'container' and vm['service']['type'] not in config.CONTAINER_IMAGES:
+                return False
+        return True
+
+    def _validate_dependencies(self):
+        """
+        Helper function which checks that block names are unique, and
+        that every block in a 'depends_on' exists and there are no cycles.
+        Returns True if dependencies are valid
+        """
+        names = [vm['name'] for vm in self.rugby_obj]
+        if len(set(names)) != len(names):
+            return False
+        for vm in self.rugby_obj:
+            for dependency in vm.get('depends_on', []):
+                if dependency not in names or dependency == vm['name']:
+                    return False
+        return RugbyLoader.dependency_order(self.rugby_obj) != None
+
+    def _validate_barriers(self):
         """
-        Helper function which parses self.rugby_conf, and returns
-        the dict version of it
+        Helper function which checks that every stage in a block's
+        'barriers' is one that comes after another, since there is
+        nothing to wait for before 'boot'
         """
-        parsed_config_obj = {}
-        with open(self.rugby_conf) as config_file:
-            parsed_config_obj = yaml.safe_load(config_file)
+        stages = set(name for name, _ in BLOCK_STAGES[1:])
+        for vm in self.rugby_obj:
+            if not set(vm.get('barriers', [])) <= stages:
+                return False
+        return True
+
+    @staticmethod
+    def expand_shards(rugby_obj):
+        """
+        This method takes a rugby config object and returns it with each
+        block that has a 'parallelism' of N replaced by N copies of it,
+        named '<name>-shard-<1..N>'. Each copy has 'shard_of' set to the
+        original name, 'shard_index' to 0..N-1 and 'shard_total' to N.
+        A 'depends_on' naming a sharded block waits for all its shards
+        """
+        shard_names = {}
+        for vm in rugby_obj:
+            total = vm.get('parallelism', 1)
+            if total > 1:
+                shard_names[vm['name']] = ['{}-shard-{}'.format(vm['name'], index + 1) for index in range(total)]
+
+        expanded = []
+        for vm in rugby_obj:
+            depends_on = []
+            for dependency in vm.get('depends_on', []):
+                depends_on.extend(shard_names.get(dependency, [dependency]))
+            if 'depends_on' in vm:
+                vm['depends_on'] = depends_on
+
+            if vm['name'] not in shard_names:
+                expanded.append(vm)
+                continue
+            for index, name in enumerate(shard_names[vm['name']]):
+                shard = copy.deepcopy(vm)
+                shard['name'] = name
+                shard['shard_of'] = vm['name']
+                shard['shard_index'] = index
+                shard['shard_total'] = len(shard_names[vm['name']])
+                expanded.append(shard)
+        return expanded
+
+    @staticmethod
+    def offset_ip(ip, offset):
+        """
+        This method returns the address offset addresses after ip
+        """
+        octets = ip.split('.')
+        octets[-1] = str(int(octets[-1]) + offset)
+        return '.'.join(octets)
+
+    @staticmethod
+    def dependency_order(rugby_obj):
+        """
+        This method takes a rugby config object and returns its blocks
+        ordered so that every block comes after the blocks in its
+        'depends_on'. Returns None if there is a dependency cycle
+        """
+        ordered = []
+        ordered_names = set()
+        remaining = list(rugby_obj)
+        while remaining:
+            ready = [vm for vm in remaining
+                     if all(dependency in ordered_names for dependency in vm.get('depends_on', []))]
+            if not ready:
+                return None
+            for vm in ready:
+                ordered.append(vm)
+                ordered_names.add(vm['name'])
+                remaining.remove(vm)
+        return ordered
         
-        return parsed_config_obj
+    def _load(self, content):
+        """
+        Helper function which parses and validates the contents of a
+        rugby config, and returns its blocks with shards expanded, or
+        None if it failed validation
+        """
+        self.rugby_obj = self._parse(content)
+
+        # Validate VM definitions object 
+        if not self._valid_config():
+            return None
+
+        # Blocks with parallelism become one block per shard
+        self.rugby_obj = RugbyLoader.expand_shards(self.rugby_obj)
+        if not self._validate_dependencies():
+            return None
+        return self.rugby_obj
+
+    def _parse(self, content):
+        """
+        Helper function which parses the contents of self.rugby_conf,
+        and returns the dict version of it
+        """
+        return yaml.load(content, Loader=yaml_loader)
 
@@ -0,0 +1,246 @@
+# internal
+from rugby_protocol import log_msg
+import config
+
+# stdlib
+from threading import Thread, Condition, Lock, Event
+from collections import deque
+import logging
+import time
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+"""
+Every line of build output is kept as a tuple
+
+    (<timestamp>, <block name or None>, <RugbyState>, <text>)
+
+where block name is None for output from the worker itself, IE vagrant.
+On disk each line is written tab separated, with '-' for no block.
+Lines of logs from before this format have no timestamp, block or phase.
+"""
+
+def format_line(line):
+    timestamp, block_name, phase, text = line
+    return '{:.3f}\t{}\t{}\t{}\n'.format(timestamp, block_name or '-', phase, text)
+
+def parse_line(raw_line):
+    """
+    This function returns the tuple of a line written by format_line.
+    Logs written before lines were tagged are plain text, so a line
+    which isn't in this format is returned as (0, None, None, <line>)
+    """
+    raw_line = raw_line.rstrip('\n')
+    fields = raw_line.split('\t', 3)
+    if len(fields) == 4:
+        timestamp, block_name, phase, text = fields
+        try:
+            return (float(timestamp), None if block_name == '-' else block_name, phase, text)
+        except ValueError:
+            pass
+    return (0, None, None, raw_line)
+
+def read_log_file(log_path, offset=0):
+    """
+    This function yields (offset, timestamp, block_name, phase, text)
+    for every line of a finished build's log, starting at offset
+    """
+    if not os.path.exists(log_path):
+        return
+    with open(log_path) as log_file:
+        for line_offset, raw_line in enumerate(log_file):
+            if line_offset >= offset:
+                yield (line_offset,) + parse_line(raw_line)
+
+class LogSender:
+    """
+    Worker side of the log pipeline. Lines are buffered and sent to the
+    parent in a log message once config.LOG_CHUNK_LINES have built up, or
+    config.LOG_FLUSH_INTERVAL seconds after the first one was added,
+    whichever comes first.
+    """
+    def __init__(self, commit_id, send):
+        """
+        commit_id = Unique identifier of the build
+        send      = Function which sends an object to the parent process
+        """
+        self.commit_id = commit_id
+        self.send = send
+        self._lines = []
+        self._lock = Lock()
+        self._pending = Event()
+        self._closed = False
+        self._thread = Thread(target=self._flusher)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, block_name, phase, text):
+        with self._lock:
+            self._lines.append((time.time(), block_name, str(phase), text))
+            full = len(self._lines) >= config.LOG_CHUNK_LINES
+        if full:
+            self.flush()
+        else:
+            self._pending.set()
+
+    def flush(self):
+        with self._lock:
+            lines = self._lines
+            self._lines = []
+            if lines:
+                self.send(log_msg(self.commit_id, lines))
+
+    def close(self):
+        self._closed = True
+        self._pending.set()
+        self._thread.join()
+        self.flush()
+
+    def _flusher(self):
+        while not self._closed:
+            self._pending.wait()
+            self._pending.clear()
+            if not self._closed:
+                time.sleep(config.LOG_FLUSH_INTERVAL)
+            self.flush()
+
+class LineWriter:
+    """
+    File like object which splits whatever is written to it into lines
+    and adds them to a LogSender, tagged with block_name and the phase
+    get_phase() returns when each line is completed
+    """
+    def __init__(self, log_sender, block_name, get_phase):
+        self.log_sender = log_sender
+        self.block_name = block_name
+        self.get_phase = get_phase
+        # Output which hasn't been terminated by a newline yet
+        self._partial = ''
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.log_sender.add(self.block_name, self.get_phase(), line.rstrip('\r'))
+
+    def close(self):
+        if self._partial:
+            self.write('\n')
+
+class RugbyLogStream:
+    """
+    Usage:
+        log_stream = RugbyLogStream(log_store, commit_id)
+        log_stream.append(lines)
+        ...
+        for offset, timestamp, block_name, phase, text in log_stream.stream(0):
+            ...
+        log_stream.close()
+
+    Parent side of the log pipeline for one build. Lines are appended to
+    the build's log file in batches of at least config.LOG_WRITE_BYTES,
+    and the most recent config.LOG_MEMORY_LINES are kept in memory so any
+    number of subscribers can follow the build without touching the disk.
+    Subscribers resuming from an offset that is no longer in memory are
+    served from the file. Once closed, the log file is compacted by
+    log_store in the background.
+    """
+
+    def __init__(self, log_store, commit_id):
+        """
+        log_store = RugbyLogStore the build's log file belongs to
+        commit_id = Unique identifier of the build
+        """
+        self.log_store = log_store
+        self.commit_id = commit_id
+        self.log_path = log_store.path(commit_id)
+
+        """
+        Private member variables
+            _recent  = Most recent lines
+            _first   = Offset of the first line in _recent
+            _total   = Number of lines appended so far
+            _buffer  = Formatted lines not written to disk yet
+            _closed  = True once the build has finished
+            _cond    = Condition subscribers wait on for new lines
+        """
+        self._recent = deque(maxlen=config.LOG_MEMORY_LINES)
+        self._first = 0
+        self._total = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._closed = False
+        self._cond = Condition()
+
+        # Offsets are line numbers in the log file, so start it afresh,
+        # keeping the log of the commit's last build if there is one
+        log_store.rotate(commit_id)
+        open(self.log_path, 'w').close()
+
+    def append(self, lines):
+        with self._cond:
+            for line in lines:
+                formatted = format_line(line)
+                self._buffer.append(formatted)
+                self._buffer_bytes += len(formatted)
+            self._recent.extend(lines)
+            self._total += len(lines)
+            self._first = self._total - len(self._recent)
+            if self._buffer_bytes >= config.LOG_WRITE_BYTES:
+                self._flush()
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._flush()
+            self._closed = True
+            self._cond.notify_all()
+
+        t = Thread(target=self.log_store.compact, args=(self.commit_id,))
+        t.daemon = True
+        t.start()
+
+    def stream(self, offset=0):
+        """
+        Method yields (offset, timestamp, block_name, phase, text) for
+        every line from offset onwards, waiting for new lines until the
+        build has finished
+        """
+        while True:
+            with self._cond:
+                while offset >= self._total and not self._closed:
+                    self._cond.wait()
+                if offset >= self._total:
+                    return
+                if offset >= self._first:
+                    recent = list(self._recent)[offset - self._first:]
+                    on_disk = False
+                else:
+                    # Make sure what we want to read is on disk
+                    self._flush()
+                    on_disk = True
+
+            if on_disk:
+                for line in self.log_store.read(self.commit_id, offset):
+                    if line[0] >= self._first:
+                        break
+                    yield line
+                    offset = line[0] + 1
+            else:
+                for line in recent:
+                    yield (offset,) + line
+                    offset += 1
+
+    def _flush(self):
+        """
+        Helper function which appends buffered lines to the log file in
+        one write. Must be called holding _cond
+        """
+        if self._buffer:
+            with open(self.log_path, 'a') as log_file:
+                log_file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_bytes = 0
@@ -0,0 +1,297 @@
+# internal
+from rugby_log import parse_line, read_log_file
+import config
+
+# stdlib
+from threading import Lock
+import logging
+import errno
+import json
+import time
+import zlib
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+INDEX_VERSION = 1
+
+class RugbyLogStore:
+    """
+    Usage:
+        log_store = RugbyLogStore()
+        log_store.compact(commit_id)
+        for offset, timestamp, block_name, phase, text in log_store.read(commit_id, phase=str(RugbyState.RUNNING_TESTS)):
+            ...
+        for line in log_store.tail(commit_id, 500):
+            ...
+
+    Owns the build logs in log_dir. While a build runs its log is a plain
+    file named by commit id. Once it has finished, compact() rewrites it as
+    <commit_id>.logz, independently zlib compressed chunks of
+    config.LOG_ARCHIVE_CHUNK_LINES lines, and <commit_id>.idx, a small JSON
+    index of where each chunk is and which lines, phases and blocks it
+    holds. Reading a range of lines, a phase, or a block only decompresses
+    the chunks it needs.
+
+    When a commit is built again, rotate() keeps the log of its last build
+    as <commit_id>.1, <commit_id>.2 and so on before the new one starts.
+
+    After every compaction, compacted logs older than config.LOG_RETENTION_DAYS
+    are deleted, then the oldest ones until all of them fit in
+    config.LOG_RETENTION_BYTES.
+    """
+
+    def __init__(self, log_dir=config.LOG_DIR):
+        """
+        log_dir = Directory where build logs are placed
+        """
+        self.log_dir = log_dir
+
+        """
+        Private member variables
+            _lock = Lock so only one thread enforces retention at a time
+        """
+        self._lock = Lock()
+
+    def path(self, commit_id):
+        """
+        Method returns the path of a build's plain log file
+        """
+        return os.path.join(self.log_dir, commit_id)
+
+    def is_compacted(self, commit_id):
+        return os.path.exists(self._index_path(commit_id))
+
+    def compact(self, commit_id):
+        """
+        Method compresses a finished build's plain log file, and then
+        enforces the retention policy. Does nothing if there is no
+        plain log file
+        """
+        log_path = self.path(commit_id)
+        if not os.path.exists(log_path):
+            return
+
+        data_path = self._data_path(commit_id)
+        index_path = self._index_path(commit_id)
+        index = {'version' : INDEX_VERSION, 'lines' : 0, 'chunks' : [], 'phases' : {}, 'blocks' : {}}
+
+        # Write to temporary names so a half written log is never read
+        with open(log_path) as log_file, open(data_path + '.partial', 'wb') as data_file:
+            chunk = []
+            for raw_line in log_file:
+                chunk.append(raw_line)
+                if len(chunk) == config.LOG_ARCHIVE_CHUNK_LINES:
+                    self._write_chunk(data_file, chunk, index)
+                    chunk = []
+            if chunk:
+                self._write_chunk(data_file, chunk, index)
+
+        with open(index_path + '.partial', 'w') as index_file:
+            json.dump(index, index_file)
+
+        os.rename(data_path + '.partial', data_path)
+        os.rename(index_path + '.partial', index_path)
+        os.remove(log_path)
+
+        self.evict()
+
+    def rotate(self, commit_id):
+        """
+        Method moves the log of a commit's last build out of the way so
+        a new build of the commit can start its own, compacting it first
+        if it is still a plain file. Returns the id the old log can be
+        read under, or None if there was no log
+        """
+        self.compact(commit_id)
+        if not self.is_compacted(commit_id):
+            return None
+
+        generation = 1
+        while os.path.exists(self._index_path('{}.{}'.format(commit_id, generation))):
+            generation += 1
+        old_id = '{}.{}'.format(commit_id, generation)
+        # Index first, so commit_id is never indexed without its data
+        os.rename(self._index_path(commit_id), self._index_path(old_id))
+        os.rename(self._data_path(commit_id), self._data_path(old_id))
+        logger.debug('Kept log of the last build of {} as {}'.format(commit_id, old_id))
+        return old_id
+
+    def read(self, commit_id, offset=0, limit=None, phase=None, block_name=None):
+        """
+        Method yields (offset, timestamp, block_name, phase, text) for up
+        to limit lines of a build's log from offset onwards, only
+        including lines of phase and block_name if they are given.
+        Works for both plain and compacted logs
+        """
+        if self.is_compacted(commit_id):
+            lines = self._read_compacted(commit_id, offset, phase, block_name)
+        else:
+            lines = read_log_file(self.path(commit_id), offset)
+
+        count = 0
+        for line in lines:
+            if limit != None and count >= limit:
+                return
+            if phase != None and line[3] != phase:
+                continue
+            if block_name != None and line[2] != block_name:
+                continue
+            count += 1
+            yield line
+
+    def tail(self, commit_id, lines):
+        """
+        Method yields the last lines lines of a build's log
+        """
+        total = self.count(commit_id)
+        return self.read(commit_id, max(0, total - lines))
+
+    def count(self, commit_id):
+        """
+        Method returns the number of lines in a build's log
+        """
+        index = self._index(commit_id)
+        if index != None:
+            return index['lines']
+        if not os.path.exists(self.path(commit_id)):
+            return 0
+        with open(self.path(commit_id)) as log_file:
+            return sum(1 for _ in log_file)
+
+    def sections(self, commit_id):
+        """
+        Method returns the first and last line offsets of each phase and
+        block in a compacted log, or None if the log isn't compacted
+            {"phases" : {"RugbyState.RUNNING_TESTS" : [first, last], ...},
+             "blocks" : {"<block name>" : [first, last]}}
+        """
+        index = self._index(commit_id)
+        if index == None:
+            return None
+        return {'phases' : index['phases'], 'blocks' : index['blocks']}
+
+    def get_stats(self):
+        """
+        Method returns the number of logs, and how much disk they take up
+            {"logs" : 120, "compacted" : 118, "bytes" : 52428800}
+        """
+        logs = self._logs()
+        return {
+            'logs' : len(logs),
+            'compacted' : len([log for log in logs.values() if log['compacted']]),
+            'bytes' : sum(log['bytes'] for log in logs.values())
+        }
+
+    def evict(self):
+        """
+        Method deletes compacted logs which are past their retention age,
+        then the oldest compacted logs until they fit in the size budget.
+        Plain logs belong to running builds and are never deleted
+        """
+        with self._lock:
+            logs = self._logs()
+            compacted = sorted((log for log in logs.values() if log['compacted']),
+                               key=lambda log: log['mtime'], reverse=True)
+
+            oldest = time.time() - config.LOG_RETENTION_DAYS * 24 * 60 * 60
+            used = 0
+            for log in compacted:
+                used += log['bytes']
+                if log['mtime'] < oldest or used > config.LOG_RETENTION_BYTES:
+                    logger.debug('Deleting log of {}'.format(log['commit_id']))
+                    for path in (self._index_path(log['commit_id']), self._data_path(log['commit_id'])):
+                        try:
+                            os.remove(path)
+                        except OSError as e:
+                            if e.errno != errno.ENOENT:
+                                raise
+
+    def _write_chunk(self, data_file, chunk, index):
+        """
+        Helper function which compresses chunk onto the end of data_file
+        and adds it to index
+        """
+        first_line = index['lines']
+        phases = set()
+        blocks = set()
+        for line_offset, raw_line in enumerate(chunk, first_line):
+            timestamp, block_name, phase, text = parse_line(raw_line)
+            blocks.add(block_name)
+            # Lines of old plain text logs have no phase
+            if phase != None:
+                phases.add(phase)
+                index['phases'].setdefault(phase, [line_offset, line_offset])[1] = line_offset
+            if block_name != None:
+                index['blocks'].setdefault(block_name, [line_offset, line_offset])[1] = line_offset
+
+        compressed = zlib.compress(''.join(chunk), config.LOG_COMPRESS_LEVEL)
+        index['chunks'].append({
+            'start' : data_file.tell(),
+            'size' : len(compressed),
+            'first_line' : first_line,
+            'lines' : len(chunk),
+            'phases' : sorted(phases),
+            'blocks' : sorted(blocks)
+        })
+        index['lines'] += len(chunk)
+        data_file.write(compressed)
+
+    def _read_compacted(self, commit_id, offset, phase, block_name):
+        """
+        Helper function which yields the lines from offset onwards of a
+        compacted log, skipping chunks without phase or block_name
+        """
+        index = self._index(commit_id)
+        with open(self._data_path(commit_id), 'rb') as data_file:
+            for chunk in index['chunks']:
+                if chunk['first_line'] + chunk['lines'] <= offset:
+                    continue
+                if phase != None and phase not in chunk['phases']:
+                    continue
+                if block_name != None and block_name not in chunk['blocks']:
+                    continue
+                data_file.seek(chunk['start'])
+                raw_lines = zlib.decompress(data_file.read(chunk['size'])).splitlines(True)
+                for line_offset, raw_line in enumerate(raw_lines, chunk['first_line']):
+                    if line_offset >= offset:
+                        yield (line_offset,) + parse_line(raw_line)
+
+    def _index(self, commit_id):
+        """
+        Helper function which returns a compacted log's index, or None
+        """
+        try:
+            with open(self._index_path(commit_id)) as index_file:
+                return json.load(index_file)
+        except IOError:
+            return None
+
+    def _logs(self):
+        """
+        Helper function which returns the size and age of every log
+            { "<commit_id>" : {"commit_id" : ..., "compacted" : True, "bytes" : 1024, "mtime" : ...} }
+        """
+        logs = {}
+        for name in os.listdir(self.log_dir):
+            if name.endswith('.partial'):
+                continue
+            commit_id, ext = os.path.splitext(name)
+            if ext not in ('.logz', '.idx'):
+                commit_id = name
+            try:
+                stat = os.stat(os.path.join(self.log_dir, name))
+            except OSError:
+                continue
+            log = logs.setdefault(commit_id, {'commit_id' : commit_id, 'compacted' : False, 'bytes' : 0, 'mtime' : 0})
+            log['bytes'] += stat.st_size
+            log['mtime'] = max(log['mtime'], stat.st_mtime)
+            if ext == '.idx':
+                log['compacted'] = True
+        return logs
+
+    def _data_path(self, commit_id):
+        return os.path.join(self.log_dir, '{}.logz'.format(commit_id))
+
+    def _index_path(self, commit_id):
+        return os.path.join(self.log_dir, '{}.idx'.format(commit_id))
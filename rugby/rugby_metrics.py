@@ -0,0 +1,84 @@
+# internal
+import config
+
+# stdlib
+import logging
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+def percentile(values, p):
+    """
+    This function returns the p'th percentile (0-100) of a list of
+    numbers using the nearest rank method, or None if it is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+def summarize(durations):
+    """
+    This function returns count, p50, p95 and max of a list of durations
+    """
+    return {
+        'count': len(durations),
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'max': max(durations) if durations else None
+    }
+
+class RugbyMetrics:
+    """
+    Usage:
+        metrics = RugbyMetrics(rugby_db)
+        metrics.record_phase(commit_id, str(RugbyState.SPAWNING_VMS), started_at, finished_at)
+        metrics.phase_stats()
+
+    Records how long every build spent in each RugbyState, and how long
+    every command took on each block, and summarizes them across builds
+    so slow phases and regressing commands can be found.
+    """
+
+    def __init__(self, rugby_db):
+        """
+        rugby_db = RugbyDatabase where metrics are recorded
+        """
+        self.rugby_db = rugby_db
+
+    def record_phase(self, commit_id, phase, started_at, finished_at):
+        self.rugby_db.insert_phase(commit_id, phase, started_at, finished_at - started_at)
+
+    def record_command(self, commit_id, block_name, phase, command, started_at, duration,
+                       exit_status, cpu_seconds=None, mem_used_kb=None):
+        self.rugby_db.insert_command(commit_id, block_name, phase, command, started_at, duration,
+                                     exit_status, cpu_seconds, mem_used_kb)
+
+    def get_phases(self, commit_id):
+        return self.rugby_db.get_phases(commit_id)
+
+    def get_commands(self, commit_id):
+        return self.rugby_db.get_commands(commit_id)
+
+    def phase_stats(self, builds=config.METRICS_WINDOW):
+        """
+        Method returns duration stats for each phase over the most
+        recent builds
+            { "<RugbyState>" : {"count" : 20, "p50" : 61.2, "p95" : 90.3, "max" : 95.0} }
+        """
+        durations = {}
+        for row in self.rugby_db.get_recent_phases(builds):
+            durations.setdefault(row['phase'], []).append(row['duration'])
+        return dict((phase, summarize(phase_durations)) for phase, phase_durations in durations.iteritems())
+
+    def command_stats(self, builds=config.METRICS_WINDOW, block_name=None):
+        """
+        Method returns duration stats for each command of each block over
+        the most recent builds, optionally only for one block
+            { ("<block name>", "<command>") : {"count" : 20, "p50" : 3.1, ...} }
+        """
+        durations = {}
+        for row in self.rugby_db.get_recent_commands(builds, block_name):
+            key = (row['block_name'], row['command'])
+            durations.setdefault(key, []).append(row['duration'])
+        return dict((key, summarize(command_durations)) for key, command_durations in durations.iteritems())
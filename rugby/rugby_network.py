@@ -0,0 +1,78 @@
+# internal
+import config
+
+# stdlib
+import sqlite3
+import logging
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# Exception class that is thrown when every subnet is leased
+class NetworkExhaustedError(Exception):
+    pass
+
+class NetworkLease:
+    """
+    Struct to hold the private subnet leased to a build. Block i of
+    the build's rugby config gets address(i)
+    """
+    def __init__(self, commit_id, subnet):
+        self.commit_id = commit_id
+        self.subnet = subnet
+        self.network = '{}{}.0/24'.format(config.NETWORK_PREFIX, subnet)
+        self.netmask = '255.255.255.0'
+
+    def address(self, index):
+        host = config.NETWORK_HOST_OFFSET + index
+        if host > 254:
+            raise NetworkExhaustedError('No address left for block {} in {}'.format(index, self.network))
+        return '{}{}.{}'.format(config.NETWORK_PREFIX, self.subnet, host)
+
+class RugbyNetwork:
+    """
+    Usage:
+        rugby_network = RugbyNetwork(rugby_db)
+        lease = rugby_network.lease(commit_id)
+        ...
+        rugby_network.release(commit_id)
+
+    Hands out a /24 from config.NETWORK_PREFIX to each build so builds
+    running side by side never share addresses. Leases are kept in the
+    rugby database so they survive restarts, and since every worker
+    process talks to the same database, two workers can never be given
+    the same subnet.
+    """
+
+    def __init__(self, rugby_db):
+        """
+        rugby_db = RugbyDatabase where leases are recorded
+        """
+        self.rugby_db = rugby_db
+
+    def lease(self, commit_id):
+        """
+        Method returns a NetworkLease for commit_id, reusing the lease the
+        build already holds if there is one. Raises NetworkExhaustedError
+        if every subnet is in use.
+        """
+        existing = self.rugby_db.get_lease(commit_id)
+        if existing != None:
+            return NetworkLease(commit_id, existing['subnet'])
+
+        while True:
+            used = set(row['subnet'] for row in self.rugby_db.get_leases())
+            free = [subnet for subnet in config.NETWORK_SUBNETS if subnet not in used]
+            if not free:
+                raise NetworkExhaustedError('All {} build subnets are leased'.format(len(used)))
+            try:
+                self.rugby_db.insert_lease(free[0], commit_id)
+            except sqlite3.IntegrityError:
+                # Another worker took it between our read and insert
+                continue
+            return NetworkLease(commit_id, free[0])
+
+    def release(self, commit_id):
+        """
+        Method gives the subnet held by commit_id back
+        """
+        self.rugby_db.delete_lease(commit_id)
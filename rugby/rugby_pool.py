@@ -0,0 +1,437 @@
+# internal
+from rugby_loader import render_vagrantfile
+import config
+
+# external
+from vagrant import Vagrant
+
+# stdlib
+from multiprocessing import Value, Lock, Event
+from threading import Thread
+import subprocess
+import logging
+import shutil
+import errno
+import json
+import os
+import re
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# Marker files which record what state a pool VM is in. Exactly one of
+# these exists in a pool VM's directory at any time, and moving between
+# states is done with os.rename so that only one process can ever win
+# a transition (IE check out a ready VM)
+BOOTING = 'booting'
+READY = 'ready'
+LEASED = 'leased'
+DIRTY = 'dirty'
+POOL_STATES = [BOOTING, READY, LEASED, DIRTY]
+
+# Name of the single machine defined in each pool VM's Vagrantfile
+POOL_MACHINE_NAME = 'pool'
+
+# Network adapter of the private network, the first is Vagrant's NAT
+POOL_PRIVATE_NIC = 2
+
+# Pool VM directories are named <group>-<type>-<slot>
+POOL_VM_DIR_PATTERN = re.compile(r'^.+-.+-(\d+)$')
+
+class PoolLease:
+    """
+    Struct to hold all the info a RugbyWorker needs about a pool VM
+    it has checked out
+    """
+    def __init__(self, vm_dir, vm_group, vm_type, ip):
+        self.vm_dir = vm_dir
+        self.group = vm_group
+        self.type = vm_type
+        self.ip = ip
+        self.machine_name = POOL_MACHINE_NAME
+
+class RugbyPool:
+    """
+    Usage:
+        rugby_pool = RugbyPool('/opt/VM_Pool')
+        rugby_pool.start()
+        leases = rugby_pool.checkout([('db', 'mongo'), ('lang', 'node')])
+        ...
+        rugby_pool.release(leases)
+
+    Keeps a pool of booted and provisioned VMs for each (group, type) pair
+    in config.GROUP_TO_TYPES. Each pool VM lives in its own directory under
+    pool_dir with its own Vagrantfile, and has a snapshot taken right after
+    provisioning. Released VMs are rolled back to that snapshot in the
+    background by the maintainer thread, which also keeps the number of
+    VMs for each pair between its configured min and max.
+
+    Idle pool VMs are each on a private network of their own. The VMs
+    checked out by a build are moved onto a network named after the
+    build, so they can reach each other but no other build. Rolling
+    back to the snapshot puts them back on their own network.
+
+    The pool is created in the main rugby process and inherited by each
+    worker process, so checkout and release work from either one. Hit and
+    miss counters are kept in shared memory for the same reason.
+    """
+
+    def __init__(self, pool_dir=config.POOL_DIR, pool_sizes=config.POOL_SIZES):
+        """
+        pool_dir   = Directory where pool VM directories should be placed
+        pool_sizes = Dictionary of (min, max) VM counts
+                     { "<group>" : { "<type>" : (<min>, <max>) } }
+        """
+        self.pool_dir = pool_dir
+        self.pool_sizes = pool_sizes
+
+        """
+        Private member variables
+            _counters = Shared hit/miss counters for each (group, type)
+                        { ("<group>", "<type>") : {"hits" : <Value>, "misses" : <Value>} }
+            _lock     = Lock guarding updates to _counters
+            _wake     = Event set whenever a VM is released, so the
+                        maintainer can reset it straight away
+            _thread   = Maintainer thread, only run in the main rugby process
+        """
+        self._counters = {}
+        for vm_group, vm_types in config.GROUP_TO_TYPES.iteritems():
+            for vm_type in vm_types:
+                self._counters[(vm_group, vm_type)] = {'hits': Value('i', 0),
+                                                       'misses': Value('i', 0)}
+        self._lock = Lock()
+        self._wake = Event()
+        self._thread = None
+
+        try:
+            os.makedirs(self.pool_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def start(self):
+        """
+        Start the maintainer thread which boots, resets and trims pool VMs
+        """
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._maintain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def checkout(self, services, owner=None):
+        """
+        Method takes a list of (group, type) pairs, one per block of a build,
+        and tries to check out a ready VM for each of them. A build needs all
+        of its VMs on the same network, so either every pair is served and a
+        list of PoolLease objects (in the same order) is returned, or None is
+        returned and nothing is held. owner is the commit_id of the build,
+        which reclaim() uses to find VMs leased to builds which have died,
+        and which names the network the VMs are moved onto.
+        """
+        leases = []
+        for vm_group, vm_type in services:
+            lease = self._checkout_one(vm_group, vm_type, leases, owner)
+            if lease is None:
+                break
+            leases.append(lease)
+
+        if len(leases) != len(services):
+            # Put back whatever we grabbed, those VMs were never touched
+            for lease in leases:
+                self._transition(lease.vm_dir, LEASED, READY)
+            self._count(services, 'misses')
+            return None
+
+        if owner is not None:
+            try:
+                for lease in leases:
+                    self._join_network(lease.vm_dir, owner)
+            except Exception:
+                logger.exception('Failed to move pool VMs onto the network of {}'.format(owner))
+                # Some may have been moved already, so they are all reset
+                self.release(leases)
+                self._count(services, 'misses')
+                return None
+
+        self._count(services, 'hits')
+        return leases
+
+    def release(self, leases):
+        """
+        Method takes a list of PoolLease objects and hands them back to
+        the pool. They are reset in the background before being reused.
+        """
+        for lease in leases:
+            self._transition(lease.vm_dir, LEASED, DIRTY)
+        self._wake.set()
+
+    def reclaim(self, live, restarted=False):
+        """
+        Method hands back every VM leased to a build whose commit_id is not
+        in live, IE its worker died without releasing it, and returns how
+        many there were. After a restart, VMs leased without an owner are
+        handed back too, and VMs which were still booting are destroyed
+        since nothing is left to finish booting them
+        """
+        reclaimed = 0
+        threads = []
+        for name in sorted(os.listdir(self.pool_dir)):
+            vm_dir = os.path.join(self.pool_dir, name)
+            state = self._state(vm_dir)
+            if state == LEASED:
+                owner = self._owner(vm_dir)
+                if (owner is None and restarted) or (owner is not None and owner not in live):
+                    if self._transition(vm_dir, LEASED, DIRTY):
+                        logger.debug('Reclaiming pool VM {} from {}'.format(vm_dir, owner))
+                        reclaimed += 1
+            elif state == BOOTING and restarted:
+                threads.append(Thread(target=self._destroy, args=(vm_dir,)))
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if reclaimed:
+            self._wake.set()
+        return reclaimed
+
+    def get_stats(self):
+        """
+        Method returns the number of VMs in each state along with hit/miss
+        counters for every (group, type) pair
+
+            { "<group>/<type>" : {"ready" : 1, ..., "hits" : 3, "misses" : 0} }
+        """
+        stats = {}
+        for (vm_group, vm_type), counters in self._counters.iteritems():
+            vm_stats = dict((state, 0) for state in POOL_STATES)
+            for vm_dir in self._vm_dirs(vm_group, vm_type):
+                state = self._state(vm_dir)
+                if state is not None:
+                    vm_stats[state] += 1
+            vm_stats['hits'] = counters['hits'].value
+            vm_stats['misses'] = counters['misses'].value
+            stats['{}/{}'.format(vm_group, vm_type)] = vm_stats
+        return stats
+
+    def _checkout_one(self, vm_group, vm_type, taken, owner=None):
+        """
+        Helper function which atomically moves one ready VM of vm_group and
+        vm_type into the leased state, and returns a PoolLease for it. The
+        owner is written into the leased marker
+        """
+        taken_dirs = [lease.vm_dir for lease in taken]
+        for vm_dir in self._vm_dirs(vm_group, vm_type):
+            if vm_dir in taken_dirs:
+                continue
+            if self._transition(vm_dir, READY, LEASED):
+                if owner is not None:
+                    with open(os.path.join(vm_dir, LEASED), 'w') as marker_file:
+                        marker_file.write(owner)
+                meta = self._read_meta(vm_dir)
+                return PoolLease(vm_dir, vm_group, vm_type, meta['ip'])
+        return None
+
+    def _count(self, services, counter):
+        """
+        Helper function which bumps a hit or miss counter for each
+        (group, type) pair in services
+        """
+        with self._lock:
+            for service in services:
+                if service in self._counters:
+                    self._counters[service][counter].value += 1
+
+    def _maintain(self):
+        """
+        Maintainer loop. Resets dirty VMs, then boots or destroys VMs so that
+        every (group, type) pair has at least min ready VMs and no more than
+        max VMs in total
+        """
+        while True:
+            self._wake.clear()
+            try:
+                self._maintain_once()
+            except Exception:
+                logger.exception('Pool maintenance failed')
+            self._wake.wait(config.POOL_MAINTAIN_INTERVAL)
+
+    def _maintain_once(self):
+        """
+        Helper function for a single pass of the maintainer loop. Resets and
+        boots run in their own threads since each can take minutes
+        """
+        threads = []
+        for vm_group, vm_types in self.pool_sizes.iteritems():
+            for vm_type, (pool_min, pool_max) in vm_types.iteritems():
+                vm_dirs = self._vm_dirs(vm_group, vm_type)
+                by_state = dict((state, []) for state in POOL_STATES)
+                for vm_dir in vm_dirs:
+                    state = self._state(vm_dir)
+                    if state is not None:
+                        by_state[state].append(vm_dir)
+
+                for vm_dir in by_state[DIRTY]:
+                    threads.append(Thread(target=self._reset, args=(vm_dir,)))
+
+                # Dirty VMs will be ready soon, so they count towards min
+                warm = len(by_state[READY]) + len(by_state[DIRTY]) + len(by_state[BOOTING])
+                total = len(vm_dirs)
+                while warm < pool_min and total < pool_max:
+                    vm_dir = self._create(vm_group, vm_type)
+                    threads.append(Thread(target=self._boot, args=(vm_dir,)))
+                    warm += 1
+                    total += 1
+
+                # Trim idle VMs above max, for when max has been lowered
+                extra = total - pool_max
+                for vm_dir in by_state[READY][:max(extra, 0)]:
+                    if self._transition(vm_dir, READY, BOOTING):
+                        threads.append(Thread(target=self._destroy, args=(vm_dir,)))
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _create(self, vm_group, vm_type):
+        """
+        Helper function which picks a free slot for a new pool VM, creates
+        its directory in the booting state and renders its Vagrantfile
+        """
+        used_slots = set()
+        for name in os.listdir(self.pool_dir):
+            # Skip anything else left in pool_dir, IE a lost+found
+            match = POOL_VM_DIR_PATTERN.match(name)
+            if match == None:
+                logger.debug('Ignoring {} in {}, it is not a pool VM'.format(name, self.pool_dir))
+                continue
+            used_slots.add(int(match.group(1)))
+        slot = min(set(config.POOL_IP_SLOTS) - used_slots)
+
+        vm_dir = os.path.join(self.pool_dir, '{}-{}-{}'.format(vm_group, vm_type, slot))
+        ip = config.POOL_IP_PREFIX + str(slot)
+        os.makedirs(vm_dir)
+        open(os.path.join(vm_dir, BOOTING), 'w').close()
+        with open(os.path.join(vm_dir, 'meta.json'), 'w') as meta_file:
+            json.dump({'group': vm_group, 'type': vm_type, 'ip': ip}, meta_file)
+
+        # Until it is checked out the VM is on a network of its own
+        vm = {
+            'name': POOL_MACHINE_NAME,
+            'service': {'group': vm_group, 'type': vm_type},
+            'ip': ip,
+            'commit_id': '{}-{}'.format(config.POOL_NETWORK_NAME, slot)
+        }
+        render_vagrantfile(vm_dir, [vm])
+        return vm_dir
+
+    def _boot(self, vm_dir):
+        """
+        Helper function which brings up and provisions a new pool VM, then
+        snapshots it so it can be reset after every build
+        """
+        try:
+            Vagrant(vm_dir).up()
+            self._snapshot(vm_dir, 'save')
+        except Exception:
+            logger.exception('Failed to boot pool VM {}'.format(vm_dir))
+            self._destroy(vm_dir)
+            return
+        self._transition(vm_dir, BOOTING, READY)
+
+    def _reset(self, vm_dir):
+        """
+        Helper function which rolls a used pool VM back to its clean snapshot.
+        If that fails the VM is destroyed, and the next maintenance pass will
+        boot a replacement
+        """
+        try:
+            self._snapshot(vm_dir, 'restore', '--no-provision')
+        except Exception:
+            logger.exception('Failed to reset pool VM {}'.format(vm_dir))
+            self._destroy(vm_dir)
+            return
+        self._transition(vm_dir, DIRTY, READY)
+
+    def _destroy(self, vm_dir):
+        """
+        Helper function which destroys a pool VM and removes its directory
+        """
+        try:
+            Vagrant(vm_dir).destroy()
+        except Exception:
+            logger.exception('Failed to destroy pool VM {}'.format(vm_dir))
+        shutil.rmtree(vm_dir, ignore_errors=True)
+
+    def _snapshot(self, vm_dir, action, *args):
+        """
+        Helper function which runs `vagrant snapshot <action>` on a pool VM.
+        python-vagrant does not wrap the snapshot commands
+        """
+        cmd = ['vagrant', 'snapshot', action] + list(args) + [POOL_MACHINE_NAME, config.POOL_SNAPSHOT_NAME]
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, cwd=vm_dir, stdout=devnull, stderr=devnull)
+
+    def _join_network(self, vm_dir, network):
+        """
+        Helper function which moves a running pool VM's private network
+        adapter onto the VirtualBox internal network named network.
+        python-vagrant can't do this, so VBoxManage is run on the VM's id
+        """
+        with open(os.path.join(vm_dir, '.vagrant', 'machines', POOL_MACHINE_NAME, 'virtualbox', 'id')) as id_file:
+            machine_id = id_file.read().strip()
+        cmd = ['VBoxManage', 'controlvm', machine_id, 'nic{}'.format(POOL_PRIVATE_NIC), 'intnet', network]
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+
+    def _vm_dirs(self, vm_group, vm_type):
+        """
+        Helper function which returns the directories of every pool VM
+        of vm_group and vm_type
+        """
+        prefix = '{}-{}-'.format(vm_group, vm_type)
+        return [os.path.join(self.pool_dir, name) for name in sorted(os.listdir(self.pool_dir))
+                if name.startswith(prefix)]
+
+    @staticmethod
+    def _read_meta(vm_dir):
+        with open(os.path.join(vm_dir, 'meta.json')) as meta_file:
+            return json.load(meta_file)
+
+    @staticmethod
+    def _owner(vm_dir):
+        """
+        Helper function which returns the commit_id a leased pool VM was
+        checked out by, or None if it is not known
+        """
+        try:
+            with open(os.path.join(vm_dir, LEASED)) as marker_file:
+                return marker_file.read().strip() or None
+        except IOError:
+            return None
+
+    @staticmethod
+    def _state(vm_dir):
+        """
+        Helper function which returns which state marker exists in vm_dir
+        """
+        for state in POOL_STATES:
+            if os.path.exists(os.path.join(vm_dir, state)):
+                return state
+        return None
+
+    @staticmethod
+    def _transition(vm_dir, from_state, to_state):
+        """
+        Helper function which atomically moves vm_dir from from_state to
+        to_state. Returns False if vm_dir was not in from_state, IE another
+        process got to it first
+        """
+        try:
+            os.rename(os.path.join(vm_dir, from_state), os.path.join(vm_dir, to_state))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
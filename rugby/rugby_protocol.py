@@ -0,0 +1,82 @@
+# internal
+from rugby_state import RugbyState
+import config
+
+# stdlib
+import logging
+import time
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+"""
+Messages between a worker and the process supervising it are tuples,
+pickled by multiprocessing, which start with the version of this schema,
+the kind of message, the build it is about and when it was sent
+
+    (<version>, <kind>, <commit_id>, <timestamp>, <fields of kind>...)
+
+Worker to parent
+    state     = <RugbyState value>, <message>
+    log       = <list of log lines, see rugby_log>
+    progress  = <block name>, <RugbyState value of the block>, <command>,
+                <exit status>, <seconds it ran for>. Sent when a command
+                starts, with exit status and seconds None, and when it
+                ends, with exit status -1 if it couldn't be run
+    resources = <block name>, <CPU seconds>, <memory in use in KB>. For a
+                block, the CPU time of the command just run and the memory
+                in use on its machine. With block name None, the CPU time
+                of the worker process and its children so far and its
+                resident memory. Either can be None if it couldn't be read
+    heartbeat = <seconds since the worker last made progress>
+
+Parent to worker
+    cancel    = <RugbyState value the build should end in>, <reason>
+
+PROTOCOL_VERSION is bumped whenever the fields of a kind change, and
+messages of any other version are dropped by whoever receives them.
+"""
+PROTOCOL_VERSION = 1
+
+# Kinds of message
+STATE = 'state'
+LOG = 'log'
+PROGRESS = 'progress'
+RESOURCES = 'resources'
+HEARTBEAT = 'heartbeat'
+CANCEL = 'cancel'
+
+def state_msg(commit_id, state, msg):
+    return (PROTOCOL_VERSION, STATE, commit_id, time.time(), state.value, msg)
+
+def log_msg(commit_id, lines):
+    return (PROTOCOL_VERSION, LOG, commit_id, time.time(), lines)
+
+def progress_msg(commit_id, block_name, state, command, exit_status=None, duration=None):
+    return (PROTOCOL_VERSION, PROGRESS, commit_id, time.time(), block_name, state.value, command,
+            exit_status, duration)
+
+def resources_msg(commit_id, block_name, cpu_seconds, mem_kb):
+    return (PROTOCOL_VERSION, RESOURCES, commit_id, time.time(), block_name, cpu_seconds, mem_kb)
+
+def heartbeat_msg(commit_id, idle_seconds):
+    return (PROTOCOL_VERSION, HEARTBEAT, commit_id, time.time(), idle_seconds)
+
+def cancel_msg(commit_id, state, reason):
+    return (PROTOCOL_VERSION, CANCEL, commit_id, time.time(), state.value, reason)
+
+def msg_state(msg):
+    """
+    This function returns the RugbyState of a state, progress or
+    cancel message
+    """
+    return RugbyState(msg[5] if msg[1] == PROGRESS else msg[4])
+
+def is_current(msg):
+    """
+    This function returns True if msg is a message of this version of
+    the schema, logging it if not
+    """
+    if isinstance(msg, tuple) and msg and msg[0] == PROTOCOL_VERSION:
+        return True
+    logger.warning('Dropping message which is not protocol version {}: {!r}'.format(PROTOCOL_VERSION, msg)[:500])
+    return False
@@ -0,0 +1,442 @@
+# internal
+from rugby_ssh import RugbyConnections, SSHInfo
+from rugby_fake import FakeConnections
+import config
+
+# external
+from vagrant import Vagrant
+
+# stdlib
+from threading import Thread, Lock
+import subprocess
+import logging
+import signal
+import pipes
+import json
+import time
+import re
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# File in a build's root_dir listing the containers ContainerProvider made
+CONTAINERS_FILE = 'containers.json'
+
+# Exception class that is thrown when a block's machine can't be
+# created, started or destroyed
+class ProviderError(Exception):
+    pass
+
+class RugbyProvider:
+    """
+    Base class of the drivers which bring up the machines blocks run on.
+    A build creates one provider per provider name used in its rugby
+    config, each looking after the blocks which picked it.
+
+        provider = new_provider('vagrant', commit_id, root_dir, vms)
+        provider.create(raw_url)
+        provider.up_block(block_name)
+        exit_status = provider.connections.run(block_name, provider.command('npm test'), output)
+        provider.destroy()
+
+    connections has the same interface as RugbyConnections.
+    """
+    name = None
+
+    def __init__(self, commit_id, root_dir, vms, network_lease=None):
+        """
+        commit_id     = Unique identifier of the build
+        root_dir      = Directory the provider can keep its files in
+        vms           = Blocks from the rugby config to look after
+        network_lease = NetworkLease the blocks' addresses come from
+        """
+        self.commit_id = commit_id
+        self.root_dir = root_dir
+        self.vms = vms
+        self.network_lease = network_lease
+        self.connections = None
+
+        """
+        Private member variables
+            _up_lock = Lock so only one block at a time brings up machines
+                       of a provider which can't bring them up side by side
+            _up      = Whether up() succeeded, None until it has been run
+        """
+        self._up_lock = Lock()
+        self._up = None
+
+    def create(self, raw_url):
+        """
+        Method writes out whatever up() needs, without starting anything
+        """
+        pass
+
+    def up(self):
+        """
+        Method starts and provisions every block's machine
+        """
+        pass
+
+    def up_block(self, block_name):
+        """
+        Method starts and provisions the machine of one block, so the block
+        can move on without waiting for the others. Can be called from
+        several threads at once. Providers which can only bring up all
+        their blocks together do so the first time it is called
+        """
+        with self._up_lock:
+            if self._up == None:
+                try:
+                    self.up()
+                    self._up = True
+                except Exception:
+                    self._up = False
+                    raise
+            if not self._up:
+                raise ProviderError('{} blocks failed to come up'.format(self.name))
+
+    def command(self, script):
+        """
+        Method returns the command which runs script as root in a
+        login shell on a block's machine
+        """
+        return 'sudo -n -H bash -l -c {}'.format(pipes.quote(script))
+
+    def destroy(self):
+        """
+        Method stops and removes every block's machine
+        """
+        pass
+
+    @staticmethod
+    def reap(root_dir):
+        """
+        This method destroys whatever machines of the provider are left
+        behind in root_dir by a worker which died before cleaning up
+        """
+        pass
+
+class VagrantProvider(RugbyProvider):
+    """
+    Runs each block in a VirtualBox VM brought up by Vagrant from a
+    Vagrantfile rendered for the provider's blocks, or in warm VMs checked
+    out of the pool if leases are given. Commands are run over SSH.
+    """
+    name = 'vagrant'
+
+    def __init__(self, commit_id, root_dir, vms, network_lease=None, leases=None, render=None):
+        """
+        leases = PoolLease for each block, in order, if pool VMs are used
+        render = Function which takes a directory, the raw URL of the
+                 repo and a list of blocks, and writes their Vagrantfile
+        """
+        RugbyProvider.__init__(self, commit_id, root_dir, vms, network_lease)
+        self.leases = leases or []
+        self.render = render
+        self.connections = RugbyConnections(self._ssh_info)
+
+        """
+        Private member variables
+            _vagrant  = Vagrant Object of root_dir, None if pool
+                        VMs are used
+            _machines = Vagrant Object and machine name to use for each block
+                        { "<block name>" : (<Vagrant>, "<machine name>") }
+        """
+        self._vagrant = None
+        self._machines = {}
+        for vm, lease in zip(self.vms, self.leases):
+            self._machines[vm['name']] = (VagrantProvider.new_vagrant(lease.vm_dir), lease.machine_name)
+
+    def create(self, raw_url):
+        if self.leases:
+            return
+        self.render(self.root_dir, raw_url, self.vms)
+        self._vagrant = VagrantProvider.new_vagrant(self.root_dir)
+        for vm in self.vms:
+            self._machines[vm['name']] = (self._vagrant, vm['name'])
+
+    def up(self):
+        # Pool VMs are already up and provisioned
+        if self._vagrant != None:
+            self._vagrant.up()
+
+    def up_block(self, block_name):
+        # Concurrent `vagrant up`s of one Vagrantfile fight over its
+        # .vagrant directory and the VirtualBox host, so machines are
+        # brought up one at a time. Blocks which are already up carry
+        # on cloning and installing meanwhile
+        if self._vagrant != None:
+            vagrant, machine_name = self._machines[block_name]
+            with self._up_lock:
+                vagrant.up(vm_name=machine_name)
+
+    def destroy(self):
+        # Pool VMs are handed back by the worker instead
+        if self._vagrant != None:
+            self._vagrant.destroy()
+
+    def _ssh_info(self, block_name):
+        """
+        Helper function which returns the SSHInfo needed to run
+        commands on the VM of a block. This shells out to
+        `vagrant ssh-config`, so RugbyConnections only calls it
+        once per block
+        """
+        vagrant, machine_name = self._machines[block_name]
+        ssh_config = vagrant.conf(vm_name=machine_name)
+        # Password for keyfile which should always be by default
+        # 'vagrant'
+        key_password = 'vagrant'
+        return SSHInfo(ssh_config['HostName'], ssh_config['User'], key_password,
+                       ssh_config['Port'], ssh_config['IdentityFile'])
+
+    @staticmethod
+    def reap(root_dir):
+        if os.path.exists(os.path.join(root_dir, 'Vagrantfile')):
+            VagrantProvider.new_vagrant(root_dir).destroy()
+
+    @staticmethod
+    def new_vagrant(root_dir):
+        return Vagrant(root_dir, quiet_stdout=False, quiet_stderr=False)
+
+class ContainerProvider(RugbyProvider):
+    """
+    Runs each block in a Docker container on the host, started from
+    config.CONTAINER_IMAGES for its service type. Containers start in well
+    under a second, but share the host's kernel. The provider's blocks
+    are put on a Docker network using the build's leased subnet, so they
+    keep the addresses they were given. Commands are run with `docker exec`.
+    """
+    name = 'container'
+
+    def __init__(self, commit_id, root_dir, vms, network_lease=None):
+        RugbyProvider.__init__(self, commit_id, root_dir, vms, network_lease)
+        self.network_name = 'rugby-{}'.format(commit_id)
+        self.containers = dict((vm['name'], ContainerProvider.container_name(commit_id, vm['name']))
+                               for vm in vms)
+        self.connections = ContainerConnections(self.containers)
+
+        """
+        Private member variables
+            _network = True once network_name has been created
+        """
+        self._network = False
+
+    def create(self, raw_url):
+        # Containers outlive a worker which dies, so remember what to remove
+        with open(os.path.join(self.root_dir, CONTAINERS_FILE), 'w') as containers_file:
+            json.dump({'containers' : sorted(self.containers.values()), 'network' : self.network_name},
+                      containers_file)
+
+    def up(self):
+        for vm in self.vms:
+            self.up_block(vm['name'])
+
+    def up_block(self, block_name):
+        # Blocks share the network, which the first of them creates
+        with self._up_lock:
+            if self.network_lease != None and not self._network:
+                ContainerProvider.docker('network', 'create', '--subnet', self.network_lease.network, self.network_name)
+                self._network = True
+
+        vm = [vm for vm in self.vms if vm['name'] == block_name][0]
+        image = config.CONTAINER_IMAGES[vm['service']['type']]
+        args = ['run', '--detach', '--name', self.containers[vm['name']],
+                '--hostname', self.containers[vm['name']]]
+        if self._network:
+            args += ['--network', self.network_name, '--ip', vm['ip']]
+        # Language images exit straight away without something to run
+        if vm['service']['group'] in config.CONTAINER_KEEP_ALIVE_GROUPS:
+            args += ['--entrypoint', 'sleep', image, 'infinity']
+        else:
+            args += [image]
+        ContainerProvider.docker(*args)
+
+    def command(self, script):
+        # Containers run as root already
+        return 'bash -l -c {}'.format(pipes.quote(script))
+
+    def destroy(self):
+        for container in self.containers.values():
+            try:
+                ContainerProvider.docker('rm', '--force', container)
+            except ProviderError:
+                pass
+        if self._network:
+            try:
+                ContainerProvider.docker('network', 'rm', self.network_name)
+            except ProviderError:
+                pass
+            self._network = False
+
+    @staticmethod
+    def reap(root_dir):
+        containers_path = os.path.join(root_dir, CONTAINERS_FILE)
+        if not os.path.exists(containers_path):
+            return
+        with open(containers_path) as containers_file:
+            created = json.load(containers_file)
+        for container in created['containers']:
+            try:
+                ContainerProvider.docker('rm', '--force', container)
+            except ProviderError:
+                pass
+        try:
+            ContainerProvider.docker('network', 'rm', created['network'])
+        except ProviderError:
+            pass
+
+    @staticmethod
+    def container_name(commit_id, block_name):
+        return 'rugby-{}-{}'.format(commit_id, re.sub('[^A-Za-z0-9]+', '-', block_name).strip('-').lower())
+
+    @staticmethod
+    def docker(*args):
+        """
+        This method runs a docker command, raising ProviderError if it fails
+        """
+        with open(os.devnull, 'w') as devnull:
+            try:
+                subprocess.check_call(('docker',) + args, stdout=devnull)
+            except (OSError, subprocess.CalledProcessError):
+                raise ProviderError('docker {} failed'.format(args[0]))
+
+class ProcessChannel:
+    """
+    Lets a command run by ContainerConnections be cancelled the same
+    way as an SSH channel. The command runs in its own process group,
+    which is killed as a whole so nothing is left holding its output open
+    """
+    def __init__(self, process):
+        self.process = process
+
+    def close(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class ContainerConnections:
+    """
+    Same interface as RugbyConnections, for running commands in
+    the containers of a ContainerProvider with `docker exec`
+    """
+
+    def __init__(self, containers):
+        """
+        containers = Container name of each block
+                     { "<block name>" : "<container name>" }
+        """
+        self.containers = containers
+
+    def run(self, block_name, remote_cmd, output, channels=None, input_fd=None, pty=True):
+        args = ['docker', 'exec']
+        if input_fd != None:
+            args.append('--interactive')
+        args += [self.containers[block_name], 'sh', '-c', remote_cmd]
+        # Without a pty RugbyConnections only sends back stdout
+        stderr = subprocess.STDOUT if pty or input_fd != None else open(os.devnull, 'w')
+
+        process = subprocess.Popen(args, stdin=subprocess.PIPE if input_fd != None else None,
+                                   stdout=subprocess.PIPE, stderr=stderr, preexec_fn=os.setsid)
+        if channels != None:
+            channels[block_name] = ProcessChannel(process)
+        try:
+            if input_fd != None:
+                writer = Thread(target=ContainerConnections._feed, args=(input_fd, process.stdin))
+                writer.daemon = True
+                writer.start()
+            while True:
+                data = os.read(process.stdout.fileno(), 4096)
+                if not data:
+                    break
+                output.write(data)
+            return process.wait()
+        finally:
+            if channels != None:
+                channels.pop(block_name, None)
+            if stderr not in (subprocess.STDOUT, None):
+                stderr.close()
+
+    def get_timings(self):
+        return {}
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _feed(input_fd, stdin):
+        try:
+            while True:
+                data = input_fd.read(65536)
+                if not data:
+                    break
+                stdin.write(data)
+        except IOError:
+            pass
+        finally:
+            stdin.close()
+
+class FakeProvider(RugbyProvider):
+    """
+    Runs nothing at all, for trying out and testing Rugby without
+    VirtualBox or Docker. Bringing blocks up takes config.FAKE_UP_SECONDS,
+    and every command succeeds after config.FAKE_COMMAND_SECONDS
+    """
+    name = 'fake'
+
+    def __init__(self, commit_id, root_dir, vms, network_lease=None):
+        RugbyProvider.__init__(self, commit_id, root_dir, vms, network_lease)
+        self.connections = FakeConnections(None)
+
+    def up(self):
+        time.sleep(config.FAKE_UP_SECONDS)
+
+    def up_block(self, block_name):
+        time.sleep(config.FAKE_UP_SECONDS)
+
+PROVIDERS = dict((provider.name, provider) for provider in [VagrantProvider, ContainerProvider, FakeProvider])
+
+def new_provider(name, commit_id, root_dir, vms, network_lease=None, **kwargs):
+    """
+    This function returns the provider called name for vms
+    """
+    return PROVIDERS[name](commit_id, root_dir, vms, network_lease, **kwargs)
+
+def reap_build(root_dir):
+    """
+    This function has every provider destroy what it left behind
+    in the root_dir of a build whose worker died
+    """
+    for name, provider in sorted(PROVIDERS.iteritems()):
+        try:
+            provider.reap(root_dir)
+        except Exception:
+            logger.exception('Failed to reap {} machines in {}'.format(name, root_dir))
+
+class ProviderConnections:
+    """
+    Same interface as RugbyConnections, passing each command on to the
+    connections of the provider its block belongs to
+    """
+
+    def __init__(self, block_providers):
+        """
+        block_providers = Provider of each block
+                          { "<block name>" : <RugbyProvider> }
+        """
+        self.block_providers = block_providers
+
+    def run(self, block_name, remote_cmd, output, channels=None, input_fd=None, pty=True):
+        return self.block_providers[block_name].connections.run(block_name, remote_cmd, output,
+                                                                channels, input_fd, pty)
+
+    def get_timings(self):
+        timings = {}
+        for provider in set(self.block_providers.values()):
+            timings.update(provider.connections.get_timings())
+        return timings
+
+    def close(self):
+        for provider in set(self.block_providers.values()):
+            provider.connections.close()
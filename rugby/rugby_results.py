@@ -0,0 +1,70 @@
+# internal
+from rugby_state import RugbyState
+from rugby_source import SourceError
+import config
+
+# stdlib
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+class RugbyResultCache:
+    """
+    Usage:
+        result_cache = RugbyResultCache(rugby_db, source_cache)
+        key = result_cache.key(build_info, '.rugby.yml')
+        result = result_cache.lookup(key)
+        if result == None:
+            run the build, then
+            result_cache.record(key, commit_id, state)
+
+    Remembers the final state of builds by the hash of the commit's source
+    tree and the contents of its rugby config. A commit whose tree and
+    config are identical to an earlier build's, IE a re-push, a rebase
+    that didn't change anything or a duplicate webhook, gets that build's
+    result instead of a build of its own. Only states in
+    config.RESULT_CACHE_STATES are reused.
+
+    Tree hashes are looked up in the RugbySourceCache mirror of the repo.
+    """
+
+    def __init__(self, rugby_db, source_cache):
+        """
+        rugby_db     = RugbyDatabase where results are kept
+        source_cache = RugbySourceCache used to look up tree hashes
+        """
+        self.rugby_db = rugby_db
+        self.source_cache = source_cache
+
+    def key(self, build_info, rugby_config):
+        """
+        Method returns the cache key of a build, or None if its tree
+        or rugby config can't be read
+        """
+        try:
+            tree = self.source_cache.tree(build_info.clone_url, build_info.commit_id)
+            with open(rugby_config, 'rb') as config_file:
+                config_digest = hashlib.sha1(config_file.read()).hexdigest()
+        except (SourceError, IOError) as e:
+            logger.debug('Not caching result of {}: {}'.format(build_info.commit_id, e))
+            return None
+        return hashlib.sha1('{} {} {}'.format(build_info.clone_url, tree, config_digest)).hexdigest()
+
+    def lookup(self, key):
+        """
+        Method returns the cached result for key, or None
+            {"cache_key" : "<sha1>", "commit_id" : "<commit_id>", "state" : "<RugbyState>", ...}
+        """
+        if key == None:
+            return None
+        return self.rugby_db.get_result(key)
+
+    def record(self, key, commit_id, state):
+        """
+        Method caches a finished build's state under key, if it
+        is one which can be reused
+        """
+        if key != None and state in [str(RugbyState[name]) for name in config.RESULT_CACHE_STATES]:
+            self.rugby_db.insert_result(key, commit_id, state, time.time())
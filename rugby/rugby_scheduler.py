@@ -0,0 +1,347 @@
+# internal
+from rugby_loader import RugbyLoader
+from rugby_state import RugbyState
+import config
+
+# stdlib
+from collections import deque
+from threading import Lock
+import logging
+import errno
+import json
+import time
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# Exception class that is thrown when a build can't be queued
+class QueueFullError(Exception):
+    pass
+
+class QueuedBuild:
+    """
+    Struct to hold all the info needed to start a build once
+    it leaves the queue
+    """
+    def __init__(self, build_info, rugby_config, callbacks, lane, cost, enqueued_at, rugby_config_text=None):
+        self.build_info = build_info
+        # Copy of the rugby config the build was submitted with, which
+        # the file it came from may no longer match by the time it runs
+        self.rugby_config = rugby_config
+        self.rugby_config_text = rugby_config_text
+        # Same format as WorkerInfo.callbacks. Kept as a list which is
+        # handed on to the worker, so more can be attached at any time
+        self.callbacks = list(callbacks)
+        # Lower lanes are started first
+        self.lane = lane
+        # Number of VMs the build will bring up
+        self.cost = cost
+        self.enqueued_at = enqueued_at
+
+    def sort_key(self):
+        return (self.lane, self.enqueued_at)
+
+class RugbyScheduler:
+    """
+    Usage:
+        scheduler = RugbyScheduler(rugby_db, launch)
+        superseded = scheduler.submit(build_info, '.rugby.yml', callbacks)
+        scheduler.schedule()
+        ...
+        scheduler.finished(commit_id)
+        scheduler.schedule()
+
+    Sits in front of RugbyWorker so that a burst of builds doesn't bring up
+    more VMs than the host can handle. Builds wait in a bounded queue, which
+    is mirrored to the database so it survives restarts, and are started by
+    calling launch(build_info, rugby_config, callbacks) once there is room
+    for them under both the concurrent build and concurrent VM limits.
+
+    Builds on one of config.PRIORITY_BRANCHES go in lane 0 and everything
+    else in lane 1. Within a lane builds start in the order they arrived.
+    A new build replaces any queued build of the same repo and branch.
+    Submitting a commit which is already queued or running attaches its
+    callbacks to that build instead, see attach().
+    """
+
+    def __init__(self, rugby_db, launch,
+                 max_builds=config.MAX_CONCURRENT_BUILDS,
+                 max_vms=config.MAX_CONCURRENT_VMS,
+                 max_queue=config.MAX_QUEUE_SIZE,
+                 fits=None, config_dir=config.BASE_DIR):
+        """
+        rugby_db   = RugbyDatabase where the queue is persisted
+        launch     = Function which starts a worker for a build
+        max_builds = Max number of builds running at once
+        max_vms    = Max number of VMs running at once
+        max_queue  = Max number of builds waiting to run
+        fits       = Optional function which takes a list of QueuedBuild
+                     objects and returns True if they can all be started
+                     at once, IE on the hosts of a RugbyCoordinator
+        config_dir = Directory the copy of each build's rugby config is
+                     written to, and launched from
+        """
+        self.rugby_db = rugby_db
+        self.launch = launch
+        self.max_builds = max_builds
+        self.max_vms = max_vms
+        self.max_queue = max_queue
+        self.fits = fits
+        self.config_dir = config_dir
+
+        """
+        Private member variables
+            _queue   = QueuedBuild objects waiting to run
+            _running = Number of VMs used by each running build
+                       { "<commit_id>" : <cost> }
+            _builds  = QueuedBuild of every queued or running build
+                       { "<commit_id>" : <QueuedBuild> }
+            _waits   = Seconds spent queued by recently started builds
+            _lock    = Lock guarding all of the above, since builds are
+                       submitted and finished from different threads
+        """
+        self._queue = []
+        self._running = {}
+        self._builds = {}
+        self._waits = deque(maxlen=config.QUEUE_WAIT_SAMPLES)
+        self._lock = Lock()
+
+    def submit(self, build_info, rugby_config, callbacks):
+        """
+        Method queues a build, and returns a list of QueuedBuild objects
+        which were superseded by it and will never run. Raises
+        QueueFullError if there is no room left in the queue.
+
+        If the commit is already queued or running, the callbacks it
+        doesn't have yet are attached to it instead, and None is returned.
+
+        The rugby config is copied, so the build runs with it as it was
+        when it was submitted, even across a restart. A config which
+        can't be read is left for the worker to report.
+        """
+        lane = RugbyScheduler.lane(build_info)
+        cost = RugbyScheduler.cost(build_info.commit_id, rugby_config)
+        try:
+            with open(rugby_config) as config_file:
+                rugby_config_text = config_file.read()
+        except IOError:
+            rugby_config_text = None
+        queued_build = QueuedBuild(build_info, rugby_config, callbacks, lane, cost, time.time(),
+                                   rugby_config_text)
+
+        with self._lock:
+            existing = self._builds.get(build_info.commit_id)
+            if existing != None:
+                existing.callbacks.extend(cb for cb in callbacks if cb not in existing.callbacks)
+                return None
+
+            superseded = []
+            if build_info.branch != None:
+                for other in self._queue:
+                    if (other.build_info.branch == build_info.branch and
+                        other.build_info.clone_url == build_info.clone_url):
+                        superseded.append(other)
+
+            if len(self._queue) - len(superseded) >= self.max_queue:
+                raise QueueFullError('Build queue is full ({} builds)'.format(self.max_queue))
+
+            for other in superseded:
+                self._queue.remove(other)
+                self._builds.pop(other.build_info.commit_id, None)
+                self.rugby_db.dequeue_build(other.build_info.commit_id)
+                self._remove_config(other.build_info.commit_id)
+
+            self._save_config(queued_build)
+            self._queue.append(queued_build)
+            self._queue.sort(key=QueuedBuild.sort_key)
+            self._builds[build_info.commit_id] = queued_build
+            self.rugby_db.enqueue_build(queued_build)
+
+        return superseded
+
+    def restore(self, build_info_class, callbacks):
+        """
+        Method reloads builds which were still queued when rugby last
+        stopped. Only the given callbacks are attached to them since the
+        original ones can't be persisted. Builds queued before configs
+        were copied into the queue move to ERROR if their config file
+        is gone.
+        """
+        lost = []
+        with self._lock:
+            for row in self.rugby_db.get_queue():
+                build_info = build_info_class(json.loads(row['build_info']))
+                queued_build = QueuedBuild(build_info, row['rugby_config'], callbacks,
+                                           row['lane'], row['cost'], row['enqueued_at'],
+                                           row['rugby_config_text'])
+                if queued_build.rugby_config_text != None:
+                    self._save_config(queued_build)
+                elif not os.path.exists(queued_build.rugby_config):
+                    logger.warning('Config {} of queued build {} is gone'.format(
+                        queued_build.rugby_config, build_info.commit_id))
+                    self.rugby_db.dequeue_build(row['commit_id'])
+                    lost.append(build_info.commit_id)
+                    continue
+                self._queue.append(queued_build)
+                self._builds[build_info.commit_id] = queued_build
+            self._queue.sort(key=QueuedBuild.sort_key)
+
+        for commit_id in lost:
+            for callback in callbacks:
+                callback(commit_id, str(RugbyState.ERROR))
+
+    def attach(self, commit_id, callbacks):
+        """
+        Method adds callbacks to a build which is already queued or
+        running, and returns its QueuedBuild. Returns None if there is
+        no such build
+        """
+        with self._lock:
+            queued_build = self._builds.get(commit_id)
+            if queued_build != None:
+                queued_build.callbacks.extend(callbacks)
+            return queued_build
+
+    def cancel(self, commit_id):
+        """
+        Method removes a build from the queue, and returns its QueuedBuild.
+        Returns None if the build isn't queued, IE it is already running
+        """
+        with self._lock:
+            queued_build = self._builds.get(commit_id)
+            if queued_build == None or queued_build not in self._queue:
+                return None
+            self._queue.remove(queued_build)
+            del self._builds[commit_id]
+            self.rugby_db.dequeue_build(commit_id)
+            self._remove_config(commit_id)
+            return queued_build
+
+    def schedule(self):
+        """
+        Method starts queued builds, in priority order, for as long as
+        there is room for them. The head of the queue is never skipped,
+        so large builds can't be starved by a stream of small ones.
+        """
+        to_launch = []
+        with self._lock:
+            while self._queue:
+                queued_build = self._queue[0]
+                running_vms = sum(self._running.itervalues())
+                if len(self._running) >= self.max_builds:
+                    break
+                # A build bigger than max_vms can still run on its own
+                if self._running and running_vms + queued_build.cost > self.max_vms:
+                    break
+                if self.fits != None and not self.fits(to_launch + [queued_build]):
+                    break
+
+                self._queue.pop(0)
+                self.rugby_db.dequeue_build(queued_build.build_info.commit_id)
+                self._running[queued_build.build_info.commit_id] = queued_build.cost
+                self._waits.append(time.time() - queued_build.enqueued_at)
+                to_launch.append(queued_build)
+
+        for queued_build in to_launch:
+            try:
+                self.launch(queued_build.build_info, queued_build.rugby_config, queued_build.callbacks)
+            except Exception:
+                logger.exception('Failed to start build {}'.format(queued_build.build_info.commit_id))
+                self.finished(queued_build.build_info.commit_id)
+
+    def running(self):
+        """
+        Method returns the commit_ids of builds which have been started,
+        from just before their worker is launched until it is gone
+        """
+        with self._lock:
+            return set(self._running)
+
+    def finished(self, commit_id):
+        """
+        Method frees up the room held by a build once its worker is gone
+        """
+        with self._lock:
+            self._running.pop(commit_id, None)
+            self._builds.pop(commit_id, None)
+            self._remove_config(commit_id)
+
+    def get_stats(self):
+        """
+        Method returns queue depth, capacity in use and how long recently
+        started builds waited in the queue
+
+            { "depth" : 3, "lanes" : {0 : 1, 1 : 2}, "running_builds" : 2,
+              "running_vms" : 4, "oldest_wait" : 12.5,
+              "wait" : {"samples" : 20, "mean" : 4.2, "max" : 30.1} }
+        """
+        with self._lock:
+            now = time.time()
+            lanes = {}
+            for queued_build in self._queue:
+                lanes[queued_build.lane] = lanes.get(queued_build.lane, 0) + 1
+            oldest_wait = 0
+            if self._queue:
+                oldest_wait = now - min(queued_build.enqueued_at for queued_build in self._queue)
+
+            waits = list(self._waits)
+            wait_stats = {'samples': len(waits), 'mean': 0, 'max': 0}
+            if waits:
+                wait_stats['mean'] = sum(waits) / len(waits)
+                wait_stats['max'] = max(waits)
+
+            return {
+                'depth': len(self._queue),
+                'lanes': lanes,
+                'running_builds': len(self._running),
+                'running_vms': sum(self._running.itervalues()),
+                'oldest_wait': oldest_wait,
+                'wait': wait_stats
+            }
+
+    def _save_config(self, queued_build):
+        """
+        Helper function which writes out the copy of a build's rugby
+        config, and points the build at it
+        """
+        if queued_build.rugby_config_text == None:
+            return
+        queued_build.rugby_config = self._config_path(queued_build.build_info.commit_id)
+        with open(queued_build.rugby_config, 'w') as config_file:
+            config_file.write(queued_build.rugby_config_text)
+
+    def _remove_config(self, commit_id):
+        """
+        Helper function which deletes the copy of a build's rugby config
+        """
+        try:
+            os.remove(self._config_path(commit_id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _config_path(self, commit_id):
+        return os.path.join(self.config_dir, '{}.queued.rugby.yml'.format(commit_id))
+
+    @staticmethod
+    def lane(build_info):
+        """
+        Method returns which lane a build belongs in
+        """
+        if build_info.branch in config.PRIORITY_BRANCHES:
+            return 0
+        return 1
+
+    @staticmethod
+    def cost(commit_id, rugby_config):
+        """
+        Method estimates how many VMs a build will use from the number
+        of blocks in its rugby config. Blocks run in containers don't
+        count. Configs which fail to load count as one VM, the worker
+        will report the actual error.
+        """
+        try:
+            vms = RugbyLoader(commit_id, rugby_config).get_config()
+        except Exception:
+            return 1
+        return len([vm for vm in vms if vm.get('provider', config.DEFAULT_PROVIDER) != 'container'])
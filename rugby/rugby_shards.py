@@ -0,0 +1,47 @@
+# internal
+import config
+
+# stdlib
+import logging
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+def split_tests(tests, total, timings):
+    """
+    This function splits tests into total shards of about equal run time,
+    using timings, a dict of test to its last known duration in seconds.
+    Tests without a timing are assumed to take the average of those with
+    one. Returns a list of total lists of tests.
+
+    The split only depends on its arguments, so every shard of a block
+    can work out its own tests and they will all agree.
+    """
+    known = [timings[test] for test in tests if test in timings]
+    default = sum(known) / len(known) if known else 1.0
+    durations = dict((test, timings.get(test, default)) for test in tests)
+
+    # Longest first, each to the shard with the least run time so far
+    shards = [[] for _ in range(total)]
+    loads = [0.0] * total
+    for test in sorted(set(tests), key=lambda test: (-durations[test], test)):
+        index = loads.index(min(loads))
+        shards[index].append(test)
+        loads[index] += durations[test]
+    return [sorted(shard) for shard in shards]
+
+def parse_timings(output):
+    """
+    This function parses what a shard wrote to $RUGBY_SHARD_TIMINGS,
+    one '<test> <seconds>' per line, and returns a dict of test to
+    duration. Lines which can't be parsed are skipped
+    """
+    timings = {}
+    for line in output.splitlines():
+        parts = line.rsplit(None, 1)
+        if len(parts) != 2:
+            continue
+        try:
+            timings[parts[0]] = float(parts[1])
+        except ValueError:
+            pass
+    return timings
@@ -0,0 +1,171 @@
+# internal
+import config
+
+# stdlib
+import subprocess
+import hashlib
+import logging
+import fcntl
+import errno
+import os
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+# Exception class that is thrown when a commit can't be fetched
+class SourceError(Exception):
+    pass
+
+class RugbySourceCache:
+    """
+    Usage:
+        source_cache = RugbySourceCache(rugby_db)
+        archive_path = source_cache.archive(clone_url, commit_id)
+
+    Keeps a bare mirror of every repo Rugby builds under cache_dir, so a
+    build only fetches the objects it doesn't already have instead of
+    cloning the whole history into every VM. archive() returns a gzipped
+    tarball of exactly commit_id's tree, which is small enough to push to
+    each VM over its existing SSH connection.
+
+    Mirrors are shared by every worker process, so each one is updated
+    under an exclusive file lock. Hits and misses are recorded per repo
+    in the rugby database.
+    """
+
+    def __init__(self, rugby_db, cache_dir=config.SOURCE_CACHE_DIR):
+        """
+        rugby_db  = RugbyDatabase where hits and misses are recorded
+        cache_dir = Directory where mirrors and archives should be placed
+        """
+        self.rugby_db = rugby_db
+        self.cache_dir = cache_dir
+        self.archive_dir = os.path.join(cache_dir, 'archives')
+
+        try:
+            os.makedirs(self.archive_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def archive(self, clone_url, commit_id):
+        """
+        Method returns the path to a .tar.gz of commit_id's tree, fetching
+        it into the mirror of clone_url first if it isn't there yet.
+        Raises SourceError if the commit can't be found.
+        """
+        archive_path = os.path.join(self.archive_dir, '{}.tar.gz'.format(commit_id))
+        mirror_dir = self._mirror_dir(clone_url)
+
+        with open(mirror_dir + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            hit = os.path.exists(archive_path) or self._has_commit(mirror_dir, commit_id)
+            if not hit:
+                self._fetch_commit(clone_url, mirror_dir, commit_id)
+
+            if os.path.exists(archive_path):
+                # Mark as recently used
+                os.utime(archive_path, None)
+            else:
+                # Write to a temporary name so a half written archive
+                # is never picked up by another build
+                partial_path = archive_path + '.partial'
+                self._git(mirror_dir, 'archive', '--format=tar.gz', '-o', partial_path, commit_id)
+                os.rename(partial_path, archive_path)
+
+        self.rugby_db.record_source_cache(clone_url, hit)
+        try:
+            self._evict()
+        except OSError:
+            # The archive is there, eviction can happen next time
+            logger.exception('Failed to evict source archives')
+        return archive_path
+
+    def tree(self, clone_url, commit_id):
+        """
+        Method returns the hash of commit_id's tree, which is the same for
+        every commit with identical source, fetching the commit into the
+        mirror of clone_url first if it isn't there yet. Raises SourceError
+        if the commit can't be found.
+        """
+        mirror_dir = self._mirror_dir(clone_url)
+
+        with open(mirror_dir + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if not self._has_commit(mirror_dir, commit_id):
+                self._fetch_commit(clone_url, mirror_dir, commit_id)
+            return self._git(mirror_dir, 'rev-parse', '{}^{{tree}}'.format(commit_id)).strip()
+
+    def _mirror_dir(self, clone_url):
+        """
+        Helper function which returns where the mirror of clone_url lives
+        """
+        return os.path.join(self.cache_dir, hashlib.sha1(clone_url).hexdigest() + '.git')
+
+    def _fetch(self, clone_url, mirror_dir):
+        """
+        Helper function which creates the mirror of clone_url, or brings
+        an existing one up to date. Only new objects are downloaded
+        """
+        if not os.path.isdir(mirror_dir):
+            self._git(self.cache_dir, 'clone', '--mirror', '--quiet', clone_url, mirror_dir)
+        else:
+            self._git(mirror_dir, 'fetch', '--prune', '--quiet', 'origin')
+
+    def _fetch_commit(self, clone_url, mirror_dir, commit_id):
+        """
+        Helper function which brings the mirror up to date, raising
+        SourceError if commit_id still isn't in it. Must be called
+        holding the mirror's lock
+        """
+        self._fetch(clone_url, mirror_dir)
+        if not self._has_commit(mirror_dir, commit_id):
+            raise SourceError('Commit {} not found in {}'.format(commit_id, clone_url))
+
+    def _has_commit(self, mirror_dir, commit_id):
+        """
+        Helper function which returns True if commit_id is in the mirror
+        """
+        if not os.path.isdir(mirror_dir):
+            return False
+        try:
+            self._git(mirror_dir, 'cat-file', '-e', '{}^{{commit}}'.format(commit_id))
+        except SourceError:
+            return False
+        return True
+
+    def _evict(self):
+        """
+        Helper function which deletes all but the most recently used
+        config.SOURCE_ARCHIVE_KEEP archives
+        """
+        archives = []
+        for name in os.listdir(self.archive_dir):
+            if not name.endswith('.tar.gz'):
+                continue
+            archive_path = os.path.join(self.archive_dir, name)
+            try:
+                archives.append((os.path.getmtime(archive_path), archive_path))
+            except OSError:
+                # Evicted by another worker
+                pass
+        archives.sort(reverse=True)
+        for _, archive_path in archives[config.SOURCE_ARCHIVE_KEEP:]:
+            try:
+                os.remove(archive_path)
+            except OSError:
+                # Evicted by another worker
+                pass
+
+    @staticmethod
+    def _git(cwd, *args):
+        """
+        Helper function which runs a git command in cwd and returns its
+        output, raising SourceError if it fails
+        """
+        with open(os.devnull, 'w') as devnull:
+            try:
+                return subprocess.check_output(('git',) + args, cwd=cwd, stderr=devnull)
+            except (OSError, subprocess.CalledProcessError):
+                raise SourceError('git {} failed'.format(args[0]))
@@ -0,0 +1,165 @@
+# internal
+import config
+
+# external
+import paramiko
+
+# stdlib
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger(config.LOGGER_NAME)
+
+class SSHInfo:
+    """
+    Struct to hold everything needed to log in to a block's VM
+    """
+    def __init__(self, host, user, password, port, keyfile):
+        self.host = host
+        self.user = user
+        # Password for keyfile
+        self.password = password
+        self.port = int(port)
+        self.keyfile = keyfile
+
+class ConnectionTimings:
+    """
+    Struct to hold how long was spent connecting to a block's VM
+    and how long was spent running commands on it
+    """
+    def __init__(self):
+        self.connects = 0
+        self.connect_seconds = 0.0
+        self.commands = 0
+        self.command_seconds = 0.0
+
+class RugbyConnections:
+    """
+    Usage:
+        connections = RugbyConnections(resolve)
+        exit_status = connections.run('My App Server', 'npm test', output)
+        ...
+        connections.close()
+
+    Per build SSH connection manager. resolve(block_name) is called once per
+    block to look up its SSHInfo, and one authenticated paramiko transport
+    is then kept open to each block's VM for the rest of the build. Every
+    command is run on a new channel of that transport, so clone, install
+    and script commands only pay for connection setup once per VM.
+    """
+
+    def __init__(self, resolve):
+        """
+        resolve = Function which takes a block name and returns
+                  the SSHInfo of its VM
+        """
+        self.resolve = resolve
+
+        """
+        Private member variables
+            _clients = Connected paramiko SSHClient for each block
+            _infos   = SSHInfo for each block, looked up once
+            _timings = ConnectionTimings for each block
+            _locks   = Lock for each block, so a block's connection is
+                       only set up once even if used from several threads
+            _lock    = Lock guarding _locks
+        """
+        self._clients = {}
+        self._infos = {}
+        self._timings = {}
+        self._locks = {}
+        self._lock = Lock()
+
+    def run(self, block_name, remote_cmd, output, channels=None, input_fd=None, pty=True):
+        """
+        Method runs remote_cmd on a block's VM with a pty, writes its
+        output to output as it arrives, and returns its exit status.
+        While the command runs its channel is kept in channels under
+        block_name, so another thread can cancel it by closing it.
+
+        If input_fd is given, its contents are sent to the command's stdin
+        instead. No pty is used in that case, or if pty is False, so binary
+        data isn't mangled. Without a pty only stdout is written to output.
+        """
+        transport = self._transport(block_name)
+        timings = self._timings[block_name]
+
+        start = time.time()
+        channel = transport.open_session()
+        if channels != None:
+            channels[block_name] = channel
+        try:
+            # Forward our agent so private repos can be cloned
+            paramiko.agent.AgentRequestHandler(channel)
+            if input_fd == None and pty:
+                channel.get_pty()
+            elif input_fd != None:
+                channel.set_combine_stderr(True)
+            channel.exec_command(remote_cmd)
+            if input_fd != None:
+                while True:
+                    data = input_fd.read(65536)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                channel.shutdown_write()
+            while True:
+                data = channel.recv(4096)
+                if not data:
+                    break
+                output.write(data)
+            return channel.recv_exit_status()
+        finally:
+            if channels != None:
+                channels.pop(block_name, None)
+            channel.close()
+            timings.commands += 1
+            timings.command_seconds += time.time() - start
+
+    def get_timings(self):
+        """
+        Method returns the ConnectionTimings of every block
+            { "<block name>" : <ConnectionTimings> }
+        """
+        return dict(self._timings)
+
+    def close(self):
+        """
+        Method closes the connection to every VM
+        """
+        for client in self._clients.values():
+            client.close()
+        self._clients = {}
+
+    def _transport(self, block_name):
+        """
+        Helper function which returns the open transport to a block's VM,
+        connecting to it first if there isn't one or it has dropped
+        """
+        with self._lock:
+            block_lock = self._locks.setdefault(block_name, Lock())
+            self._timings.setdefault(block_name, ConnectionTimings())
+
+        with block_lock:
+            client = self._clients.get(block_name)
+            if client != None and client.get_transport() != None and client.get_transport().is_active():
+                return client.get_transport()
+
+            timings = self._timings[block_name]
+            start = time.time()
+            if block_name not in self._infos:
+                self._infos[block_name] = self.resolve(block_name)
+            ssh_info = self._infos[block_name]
+            client = paramiko.SSHClient()
+            # VM host keys change every time they are spawned
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(ssh_info.host, port=ssh_info.port, username=ssh_info.user,
+                           key_filename=ssh_info.keyfile, password=ssh_info.password,
+                           look_for_keys=False)
+            client.get_transport().set_keepalive(config.SSH_KEEPALIVE)
+            timings.connects += 1
+            timings.connect_seconds += time.time() - start
+
+            self._clients[block_name] = client
+            return client.get_transport()
@@ -11,3 +11,21 @@ class RugbyState(Enum):
     CLEANING_UP = 7
     ERROR = 8
     SUCCESS = 9
+    QUEUED = 10
+    SUPERSEDED = 11
+    CANCELLED = 12
+    TIMEOUT = 13
+
+# States a build never leaves
+FINISHED_STATES = [RugbyState.ERROR, RugbyState.SUCCESS, RugbyState.SUPERSEDED,
+                   RugbyState.CANCELLED, RugbyState.TIMEOUT]
+
+# Finished states which say whether a commit passed, as opposed to it
+# not being built to the end
+RESULT_STATES = [RugbyState.SUCCESS, RugbyState.ERROR, RugbyState.TIMEOUT]
+
+# Stages every block of a build goes through in order, and the state a
+# block is in while it is in or waiting for each. A build is in the
+# state of its least advanced block
+BLOCK_STAGES = [('boot', RugbyState.SPAWNING_VMS), ('clone', RugbyState.CLONING_SOURCE),
+                ('install', RugbyState.RUNNING_INSTALL), ('script', RugbyState.RUNNING_TESTS)]
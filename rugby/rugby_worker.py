@@ -1,21 +1,59 @@
 # internal
-from rugby_state import RugbyState
+from rugby_state import RugbyState, BLOCK_STAGES
 from rugby_loader import RugbyLoader
+from rugby_database import RugbyDatabase
+from rugby_network import RugbyNetwork
+from rugby_source import RugbySourceCache
+from rugby_install_cache import RugbyInstallCache
+from rugby_metrics import RugbyMetrics
+from rugby_log import LogSender, LineWriter
+from rugby_shards import split_tests, parse_timings
+from rugby_provider import new_provider, ProviderConnections, ProviderError
+from rugby_janitor import WORKER_PID_FILE, process_start_time
+from rugby_protocol import (state_msg, progress_msg, resources_msg, heartbeat_msg,
+                            msg_state, is_current, CANCEL)
 import config
 
-# external
-from vagrant import Vagrant
-from fabric.api import settings, env, sudo, hide, cd
-
 # stdlib
+from threading import Thread, Timer, Event, Lock, Condition
+from StringIO import StringIO
+import resource
+import pipes
+import uuid
 import errno
 import os
+import re
 import time
 import sys
 import shutil
+import traceback
+
+# Message sent to the parent when the build moves into each stage
+STAGE_MESSAGES = {
+    RugbyState.SPAWNING_VMS : "Starting up VMs and performing initial provisioning",
+    RugbyState.CLONING_SOURCE : "Cloning source into each VM",
+    RugbyState.RUNNING_INSTALL : "Running install commands",
+    RugbyState.RUNNING_TESTS : "Running test script commands"
+}
+
+# Prints how much memory is in use on a VM, counting swap, as
+#   rugby-mem 812000
+MEM_SAMPLE_CMD = ("awk '/^(MemTotal|MemFree|Buffers|Cached|SwapTotal|SwapFree):/ {m[$1] = $2} "
+                  "END {print \"rugby-mem\", m[\"MemTotal:\"] - m[\"MemFree:\"] - m[\"Buffers:\"] "
+                  "- m[\"Cached:\"] + m[\"SwapTotal:\"] - m[\"SwapFree:\"]}' /proc/meminfo")
+
+# Exception class that is thrown when a command can't be run, or
+# exits with a non zero status
+class CommandError(Exception):
+    pass
+
+# Exception class that is thrown when a command is stopped for running
+# past its block's command or phase timeout
+class CommandTimeoutError(CommandError):
+    pass
 
 class RugbyWorker:
-    def __init__(self, commit_id, clone_url, raw_url, rugby_root_dir, rugby_config_path):
+    def __init__(self, commit_id, clone_url, raw_url, rugby_root_dir, rugby_config_path, rugby_pool=None):
         """
         commit_id = Unique identifier for worker
         clone_url = URL from which to fetch source code from repo
@@ -23,24 +61,93 @@ class RugbyWorker:
         root_dir  = Base directory where worker should
                     create its own worker directory
         conf_path = Path to rugby configuration file
+        pool      = Optional RugbyPool to check out warm VMs from
         """
         self.commit_id = str(commit_id)
         self.root_dir = os.path.join(str(rugby_root_dir), self.commit_id)
         self.conf_path = str(rugby_config_path)
+        self.pool = rugby_pool
+        self.rugby_db = RugbyDatabase(str(rugby_root_dir))
+        self.network = RugbyNetwork(self.rugby_db)
+        self.metrics = RugbyMetrics(self.rugby_db)
+        self.source_cache = None
+        if config.SOURCE_CACHE_ENABLED:
+            self.source_cache = RugbySourceCache(self.rugby_db)
+        self.install_cache = None
+        if config.INSTALL_CACHE_ENABLED:
+            self.install_cache = RugbyInstallCache()
         
         """
         Private member variables
-            _state     = Current state of worker
-            _vagrant   = Vagrant Object which we use to interface
-                         with VMs
+            _state     = Current state of worker, while blocks are
+                         running the state of the least advanced one
+            _block_states = State of each block, SUCCESS once it
+                            has been through every stage
+                            { "<block name>" : <RugbyState> }
+            _state_lock = Lock guarding _block_states and _state,
+                          which every block's thread updates
+            _providers = RugbyProvider bringing up the machines of
+                         each block
+                         { "<block name>" : <RugbyProvider> }
             _clone_dir = Directory where source code should be cloned in VM
             _msg_pipe  = Connection Object which is used to send/recieve messages
                          with process that spawned this worker
-            _log_fd    = File descriptor where output to be logged should go
+            _log_fd    = Line buffered write end of the pipe output to be
+                         logged should go to, IE vagrant's
             _conf_obj  = Dict representation of rugby config 
+            _leases    = PoolLease objects checked out from pool, empty
+                         if VMs are being spawned for this build
+            _network_lease = NetworkLease for the subnet this build's VMs
+                             are on, None if pool VMs are being used
+            _env       = Environment variables set for every command run
+                         in a VM
+            _block_env = Extra environment variables for each block
+                         { "<block name>" : { "<name>" : "<value>" } }
+            _shard_results = Whether each shard passed its script
+                             { "<block name>" : True }
+            _log_sender = LogSender which batches log lines and sends
+                          them to the parent process
+            _log_reader = Thread which reads _log_fd's pipe into _log_sender
+            _msg_lock  = Lock guarding _msg_pipe, which log chunks are
+                         sent over from several threads
+            _connections = ProviderConnections passing each command on to
+                           its block's provider, IE over an SSH connection
+                           kept open to each VM
+            _phase     = State and start time of the phase being timed
+            _phase_started = When each block started its current stage,
+                             after waiting for depends_on and barriers
+                             { "<block name>" : <epoch> }
+            _running_phases = (cancelled, channels) of the blocks' stages
+                              while they run, so the build can be stopped
+            _stop      = (RugbyState, message) once the build has been
+                         cancelled or has run past its build timeout
+            _watchdog  = Timer which stops the build at its build timeout
+            _progress_at = When the build last changed state or a
+                           command started or ended
+            _block_usage = Most memory and CPUs each block used while
+                           running its install and script commands
+                           { "<block name>" : [<peak_mem_kb>, <peak_cpus>] }
         """
         self._state = RugbyState.STANDBY
-        self._vagrant = None
+        self._block_states = {}
+        self._state_lock = Lock()
+        self._providers = {}
+        self._leases = []
+        self._network_lease = None
+        self._env = {}
+        self._block_env = {}
+        self._shard_results = {}
+        self._log_sender = None
+        self._log_reader = None
+        self._msg_lock = Lock()
+        self._connections = ProviderConnections(self._providers)
+        self._phase = None
+        self._phase_started = {}
+        self._running_phases = []
+        self._stop = None
+        self._watchdog = None
+        self._progress_at = time.time()
+        self._block_usage = {}
         self._clone_dir = config.REPO_DIR
         self._clone_url = clone_url
         self._raw_url = raw_url
@@ -56,7 +163,7 @@ class RugbyWorker:
         """
         self._cleanup()
 
-    def __call__(self, msg_pipe, log_path=os.devnull):
+    def __call__(self, msg_pipe):
         """
         This method is run in a subprocess context. NOT in 
         the main rugby context. Therefore, things we set
@@ -67,13 +174,32 @@ class RugbyWorker:
         # be used to talk to parent process who spawned this
         # worker
         self._msg_pipe = msg_pipe
+        started_at = time.time()
+
+        # The parent sends a cancel message down the same pipe to
+        # stop the build
+        listener = Thread(target=self._listen)
+        listener.daemon = True
+        listener.start()
 
-        # Create fd from log_path which is where select output
-        # from worker will be sent. Output is unbuffered
+        # Lets the parent tell a wedged worker from a busy one
+        pulse = Thread(target=self._pulse)
+        pulse.daemon = True
+        pulse.start()
+
+        # Output to be logged is sent to the parent in batches of
+        # timestamped lines, instead of being written to a log file
+        # a byte at a time. Select output from the worker goes
+        # through a pipe, so output of subprocesses is caught too
+        self._log_sender = LogSender(self.commit_id, self._send)
         try:
-            self._log_fd = open(log_path, 'w', 0)
+            read_fd, write_fd = os.pipe()
+            self._log_fd = os.fdopen(write_fd, 'w', 1)
         except Exception:
-            self._suicide("Couldn't open {} for piping worker output".format(log_path))
+            self._suicide("Couldn't create pipe for worker output")
+        self._log_reader = Thread(target=self._read_log, args=(read_fd,))
+        self._log_reader.daemon = True
+        self._log_reader.start()
 
         # Save orginal stdout and stderr
         orig_stdout = sys.stdout
@@ -83,6 +209,7 @@ class RugbyWorker:
         self._state = RugbyState.INITIALIZING
         self._send_msg("Creating VM Directory")
         self._initialization()
+        self._start_watchdog(started_at)
         
         # If we are in DEBUG_MODE, we probably also want to log the
         # initial bring up of VMs, eventhough this is info our user
@@ -90,31 +217,21 @@ class RugbyWorker:
         if config.DEBUG_MODE == True:
             sys.stdout = sys.stderr = self._log_fd
         
-        # Spawn VMs
+        # Each block boots, has the source copied in, runs its install
+        # commands and then its test commands, moving on as soon as it
+        # and the blocks it depends on are ready. The build is in the
+        # state of the least advanced block
+        for vm in self._conf_obj:
+            self._block_states[vm['name']] = RugbyState.SPAWNING_VMS
         self._state = RugbyState.SPAWNING_VMS
-        self._send_msg("Starting up VMs and performing initial provisioning")
-        self._spawn_vms()
-
-        # Copy repo source code into VM
-        self._state = RugbyState.CLONING_SOURCE
-        self._send_msg("Cloning source into each VM")
-        self._clone_source()
-
-        # Log output from user defined actions. If DEBUG_MODE is on,
-        # then output is already being logged and we don't have to do
-        # anything
-        if config.DEBUG_MODE == False:
-            sys.stdout = sys.stderr = self._log_fd
-
-        # Run any install commands
-        self._state = RugbyState.RUNNING_INSTALL
-        self._send_msg("Running install commands")
-        self._install_cmds()
-
-        # Run test commands
-        self._state = RugbyState.RUNNING_TESTS
-        self._send_msg("Running test script commands")
-        self._script_cmds()
+        self._send_msg(STAGE_MESSAGES[self._state])
+        if self._leases:
+            # Pool VMs are already up and provisioned
+            self._send_msg("Using warm VMs from pool")
+        self._run_blocks([self._boot_block(), self._clone_block(),
+                          self._install_block(), self._script_block()],
+                         self._finish_blocks)
+        self._check_stop()
 
         # Set stdout and stderr back to what they were originally
         sys.stdout = orig_stdout
@@ -139,7 +256,8 @@ class RugbyWorker:
         Helper function for running initialization
         tasks. 
             - Create Directory for VMs
-            - Generate Vagrantfile from rugby conf
+            - Set up a provider for the blocks on each,
+              IE generate Vagrantfile from rugby conf
         """
         # Create directory for storing VM data
         try:
@@ -152,181 +270,899 @@ class RugbyWorker:
                 pass    
             
             self._suicide("Failed to create root directory")
-            
-        # Parse rugby config and generate
-        # Vagrantfile into root dir
+
+        # Lets the janitor kill this worker if it outlives rugby
+        try:
+            with open(os.path.join(self.root_dir, WORKER_PID_FILE), 'w') as pid_file:
+                pid_file.write('{} {}'.format(os.getpid(), process_start_time(os.getpid())))
+        except IOError:
+            self._suicide("Failed to write worker pid file")
+
+        # Parse rugby config
         try:
             rugby_loader = RugbyLoader(self.commit_id, self.conf_path)
-            rugby_loader.render_vagrant(self.root_dir, self._raw_url)
         except Exception:
             raise
-            self._suicide("Failed to generate Vagrantfile from config")
+            self._suicide("Failed to load rugby config")
 
         # Set internal conf_obj to Dict version of rugby config
         self._conf_obj = rugby_loader.rugby_obj
 
-        # Set internal vagrant object, initializing
-        # it to self.root_dir
+        # VMs are sized from what their blocks used in earlier builds
+        if config.RIGHTSIZE_ENABLED:
+            rugby_loader.use_usage(self.rugby_db.get_block_usage(self._clone_url))
+
+        # Try to use warm VMs from the pool, every block has to be
+        # served or none are. Blocks with their own provisioning config
+        # or their own memory and cpus need a fresh VM since pool VMs
+        # were provisioned without them, at the pool's size
+        providers = [RugbyWorker.provider_name(vm) for vm in self._conf_obj]
+        if (self.pool != None and providers == ['vagrant'] * len(providers) and
+            not any(field in vm for vm in self._conf_obj for field in ['config', 'memory', 'cpus'])):
+            services = [(vm['service']['group'], vm['service']['type']) for vm in self._conf_obj]
+            self._leases = self.pool.checkout(services, self.commit_id) or []
+
+        if self._leases:
+            for vm, lease in zip(self._conf_obj, self._leases):
+                # Pool VMs already have their own address
+                vm['ip'] = lease.ip
+            try:
+                provider = new_provider('vagrant', self.commit_id, self.root_dir, self._conf_obj,
+                                        leases=self._leases)
+            except Exception:
+                self._suicide("Failed to instantiate vagrant object for pool VM")
+            for vm in self._conf_obj:
+                self._providers[vm['name']] = provider
+            self._env = RugbyWorker.address_env(self._conf_obj)
+            return
+
+        # Give each block its own address on a subnet only this build uses
         try:
-            self._vagrant = Vagrant(self.root_dir, quiet_stdout=False, quiet_stderr=False)
+            self._network_lease = self.network.lease(self.commit_id)
+            rugby_loader.use_network(self._network_lease)
         except Exception:
-            self._suicide("Failed to instantiate internal vagrant object")
+            self._suicide("Failed to lease a network for VMs")
+        self._env = RugbyWorker.address_env(self._conf_obj)
+
+        # Each provider looks after the blocks which picked it, vagrant
+        # generates a Vagrantfile for its blocks into root dir
+        for name in sorted(set(providers)):
+            vms = [vm for vm in self._conf_obj if RugbyWorker.provider_name(vm) == name]
+            kwargs = {}
+            if name == 'vagrant':
+                kwargs['render'] = rugby_loader.render_vagrant
+            try:
+                provider = new_provider(name, self.commit_id, self.root_dir, vms, self._network_lease, **kwargs)
+                provider.create(self._raw_url)
+            except Exception:
+                self._suicide("Failed to set up {} provider".format(name))
+            for vm in vms:
+                self._providers[vm['name']] = provider
 
-    def _spawn_vms(self):
+    def _boot_block(self):
         """
-        Helper function which executes vagrant
-        to bring up VM's and provisions them with 
-        our basic packages (defined in Vagrantfile)
+        Helper function which returns a function for _run_blocks that has
+        a block's provider bring up its machine and provision it with our
+        basic packages (defined in Vagrantfile)
         """
-        self._send_msg("Starting up VMs and performing initial provisioning")
-        
-        # Start VMs
+        def boot_block(vm, block_log, channels, cancelled):
+            try:
+                self._providers[vm['name']].up_block(vm['name'])
+            except Exception as e:
+                # vagrant and docker say what went wrong in the exception,
+                # so it goes in the build log
+                block_log.write(traceback.format_exc())
+                raise ProviderError('Failed to bring up {}: {}'.format(vm['name'], e))
+        return boot_block
+
+    def _clone_block(self):
+        """
+        Helper function which returns a function for _run_blocks that
+        copies the source code of commit_id into a block's VM. With the
+        source cache the commit is archived on the host while the blocks
+        boot, and pushed to each VM, otherwise each VM git clones the
+        repository itself. A VM also git clones it if the cache fails.
+        """
+        git_clone_cmd = 'git clone {0} {1} && cd {1} && git checkout -q {2}'.format(
+            self._clone_url, self._clone_dir, self.commit_id)
+        git_clone = self._cmds_block([git_clone_cmd], '.')
+        if self.source_cache == None:
+            return git_clone
+
+        archive = {}
+        fetched = Event()
+
+        def fetch_source():
+            try:
+                archive['path'] = self.source_cache.archive(self._clone_url, self.commit_id)
+            except Exception as e:
+                archive['error'] = e
+            finally:
+                fetched.set()
+
+        fetcher = Thread(target=fetch_source)
+        fetcher.daemon = True
+        fetcher.start()
+
+        untar_cmd = 'mkdir -p {0} && tar xzf - -C {0}'.format(self._clone_dir)
+
+        def clone_block(vm, block_log, channels, cancelled):
+            while not fetched.wait(1):
+                if cancelled.is_set():
+                    return
+            # The cache is only an optimization, so the VM clones the
+            # repo itself if the commit couldn't be archived, or the
+            # archive was evicted before it was pushed
+            if 'path' not in archive:
+                block_log.write('Failed to fetch source into cache, cloning instead: {!r}\n'.format(archive['error']))
+                git_clone(vm, block_log, channels, cancelled)
+                return
+            try:
+                self._run_cmd(vm, untar_cmd, '.', block_log, channels, archive['path'])
+            except CommandTimeoutError:
+                raise
+            except (CommandError, IOError) as e:
+                if cancelled.is_set():
+                    raise
+                block_log.write('Failed to copy source from cache, cloning instead: {}\n'.format(e))
+                self._run_cmd(vm, 'rm -rf {}'.format(self._clone_dir), '.', block_log, channels)
+                git_clone(vm, block_log, channels, cancelled)
+        return clone_block
+
+    def _install_block(self):
+        """
+        Helper function which returns a function for _run_blocks that
+        runs a block's 'install' commands. Blocks with 'cache_dirs'
+        restore those directories from the install cache instead
+        when nothing their install depends on has changed
+        """
+        run_install = self._cmds_block(lambda vm: vm.get('install', []), self._clone_dir)
+
+        def install_block(vm, block_log, channels, cancelled):
+            if self.install_cache == None or 'cache_dirs' not in vm:
+                run_install(vm, block_log, channels, cancelled)
+                return
+
+            fingerprint = self._install_fingerprint(vm, block_log, channels)
+            if self.install_cache.has(fingerprint):
+                block_log.write('Restoring install from cache {}\n'.format(fingerprint))
+                # The archive may have been evicted since has(), in which
+                # case the install is run instead
+                try:
+                    self._run_cmd(vm, 'tar xzf - -C /', '/', block_log, channels,
+                                  self.install_cache.path(fingerprint))
+                    self.rugby_db.record_install_cache(self.commit_id, vm['name'], fingerprint, True)
+                    return
+                except CommandTimeoutError:
+                    raise
+                except (CommandError, IOError) as e:
+                    if cancelled.is_set():
+                        raise
+                    block_log.write('Failed to restore install from cache, running it instead: {}\n'.format(e))
+            self.rugby_db.record_install_cache(self.commit_id, vm['name'], fingerprint, False)
+
+            run_install(vm, block_log, channels, cancelled)
+            if cancelled.is_set():
+                return
+
+            # Save the directories install filled in for later builds. The
+            # cache is only an optimization, so the build carries on if
+            # they can't be saved, IE because one of them doesn't exist
+            cache_dirs = [os.path.join(self._clone_dir, cache_dir).lstrip('/') for cache_dir in vm['cache_dirs']]
+            export_cmd = 'tar czf - -C / {}'.format(' '.join(pipes.quote(cache_dir) for cache_dir in cache_dirs))
+            try:
+                with self.install_cache.store(fingerprint) as output:
+                    self._run_cmd(vm, export_cmd, '/', block_log, channels, output=output)
+            except CommandTimeoutError:
+                raise
+            except (CommandError, IOError, OSError) as e:
+                if cancelled.is_set():
+                    raise
+                block_log.write('Failed to save install to cache: {}\n'.format(e))
+
+        return install_block
+
+    def _script_block(self):
+        """
+        Helper function which returns a function for _run_blocks that
+        runs a block's 'script' commands. Shards of a block with
+        'parallelism' each run the script with their share of the tests
+        """
+        run_script = self._cmds_block(lambda vm: vm.get('script', []), self._clone_dir)
+
+        def script_block(vm, block_log, channels, cancelled):
+            if 'shard_of' not in vm:
+                run_script(vm, block_log, channels, cancelled)
+                return
+            self._run_shard(vm, run_script, block_log, channels, cancelled)
+
+        return script_block
+
+    def _run_shard(self, vm, run_script, block_log, channels, cancelled):
+        """
+        Helper function which runs the script on one shard of a block with
+        RUGBY_SHARD_INDEX and RUGBY_SHARD_TOTAL set. If the block has
+        'shard_tests', the shard's tests are in RUGBY_SHARD_TESTS, and how
+        long they took is recorded afterwards to balance later builds
+        """
+        env = {'RUGBY_SHARD_INDEX' : str(vm['shard_index']),
+               'RUGBY_SHARD_TOTAL' : str(vm['shard_total'])}
+        tests = None
+        if 'shard_tests' in vm:
+            tests = self._shard_tests(vm, block_log, channels)
+            env['RUGBY_SHARD_TESTS'] = ' '.join(tests)
+            env['RUGBY_SHARD_TIMINGS'] = '/tmp/rugby-shard-timings-{}'.format(uuid.uuid4().hex)
+        self._block_env[vm['name']] = env
+
+        block_log.write('Running shard {} of {} of {}\n'.format(vm['shard_index'] + 1, vm['shard_total'], vm['shard_of']))
+        started_at = time.time()
         try:
-            self._vagrant.up()
+            run_script(vm, block_log, channels, cancelled)
         except Exception:
-            self._suicide("Failed to complete vagrant up")
+            self._shard_results[vm['name']] = False
+            raise
+        if cancelled.is_set():
+            return
+        self._shard_results[vm['name']] = True
+
+        if tests:
+            self._record_test_timings(vm, tests, env['RUGBY_SHARD_TIMINGS'],
+                                      time.time() - started_at, block_log, channels)
 
-    def _clone_source(self):
+    def _shard_tests(self, vm, block_log, channels):
         """
-        Helper function which git clones repository source
-        code into each VM.
+        Helper function which lists the tests matching a block's
+        'shard_tests' glob, and returns the ones this shard should run.
+        Every shard lists them itself and comes to the same split
         """
-        for vm in self._conf_obj:
-            # VM info needed to run command
-            keyfile      = self._vagrant.keyfile(vm['name'])
-            user         = self._vagrant.user(vm['name'])
-            port         = self._vagrant.port(vm['name'])
-            host         = self._vagrant.hostname(vm['name'])
-            # Password for keyfile which should always be by default
-            # 'vagrant'
-            key_password = 'vagrant' 
+        listing = StringIO()
+        list_cmd = "shopt -s globstar nullglob; printf '%s\\n' {}".format(vm['shard_tests'])
+        self._run_cmd(vm, list_cmd, self._clone_dir, block_log, channels, output=listing)
+        tests = [test for test in listing.getvalue().splitlines() if test]
+        timings = self.rugby_db.get_test_timings(self._clone_url, vm['shard_of'])
+        return split_tests(tests, vm['shard_total'], timings)[vm['shard_index']]
 
-            # Clone repo
-            git_clone_cmd = 'git clone {} {}'.format(self._clone_url, self._clone_dir)
-            self._run_cmd(git_clone_cmd, '.', host, user, key_password, port, keyfile)
+    def _record_test_timings(self, vm, tests, timings_path, duration, block_log, channels):
+        """
+        Helper function which records how long each of a shard's tests
+        took. Timings the script wrote to timings_path are used, otherwise
+        the shard's run time is split evenly over its tests
+        """
+        output = StringIO()
+        try:
+            self._run_cmd(vm, 'cat {0} 2>/dev/null; rm -f {0}; true'.format(timings_path),
+                          '/', block_log, channels, output=output)
+        except CommandError:
+            pass
+        timings = parse_timings(output.getvalue())
+        if not timings:
+            timings = dict((test, duration / len(tests)) for test in tests)
+        try:
+            self.rugby_db.record_test_timings(self._clone_url, vm['shard_of'], timings, time.time())
+        except Exception:
+            pass
 
-    def _install_cmds(self):
+    def _finish_blocks(self):
         """
-        Helper function which runs all 'install' commands
-        in config object
+        Helper function which is called once every block is done,
+        whether or not the build failed
         """
-        for vm in self._conf_obj:
-            if 'install' in vm.keys():
-                # VM info needed to run command
-                keyfile      = self._vagrant.keyfile(vm['name'])
-                user         = self._vagrant.user(vm['name'])
-                port         = self._vagrant.port(vm['name'])
-                host         = self._vagrant.hostname(vm['name'])
-                # Password for keyfile which should always be by default
-                # 'vagrant'
-                key_password = 'vagrant'
+        self._summarize_shards()
+        self._record_usage()
 
-                # Run commands
-                for cmd in vm['install']:
-                    self._run_cmd(cmd, self._clone_dir, host, user, key_password, port, keyfile) 
+    def _record_usage(self):
+        """
+        Helper function which records the most memory and CPUs each
+        block on a Vagrant VM used, for sizing its VMs in later builds.
+        Shards of a block are recorded as the block. Machines of other
+        providers report the host's memory, so aren't recorded
+        """
+        if not config.RIGHTSIZE_ENABLED:
+            return
+        usage = {}
+        for vm in self._conf_obj:
+            if vm['name'] not in self._block_usage or RugbyWorker.provider_name(vm) != 'vagrant':
+                continue
+            block_name = vm.get('shard_of', vm['name'])
+            peaks = [self._block_usage[vm['name']], usage.get(block_name, [None, None])]
+            usage[block_name] = [max(peak[0] for peak in peaks), max(peak[1] for peak in peaks)]
+        for block_name, (peak_mem_kb, peak_cpus) in usage.iteritems():
+            try:
+                self.rugby_db.record_block_usage(self._clone_url, block_name, self.commit_id,
+                                                 peak_mem_kb, peak_cpus, time.time())
+            except Exception:
+                pass
 
-    def _script_cmds(self):
+    def _summarize_shards(self):
         """
-        Helper function which runs all 'script' commands
-        in config object
+        Helper function which logs how many shards of each
+        sharded block passed
         """
+        totals = {}
         for vm in self._conf_obj:
-            if 'script' in vm.keys():
-                # VM info needed to run command
-                keyfile      = self._vagrant.keyfile(vm['name'])
-                user         = self._vagrant.user(vm['name'])
-                port         = self._vagrant.port(vm['name'])
-                host         = self._vagrant.hostname(vm['name'])
-                # Password for keyfile which should always be by default
-                # 'vagrant'
-                key_password = 'vagrant'
-
-                # Run commands
-                for cmd in vm['script']:
-                    self._run_cmd(cmd, self._clone_dir, host, user, key_password, port, keyfile)
-        
-    def _run_cmd(self, cmd, location, host, user, password, port, keyfile):
+            if 'shard_of' in vm:
+                passed, total = totals.get(vm['shard_of'], (0, 0))
+                totals[vm['shard_of']] = (passed + int(self._shard_results.get(vm['name'], False)), total + 1)
+        if self._log_fd != None:
+            for block_name, (passed, total) in sorted(totals.iteritems()):
+                self._log_fd.write('{}: {} of {} shards passed\n'.format(block_name, passed, total))
+
+    def _install_fingerprint(self, vm, block_log, channels):
         """
-        Helper function which executes a cmd on a remote
-        host.
+        Helper function which returns the install cache key of a block.
+        It covers the block's service, install commands and cache_dirs,
+        along with the contents of its cache_files and
+        config.INSTALL_CACHE_FILES, which are hashed inside the VM
         """
+        cache_files = config.INSTALL_CACHE_FILES + vm.get('cache_files', [])
+        hash_cmd = 'for f in {}; do echo "$f"; cat "$f" 2>/dev/null; done | sha1sum'.format(
+            ' '.join(pipes.quote(cache_file) for cache_file in cache_files))
+        files_digest = StringIO()
+        self._run_cmd(vm, hash_cmd, self._clone_dir, block_log, channels, output=files_digest)
+        return RugbyInstallCache.fingerprint(vm, files_digest.getvalue().split()[0])
 
-        # Set passphrase/sudo password so we arn't prompted
-        # should be default by 'vagrant'
-        env.password = password 
+    def _cmds_block(self, cmds, location, input_path=None):
+        """
+        Helper function which returns a function for _run_blocks that runs
+        a list of commands on a block's VM, sending each the contents of
+        input_path if given. cmds is either the list itself or a function
+        which takes a block and returns its list
+        """
+        def run_cmds(vm, block_log, channels, cancelled):
+            block_cmds = cmds(vm) if callable(cmds) else cmds
+            for cmd in block_cmds:
+                if cancelled.is_set():
+                    return
+                self._run_cmd(vm, cmd, location, block_log, channels, input_path)
+        return run_cmds
 
-        # Disable fabric output prefixes IE ip and output stream info
-        env.output_prefix = False
+    def _run_blocks(self, stage_fns, after=None):
+        """
+        Helper function which takes every block through BLOCK_STAGES,
+        calling stage_fns[i](vm, block_log, channels, cancelled) to run the
+        i'th stage on a block. With config.PARALLEL_BLOCKS each block goes
+        through the stages in its own thread, starting each one as soon as
+        it has finished the stage before and the blocks in its 'depends_on'
+        have finished this one, so it never waits on an unrelated slow
+        block. A stage listed in a block's 'barriers' also waits for every
+        block to finish the stage before. Otherwise each stage is run on
+        every block in turn before the next one starts. As soon as one
+        block fails the commands running on the other blocks are
+        cancelled. after is called once every block is done, before any
+        failure is reported.
+        """
+        cancelled = Event()
+        channels = {}
+        errors = []
+        # How many stages each block has finished
+        finished = dict((vm['name'], 0) for vm in self._conf_obj)
+        progress = Condition()
+        self._running_phases.append((cancelled, channels))
+        self._check_stop()
 
-        # Prevent fabric from kicking us out from the script when
-        # a command fails
-        env.warn_only = True
+        def ready(vm, index):
+            if any(finished[dependency] <= index for dependency in vm.get('depends_on', [])):
+                return False
+            if BLOCK_STAGES[index][0] in vm.get('barriers', []):
+                return all(count >= index for count in finished.values())
+            return True
 
-        with settings(hide('aborts','warnings'),
-                      cd(location),
-                      key=keyfile,
-                      user=user, 
-                      port=port, 
-                      host_string=host, 
-                      disable_known_hosts='True', 
-                      forward_agent='True',
-                      abort_on_prompts='True'):
-            
-            return_obj = sudo(cmd)
+        def run_stage(vm, index):
+            state = BLOCK_STAGES[index][1]
+            with progress:
+                while not ready(vm, index):
+                    if cancelled.is_set():
+                        return False
+                    progress.wait(1)
+            if cancelled.is_set():
+                return False
+
+            self._set_block_state(vm['name'], state)
+            # Tagged with the block's state, like the worker's own output
+            block_log = self._block_log(vm, state)
+            try:
+                self._phase_started[vm['name']] = time.time()
+                stage_fns[index](vm, block_log, channels, cancelled)
+            except Exception as e:
+                if not cancelled.is_set():
+                    errors.append(e)
+                    cancelled.set()
+                    # Stop whatever the other blocks are running
+                    for channel in channels.values():
+                        channel.close()
+                return False
+            finally:
+                block_log.close()
+            if cancelled.is_set():
+                return False
+
+            with progress:
+                finished[vm['name']] += 1
+                progress.notify_all()
+            return True
 
-            # If command failed, we should bail
-            if return_obj.failed == True:
-                self._suicide('Command \'{}\' failed to run'.format(cmd))
+        def run_block(vm):
+            for index in range(len(BLOCK_STAGES)):
+                if not run_stage(vm, index):
+                    return
+            self._set_block_state(vm['name'], RugbyState.SUCCESS)
 
+        if config.PARALLEL_BLOCKS:
+            threads = [Thread(target=run_block, args=(vm,)) for vm in self._conf_obj]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        else:
+            # Config is validated to have no dependency cycles, and
+            # blocks are run in an order which respects depends_on
+            ordered = RugbyLoader.dependency_order(self._conf_obj)
+            for index in range(len(BLOCK_STAGES)):
+                for vm in ordered:
+                    if not run_stage(vm, index):
+                        break
+                if cancelled.is_set():
+                    break
+
+        self._running_phases.remove((cancelled, channels))
+        if after != None:
+            after()
+
+        self._check_stop()
+        if errors:
+            if isinstance(errors[0], CommandTimeoutError):
+                self._suicide(str(errors[0]), RugbyState.TIMEOUT)
+            self._suicide(str(errors[0]))
+
+    def _set_block_state(self, block_name, state):
+        """
+        Helper function which moves a block to state, and the build to the
+        state of its least advanced block, telling the parent if that
+        changed. Output from user defined actions is logged once every
+        block has its source, or from the start if DEBUG_MODE is on
+        """
+        stage_states = [stage_state for _, stage_state in BLOCK_STAGES]
+        with self._state_lock:
+            self._block_states[block_name] = state
+            running = [block_state for block_state in self._block_states.values()
+                       if block_state in stage_states]
+            if not running:
+                return
+            build_state = min(running, key=stage_states.index)
+            if build_state == self._state:
+                return
+            self._state = build_state
+            if build_state == RugbyState.RUNNING_INSTALL and config.DEBUG_MODE == False:
+                sys.stdout = sys.stderr = self._log_fd
+            self._send_msg(STAGE_MESSAGES[build_state])
+
+    def _block_log(self, vm, phase):
+        """
+        Helper function which returns the log stream for commands run
+        on a block's VM during phase, the RugbyState of the stage it is in
+        """
+        if self._log_sender == None:
+            return open(os.devnull, 'w')
+        return LineWriter(self._log_sender, vm['name'], lambda: phase)
+
+    def _read_log(self, read_fd):
+        """
+        Helper function run in its own thread, which reads everything
+        written to _log_fd and passes it on to _log_sender line by line
+        """
+        log_writer = LineWriter(self._log_sender, None, lambda: self._state)
+        while True:
+            data = os.read(read_fd, 65536)
+            if not data:
+                break
+            log_writer.write(data)
+        log_writer.close()
+        os.close(read_fd)
+
+    def _run_cmd(self, vm, cmd, location, block_log, channels, input_path=None, output=None):
+        """
+        Helper function which executes a cmd on a block's VM as root,
+        streaming its output to block_log, and input_path to its stdin
+        if given. If output is given the command's stdout is written
+        there instead, untouched by a pty. The open channel is kept in
+        channels while the command runs so it can be cancelled. Raises
+        CommandError if the command fails.
+
+        Commands are run over the build's ProviderConnections, which hand
+        each block's commands to its provider's connections, IE SSH for
+        vagrant, docker exec for container or the fake ones. Not Fabric,
+        since Fabric keeps its connection settings in a process wide env
+        and can't be used from several threads at once.
+        """
+        env = dict(self._env)
+        env.update(self._block_env.get(vm['name'], {}))
+        exports = ''.join('export {}={} && '.format(name, pipes.quote(value))
+                          for name, value in sorted(env.iteritems()))
+        script = '{}cd {} && {}'.format(exports, location, cmd)
+
+        # Have bash write the command's CPU time to stats_path, so it can
+        # be recorded along with the wall time
+        stats_path = None
+        if config.COMMAND_METRICS and output == None:
+            stats_path = '/tmp/rugby-stats-{}'.format(uuid.uuid4().hex)
+            # Memory is sampled in the background while it runs as well,
+            # since it may have given back what it used by the time it
+            # exits. The sampler is detached so a bare `wait` in the
+            # command doesn't wait for it, and stops once stats_path.run
+            # is removed or the shell is gone. The command runs in a
+            # subshell, so one which calls `exit` still gets here
+            sampler = ('while [ -e {0}.run ] && kill -0 $$; do {1}; sleep {2}; done '
+                       '> {0}.mem 2> /dev/null < /dev/null').format(
+                stats_path, MEM_SAMPLE_CMD, config.RIGHTSIZE_SAMPLE_SECONDS)
+            script = ('touch {0}.run; ( ( {1} ) & ); ( {2}\n); rugby_status=$?; rm -f {0}.run; '
+                      'times > {0}; exit $rugby_status').format(stats_path, sampler, script)
+        remote_cmd = self._providers[vm['name']].command(script)
+
+        # Whichever of the block's command and phase timeouts
+        # comes first
+        timeout, timeout_name, limit = self._command_timeout(vm)
+        timeout_msg = 'Command \'{}\' on {} ran past its {} timeout of {}s'.format(cmd, vm['name'], timeout_name, limit)
+        if timeout != None and timeout <= 0:
+            raise CommandTimeoutError(timeout_msg)
+        finished = Event()
+        timed_out = Event()
+        if timeout != None and channels != None:
+            watchdog = Thread(target=RugbyWorker._expire_command, args=(vm['name'], channels, timeout, finished, timed_out))
+            watchdog.daemon = True
+            watchdog.start()
+
+        block_log.write('$ {}\n'.format(cmd))
+        block_state = self._block_states[vm['name']]
+        self._progress(progress_msg(self.commit_id, vm['name'], block_state, cmd))
+        input_fd = None
+        exit_status = -1
+        started_at = time.time()
+        try:
+            if input_path != None:
+                input_fd = open(input_path, 'rb')
+            exit_status = self._connections.run(vm['name'], remote_cmd, output or block_log, channels,
+                                                input_fd, pty=output == None)
+        except Exception:
+            if timed_out.is_set():
+                raise CommandTimeoutError(timeout_msg)
+            raise CommandError('Command \'{}\' failed to run on {}'.format(cmd, vm['name']))
+        finally:
+            finished.set()
+            if input_fd != None:
+                input_fd.close()
+            self._progress(progress_msg(self.commit_id, vm['name'], block_state, cmd,
+                                        exit_status, time.time() - started_at))
+
+        if timed_out.is_set():
+            raise CommandTimeoutError(timeout_msg)
+
+        if stats_path != None:
+            duration = time.time() - started_at
+            cpu_seconds, mem_used_kb, peak_mem_kb = self._command_stats(vm, stats_path)
+            self.metrics.record_command(self.commit_id, vm['name'], str(block_state), cmd,
+                                        started_at, duration, exit_status, cpu_seconds, mem_used_kb)
+            self._send(resources_msg(self.commit_id, vm['name'], cpu_seconds, mem_used_kb))
+            if block_state in [RugbyState.RUNNING_INSTALL, RugbyState.RUNNING_TESTS]:
+                self._note_usage(vm, duration, cpu_seconds, peak_mem_kb)
+
+        # If command failed, we should bail
+        if exit_status != 0:
+            raise CommandError('Command \'{}\' failed to run on {}'.format(cmd, vm['name']))
+
+    def _command_timeout(self, vm):
+        """
+        Helper function which returns how many seconds the next command on
+        a block may run for, which timeout that is, and its limit, as
+        [seconds, name, limit]. seconds is None if there is no limit
+        """
+        now = time.time()
+        timeouts = []
+        command_timeout = vm.get('command_timeout', config.COMMAND_TIMEOUT)
+        if command_timeout != None:
+            timeouts.append((command_timeout, 'command', command_timeout))
+        phase_timeout = vm.get('phase_timeout', config.PHASE_TIMEOUT)
+        if phase_timeout != None:
+            phase_started = self._phase_started.get(vm['name'], now)
+            timeouts.append((phase_started + phase_timeout - now, 'phase', phase_timeout))
+        if not timeouts:
+            return None, None, None
+        return min(timeouts)
+
+    @staticmethod
+    def _expire_command(block_name, channels, timeout, finished, timed_out):
+        """
+        This method is run in its own thread for each command with a
+        timeout. Unless the command finishes within timeout seconds, its
+        channel is closed, which makes the command return straight away.
+        The channel is closed again until the command returns in case it
+        hadn't been opened yet
+        """
+        if finished.wait(timeout):
+            return
+        timed_out.set()
+        while not finished.is_set():
+            channel = channels.get(block_name)
+            if channel != None:
+                channel.close()
+            finished.wait(1)
+
+    def _command_stats(self, vm, stats_path):
+        """
+        Helper function which returns the CPU seconds used by the command
+        which wrote stats_path, how much memory is in use on its VM, and
+        the most memory the VM needed while it ran, counting swap, as
+        [cpu_seconds, mem_used_kb, peak_mem_kb]. Any of them is None if
+        it can't be read
+        """
+        stats = StringIO()
+        try:
+            stats_cmd = self._providers[vm['name']].command(
+                'cat {0} {0}.mem; rm -f {0} {0}.mem {0}.run; cat /proc/meminfo'.format(stats_path))
+            self._connections.run(vm['name'], stats_cmd, stats, pty=False)
+        except Exception:
+            return None, None, None
+
+        cpu_seconds = None
+        samples = []
+        meminfo = {}
+        for line in stats.getvalue().splitlines():
+            # Second line of `times` is the user and system time of children
+            #   0m1.250s 0m0.310s
+            times = re.findall(r'(\d+)m([\d.]+)s', line)
+            if len(times) == 2:
+                cpu_seconds = sum(int(minutes) * 60 + float(seconds) for minutes, seconds in times)
+            elif line.startswith('rugby-mem '):
+                samples.append(int(line.split()[1]))
+            elif ':' in line:
+                name, value = line.split(':', 1)
+                meminfo[name] = int(value.split()[0])
+
+        mem_used_kb = None
+        if 'MemTotal' in meminfo:
+            mem_used_kb = meminfo['MemTotal'] - sum(meminfo.get(name, 0) for name in ['MemFree', 'Buffers', 'Cached'])
+            samples.append(mem_used_kb + meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0))
+        return cpu_seconds, mem_used_kb, max(samples) if samples else None
+
+    def _note_usage(self, vm, duration, cpu_seconds, peak_mem_kb):
+        """
+        Helper function which raises a block's peak memory and CPUs to
+        what a command it just ran used. CPUs are the CPU seconds of the
+        command over the seconds it ran for, IE 2 for a command which
+        kept two cores busy
+        """
+        peaks = self._block_usage.setdefault(vm['name'], [None, None])
+        if peak_mem_kb != None:
+            peaks[0] = max(peaks[0], peak_mem_kb)
+        if cpu_seconds != None and duration >= config.RIGHTSIZE_MIN_COMMAND_SECONDS:
+            peaks[1] = max(peaks[1], cpu_seconds / duration)
+
+    @staticmethod
+    def provider_name(vm):
+        """
+        This method returns the name of the provider a block runs on.
+        config.FAKE_VAGRANT puts every block on the fake provider
+        """
+        if config.FAKE_VAGRANT:
+            return 'fake'
+        return vm.get('provider', config.DEFAULT_PROVIDER)
+
+    @staticmethod
+    def address_env(conf_obj):
+        """
+        This method takes a rugby config object whose VMs have been given
+        addresses, and returns environment variables exposing them to
+        commands run in the VMs
+
+            RUGBY_IP_<BLOCK NAME> = address of that block
+            RUGBY_<GROUP>_IP      = address of the first block of that group
+        """
+        address_env = {}
+        for vm in conf_obj:
+            block_name = re.sub('[^A-Z0-9]+', '_', vm['name'].upper()).strip('_')
+            address_env['RUGBY_IP_' + block_name] = vm['ip']
+            group_var = 'RUGBY_{}_IP'.format(vm['service']['group'].upper())
+            address_env.setdefault(group_var, vm['ip'])
+        return address_env
 
     def _send_msg(self, msg):
         """
-        Helper function for writing to self.msg_pipe.
-        Appends meta data needed to identify worker
+        Helper function which tells the parent process the worker's
+        state has changed, see rugby_protocol
+        """
+        # Time how long was spent in each state
+        if self._phase == None or self._phase[0] != self._state:
+            now = time.time()
+            if self._phase != None:
+                try:
+                    self.metrics.record_phase(self.commit_id, str(self._phase[0]), self._phase[1], now)
+                except Exception:
+                    pass
+            self._phase = (self._state, now)
 
-        Format:
-            <commit_id> <state> <msg>
+        self._progress(state_msg(self.commit_id, self._state, msg))
+
+    def _send(self, obj):
+        """
+        Helper function which sends obj to the parent process. Safe to
+        call from any thread
         """
-        complete_msg = "{} {} {}".format(self.commit_id, self._state, msg)
-        self._msg_pipe.send(complete_msg)
+        with self._msg_lock:
+            self._msg_pipe.send(obj)
+
+    def _progress(self, msg):
+        """
+        Helper function which sends a message showing the build has
+        moved on to the parent process
+        """
+        self._progress_at = time.time()
+        self._send(msg)
+
+    def _pulse(self):
+        """
+        Helper function run in its own thread, which sends the parent a
+        heartbeat every config.HEARTBEAT_INTERVAL seconds, and the CPU and
+        memory the worker is using every config.RESOURCE_SAMPLE_INTERVAL
+        seconds, until the message pipe is closed
+        """
+        sampled_at = 0
+        while True:
+            now = time.time()
+            try:
+                self._send(heartbeat_msg(self.commit_id, now - self._progress_at))
+                if now - sampled_at >= config.RESOURCE_SAMPLE_INTERVAL:
+                    sampled_at = now
+                    cpu_seconds, mem_kb = RugbyWorker.process_usage()
+                    self._send(resources_msg(self.commit_id, None, cpu_seconds, mem_kb))
+            except (EnvironmentError, ValueError):
+                return
+            time.sleep(config.HEARTBEAT_INTERVAL)
 
     @staticmethod
-    def extract_id_and_state(msg):
+    def process_usage():
         """
-        This method takes a message sent using RugbyWorker._send_msg
-        in the following format
-            <commit_id> <state> <msg>
-        and returns the first 2 components.
-            [commit_id, state]
+        This method returns the CPU seconds used by this process and the
+        processes it has waited for, and its resident memory in KB, as
+        [cpu_seconds, mem_kb]. mem_kb is None if /proc isn't there
         """
-        split_msg = msg.split(' ')
-        return split_msg[0], split_msg[1]
+        cpu_seconds = sum(os.times()[:4])
+        try:
+            with open('/proc/self/statm') as statm_file:
+                mem_kb = int(statm_file.read().split()[1]) * resource.getpagesize() / 1024
+        except (IOError, IndexError, ValueError):
+            mem_kb = None
+        return cpu_seconds, mem_kb
 
-    def _suicide(self, msg):
+    def _listen(self):
         """
-        Helper function which will set error state, send
-        message to parent process, cleanup, then kill the process
+        Helper function run in its own thread, which waits for the parent
+        process to cancel the build
         """
-        self._state = RugbyState.ERROR
-        self._send_msg(msg)
+        while True:
+            try:
+                msg = self._msg_pipe.recv()
+            except (EOFError, IOError):
+                return
+            if is_current(msg) and msg[1] == CANCEL:
+                self._stop_build(msg_state(msg), msg[5])
+
+    def _start_watchdog(self, started_at):
+        """
+        Helper function which stops the build once it has run for its
+        build timeout, the longest build_timeout of any block
+        """
+        build_timeouts = [vm['build_timeout'] for vm in self._conf_obj if 'build_timeout' in vm]
+        build_timeout = max(build_timeouts) if build_timeouts else config.BUILD_TIMEOUT
+        if build_timeout == None:
+            return
+        msg = 'Build ran past its build timeout of {}s'.format(build_timeout)
+        self._watchdog = Timer(started_at + build_timeout - time.time(), self._stop_build,
+                               args=(RugbyState.TIMEOUT, msg))
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _stop_build(self, state, msg):
+        """
+        Helper function which can be called from any thread to stop the
+        build, which will end in state. Commands which are running are
+        cancelled, and the main thread calls _suicide as soon as it gets
+        to a _check_stop
+        """
+        if self._stop != None:
+            return
+        self._stop = (state, msg)
+        for cancelled, channels in list(self._running_phases):
+            cancelled.set()
+            for channel in channels.values():
+                channel.close()
+
+    def _check_stop(self):
+        """
+        Helper function which ends the build if it has been stopped
+        """
+        if self._stop != None:
+            self._suicide(self._stop[1], self._stop[0])
+
+    def _suicide(self, msg, state=RugbyState.ERROR):
+        """
+        Helper function which will set error state, cleanup, send
+        message to parent process, then kill the process. The message
+        is sent last so the parent has every log line by the time it
+        hears about the error. A build which was stopped ends in state
+        instead of ERROR, IE CANCELLED or TIMEOUT
+        """
+        self._state = state
+        if self._log_fd != None:
+            self._log_fd.write('{}\n'.format(msg))
         self._cleanup()
+        self._send_msg(msg)
         sys.exit(1)
 
+    def _unique_providers(self):
+        """
+        Helper function which returns each provider of the build once
+        """
+        providers = []
+        for vm in self._conf_obj or []:
+            provider = self._providers.get(vm['name'])
+            if provider != None and provider not in providers:
+                providers.append(provider)
+        return providers
+
     def _cleanup(self):
         """
         Helper function which will delete any files generated
         by worker (except log file), and close open file descriptor
         """
+        if self._watchdog != None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+        # Close SSH connections, and log how much of the time spent
+        # talking to each VM went on connecting to it
+        self._connections.close()
+        if self._log_fd != None:
+            for block_name, timings in sorted(self._connections.get_timings().iteritems()):
+                self._log_fd.write('[{}] SSH setup {:.2f}s ({} connections), commands {:.2f}s ({} commands)\n'.format(
+                    block_name, timings.connect_seconds, timings.connects,
+                    timings.command_seconds, timings.commands))
+
+        # Hand pool VMs back so they can be reset, instead of destroying them
+        if self._leases:
+            self.pool.release(self._leases)
+            self._leases = []
+
+        # Give back this build's subnet
+        if self._network_lease != None:
+            self.network.release(self.commit_id)
+            self._network_lease = None
+
+        # Destroy VMs
+        for provider in self._unique_providers():
+            try:
+                provider.destroy()
+            except Exception:
+                pass
+        self._providers.clear()
+
         if os.path.isdir(self.root_dir):
-            # Destroy VMs
-            if self._vagrant != None:
-                self._vagrant.destroy()
             # Remove root directory
             try:
                 shutil.rmtree(self.root_dir, ignore_errors=True)
             except Exception:
                 pass
 
-        # Close log fd
+        # Close log pipe, and wait for everything written to it
+        # to be sent to the parent
         if self._log_fd != None:
+            if sys.stdout is self._log_fd:
+                sys.stdout = sys.__stdout__
+            if sys.stderr is self._log_fd:
+                sys.stderr = sys.__stderr__
             self._log_fd.close()
+            self._log_fd = None
+        if self._log_reader != None:
+            self._log_reader.join()
+            self._log_reader = None
+        if self._log_sender != None:
+            self._log_sender.close()
+            self._log_sender = None